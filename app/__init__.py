@@ -1,2 +1,10 @@
 # app/__init__.py
-from .main import app
\ No newline at end of file
+# Importing the package (or app.models, app.schemas, ...) doesn't build the
+# API; `app.app` is app.main's app, built on first access.
+
+
+def __getattr__(name):
+    if name == "app":
+        from .main import app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
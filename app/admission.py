@@ -0,0 +1,158 @@
+"""
+Admission control for deployment submissions.
+
+A submission is refused with 429 and a Retry-After header when it would
+take a queue past its depth limit, or its organization or cluster past its
+submission rate. The depth limits keep the backlog, and so the time of a
+scheduling pass, bounded; the rates keep one runaway pipeline from filling
+the queue for everyone else in the first place.
+
+Rates are token buckets: RATE submissions per second, up to BURST at once.
+A request for n deployments (a batch) needs n tokens in every bucket it
+touches and takes them from all of them or none; a batch larger than BURST
+is let through on a full bucket and leaves it in debt. With
+ADMISSION_BACKEND=redis (the default when the queue is on Redis) buckets are
+hashes under `admission:`, updated in WATCH transactions and shared by every
+replica; `memory` keeps them in the process.
+
+Depth is read from the queues (ZCARD) before the submission is inserted, so
+concurrent submissions can overshoot a depth limit by the few that were in
+flight: they are soft limits. Every limit is off at 0.
+"""
+from fastapi import HTTPException
+from sqlalchemy import select
+from app import database, metrics, models, queues
+from app.cache import TTLCache
+import math
+import os
+import redis
+import time
+
+ADMISSION_BACKEND = os.getenv("ADMISSION_BACKEND", queues.QUEUE_BACKEND)
+BUCKET_KEY = "admission:{}"
+# Submissions per second and bucket size, per organization and per cluster
+ADMISSION_ORG_RATE = float(os.getenv("ADMISSION_ORG_RATE", 0))
+ADMISSION_ORG_BURST = int(os.getenv("ADMISSION_ORG_BURST", 0)) or max(1, math.ceil(ADMISSION_ORG_RATE))
+ADMISSION_CLUSTER_RATE = float(os.getenv("ADMISSION_CLUSTER_RATE", 0))
+ADMISSION_CLUSTER_BURST = int(os.getenv("ADMISSION_CLUSTER_BURST", 0)) or max(1, math.ceil(ADMISSION_CLUSTER_RATE))
+# Queued deployments, over an organization's clusters and its own queue, and per cluster
+ADMISSION_ORG_MAX_PENDING = int(os.getenv("ADMISSION_ORG_MAX_PENDING", 0))
+ADMISSION_CLUSTER_MAX_PENDING = int(os.getenv("ADMISSION_CLUSTER_MAX_PENDING", 100000))
+# Retry-After seconds for a full queue, there is no telling when the scheduler drains it
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", 5))
+# Attempts at a Redis bucket update that another replica keeps changing
+ADMISSION_RETRIES = int(os.getenv("ADMISSION_RETRIES", 5))
+
+# organization id -> its cluster ids, for the organization's depth
+org_clusters = TTLCache(10000, 60)
+
+
+def _refill(tokens, stamp, rate, burst, now):
+    return burst if tokens is None else min(burst, tokens + max(0.0, now - stamp) * rate)
+
+
+def _wait(levels, buckets, count):
+    """(seconds until every bucket has room for `count`, the bucket that takes longest), 0 when they have it now."""
+    return max(
+        [((min(count, burst) - tokens) / rate, key) for tokens, (key, rate, burst) in zip(levels, buckets) if tokens < min(count, burst)],
+        default=(0.0, None),
+    )
+
+
+class MemoryBuckets:
+    """Buckets of this process, {key: (tokens, time of the last take)}."""
+
+    def __init__(self):
+        self._buckets = {}
+
+    async def take(self, buckets, count):
+        now = time.time()
+        levels = [_refill(*self._buckets.get(key, (None, now)), rate, burst, now) for key, rate, burst in buckets]
+        wait = _wait(levels, buckets, count)
+        if not wait[0]:
+            for (key, _, _), tokens in zip(buckets, levels):
+                self._buckets[key] = (tokens - count, now)
+        return wait
+
+
+class RedisBuckets:
+    async def take(self, buckets, count):
+        keys = [BUCKET_KEY.format(key) for key, _, _ in buckets]
+        for _ in range(ADMISSION_RETRIES):
+            # Read-compute-write in a WATCH transaction: fails if another replica took tokens in between
+            async with database.redis_client.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(*keys)
+                    now = time.time()
+                    levels = []
+                    for key, (_, rate, burst) in zip(keys, buckets):
+                        tokens, stamp = await pipe.hmget(key, "tokens", "stamp")
+                        levels.append(_refill(None if tokens is None else float(tokens), float(stamp or now), rate, burst, now))
+                    wait = _wait(levels, buckets, count)
+                    if wait[0]:
+                        return wait
+                    pipe.multi()
+                    for key, (_, rate, burst), tokens in zip(keys, buckets, levels):
+                        pipe.hset(key, mapping={"tokens": tokens - count, "stamp": now})
+                        # A bucket idle long enough to be full again is the same as none
+                        pipe.expire(key, math.ceil(burst / rate) + 1)
+                    await pipe.execute()
+                    return 0.0, None
+                except redis.WatchError:
+                    continue
+        # Contended all along, the client comes back shortly
+        return 1.0, buckets[0][0]
+
+
+def create_backend(name=ADMISSION_BACKEND):
+    if name == "redis":
+        return RedisBuckets()
+    if name == "memory":
+        return MemoryBuckets()
+    raise ValueError(f"Unknown ADMISSION_BACKEND {name!r}, expected 'redis' or 'memory'")
+
+
+backend = create_backend()
+
+
+def _reject(scope, reason, retry_after, detail):
+    metrics.record_admission_rejection(scope, reason)
+    raise HTTPException(status_code=429, detail=detail, headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+async def _org_depth(db, org_id):
+    cluster_ids = org_clusters.get(org_id)
+    if cluster_ids is None:
+        cluster_ids = (await db.execute(select(models.Cluster.id).where(models.Cluster.organization_id == org_id))).scalars().all()
+        org_clusters.set(org_id, cluster_ids)
+    return await queues.backend.count(cluster_ids) + await queues.backend.auto.size(org_id)
+
+
+async def admit(db, org_id, cluster_id=None, count=1):
+    """
+    Raise a 429 unless `count` more deployments may be submitted to the
+    organization, on `cluster_id` or for the scheduler to place when None.
+    Takes their tokens when they may.
+    """
+    if ADMISSION_CLUSTER_MAX_PENDING and cluster_id is not None:
+        depth = await queues.backend.size(cluster_id)
+        if depth + count > ADMISSION_CLUSTER_MAX_PENDING:
+            _reject("cluster", "depth", ADMISSION_RETRY_AFTER,
+                    f"Cluster {cluster_id} has {depth} deployments waiting, at most {ADMISSION_CLUSTER_MAX_PENDING}")
+    if ADMISSION_ORG_MAX_PENDING:
+        depth = await _org_depth(db, org_id)
+        if depth + count > ADMISSION_ORG_MAX_PENDING:
+            _reject("organization", "depth", ADMISSION_RETRY_AFTER,
+                    f"Organization {org_id} has {depth} deployments waiting, at most {ADMISSION_ORG_MAX_PENDING}")
+
+    buckets = []
+    if ADMISSION_ORG_RATE:
+        buckets.append((f"organization:{org_id}", ADMISSION_ORG_RATE, ADMISSION_ORG_BURST))
+    if ADMISSION_CLUSTER_RATE and cluster_id is not None:
+        buckets.append((f"cluster:{cluster_id}", ADMISSION_CLUSTER_RATE, ADMISSION_CLUSTER_BURST))
+    if not buckets:
+        return
+    wait, bucket = await backend.take(buckets, count)
+    if wait:
+        scope = bucket.split(":")[0]
+        _reject(scope, "rate", wait, f"Submission rate of {bucket.replace(':', ' ')} exceeded, retry in {math.ceil(wait)}s")
@@ -1,14 +1,21 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
 from jose import JWTError, jwt
 from typing import Optional
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from app import models, schemas
+from app import database, models, schemas
+from app.authz import invalidate_membership
+from app.cache import TTLCache
 from app.database import get_db
-from dotenv import load_dotenv
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import os
+import redis
+import time
 
 router = APIRouter()
 
@@ -16,9 +23,24 @@ SECRET_KEY = os.getenv("SECRET_KEY", 'e680e668-363f-4c5f-90ff-44fcd1e3a84e')
 ALGORITHM = os.getenv("ALGORITHM", 'HS256')
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", '30'))
 
+# Verified token -> user cache, entries never outlive the token's exp claim
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", 10000))
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", 300))
+# Share resolved users between workers through Redis, and broadcast invalidations
+AUTH_CACHE_REDIS = os.getenv("AUTH_CACHE_REDIS", "0") == "1"
+USER_CACHE_KEY = "auth:user:{}"
+INVALIDATE_CHANNEL = "auth_invalidate"
+# Comma-separated usernames allowed on the admin endpoints (POST /scheduler/reconcile), none by default
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
+# bcrypt cost; hashes made with fewer rounds are upgraded on the next login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+# bcrypt releases the GIL, so a few threads hash in parallel without touching the event loop
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", min(4, os.cpu_count() or 1)))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS, bcrypt__min_rounds=BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+_hash_pool = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash")
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -26,10 +48,23 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
-def authenticate_user(db: Session, username: str, password: str):
-    user = db.query(models.User).filter(models.User.username == username).first()
-    if not user or not verify_password(password, user.hashed_password):
+async def _in_hash_pool(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_hash_pool, fn, *args)
+
+async def hash_password(password):
+    return await _in_hash_pool(get_password_hash, password)
+
+async def authenticate_user(db: AsyncSession, username: str, password: str):
+    user = (await db.execute(select(models.User).where(models.User.username == username))).scalars().first()
+    if not user:
         return False
+    valid, new_hash = await _in_hash_pool(pwd_context.verify_and_update, password, user.hashed_password)
+    if not valid:
+        return False
+    if new_hash:
+        # Deprecated scheme or cost, store the hash made with the current settings
+        user.hashed_password = new_hash
+        await db.commit()
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -42,12 +77,75 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+token_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+# Bumped whenever a user changes, cached entries of an older generation are ignored
+_user_generation = defaultdict(int)
+
+def invalidate_user(username: str):
+    _user_generation[username] += 1
+    if AUTH_CACHE_REDIS:
+        try:
+            asyncio.get_running_loop().create_task(_invalidate_shared(username))
+        except RuntimeError:
+            pass  # no loop, e.g. a script; the shared entry expires with AUTH_CACHE_TTL
+
+async def _invalidate_shared(username: str):
+    try:
+        pipe = database.redis_client.pipeline(transaction=False)
+        pipe.delete(USER_CACHE_KEY.format(username))
+        pipe.publish(INVALIDATE_CHANNEL, username)
+        await pipe.execute()
+    except redis.RedisError as e:
+        print(f"Could not invalidate cached user {username}: {e}")
+
+async def listen_for_invalidations():
+    # Users changed by other workers
+    while True:
+        try:
+            async with database.redis_client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                await pubsub.subscribe(INVALIDATE_CHANNEL)
+                async for message in pubsub.listen():
+                    _user_generation[message["data"].decode()] += 1
+        except redis.RedisError as e:
+            print(f"Lost {INVALIDATE_CHANNEL} subscription, cached users expire after {AUTH_CACHE_TTL}s: {e}")
+            token_cache.clear()
+            await asyncio.sleep(AUTH_CACHE_TTL)
+
+@event.listens_for(models.User, "after_update")
+@event.listens_for(models.User, "after_delete")
+def _user_changed(mapper, connection, target):
+    invalidate_user(target.username)
+    for old_username in inspect(target).attrs.username.history.deleted:
+        invalidate_user(old_username)
+
+async def _load_user(db: AsyncSession, username: str):
+    if AUTH_CACHE_REDIS:
+        try:
+            cached = await database.redis_client.get(USER_CACHE_KEY.format(username))
+            if cached is not None:
+                return schemas.User.parse_raw(cached)
+        except redis.RedisError:
+            pass
+    user = (await db.execute(select(models.User).where(models.User.username == username))).scalars().first()
+    if user is None:
+        return None
+    user = schemas.User.from_orm(user)
+    if AUTH_CACHE_REDIS:
+        try:
+            await database.redis_client.set(USER_CACHE_KEY.format(username), user.json(), ex=AUTH_CACHE_TTL)
+        except redis.RedisError:
+            pass
+    return user
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    cached = token_cache.get(token, valid=lambda entry: entry[1] == _user_generation[entry[0].username])
+    if cached is not None:
+        return cached[0]
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
@@ -56,26 +154,33 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         token_data = schemas.TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = db.query(models.User).filter(models.User.username == token_data.username).first()
+    generation = _user_generation[token_data.username]
+    user = await _load_user(db, token_data.username)
     if user is None:
         raise credentials_exception
+    token_cache.set(token, (user, generation), expires_at=payload.get("exp", time.time()))
     return user
 
+async def get_admin_user(current_user: schemas.User = Depends(get_current_user)):
+    if current_user.username not in ADMIN_USERNAMES:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin only, see ADMIN_USERNAMES")
+    return current_user
+
 @router.post("/register", response_model=schemas.User)
-def register(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = db.query(models.User).filter(models.User.username == user.username).first()
+async def register(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
+    db_user = (await db.execute(select(models.User).where(models.User.username == user.username))).scalars().first()
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await hash_password(user.password)
     db_user = models.User(username=user.username, hashed_password=hashed_password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 @router.post("/token", response_model=schemas.Token)
-async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(db, form_data.username, form_data.password)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -89,20 +194,25 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {"access_token": access_token, "token_type": "bearer"}
 
 @router.post("/join-organization")
-async def join_organization(invite_code: str, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    organization = db.query(models.Organization).filter(models.Organization.invite_code == invite_code).first()
+async def join_organization(invite_code: str, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    organization = (await db.execute(select(models.Organization).where(models.Organization.invite_code == invite_code))).scalars().first()
     if not organization:
         raise HTTPException(status_code=404, detail="Invalid invite code")
     
     user_org = models.UserOrganization(user_id=current_user.id, organization_id=organization.id)
     db.add(user_org)
-    db.commit()
+    await db.commit()
+    invalidate_membership(current_user.id)
     return {"message": "Successfully joined the organization"}
 
+@router.get("/auth/cache-stats")
+async def cache_stats(current_user: schemas.User = Depends(get_current_user)):
+    return {"token_cache": token_cache.stats()}
+
 @router.post("/create-organization", response_model=schemas.Organization)
-def create_organization(org: schemas.OrganizationCreate, db: Session = Depends(get_db)):
+async def create_organization(org: schemas.OrganizationCreate, db: AsyncSession = Depends(get_db)):
     db_org = models.Organization(**org.dict())
     db.add(db_org)
-    db.commit()
-    db.refresh(db_org)
+    await db.commit()
+    await db.refresh(db_org)
     return db_org
\ No newline at end of file
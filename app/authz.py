@@ -0,0 +1,124 @@
+"""
+Access checks for clusters and deployments.
+
+A user may access a cluster (and its deployments) when they belong to the
+cluster's organization; a deployment not placed on a cluster yet belongs to
+the organization it was submitted to. Each check takes at most one joined query, and none
+when the user's memberships and the cluster's organization are both cached.
+Cached data only ever grants access: a denial is always confirmed against
+the database, so a join handled by another worker is never refused.
+"""
+from fastapi import HTTPException
+from sqlalchemy import and_, func, literal, select, union_all
+from app import models
+from app.cache import TTLCache
+import os
+
+AUTHZ_CACHE_SIZE = int(os.getenv("AUTHZ_CACHE_SIZE", 10000))
+AUTHZ_CACHE_TTL = int(os.getenv("AUTHZ_CACHE_TTL", 60))
+
+# user id -> frozenset of organization ids
+memberships = TTLCache(AUTHZ_CACHE_SIZE, AUTHZ_CACHE_TTL)
+# cluster id -> organization id, clusters never move between organizations
+cluster_orgs = TTLCache(AUTHZ_CACHE_SIZE, 24 * 3600)
+
+
+def invalidate_membership(user_id):
+    memberships.pop(user_id)
+
+
+def remember_cluster(cluster):
+    cluster_orgs.set(cluster.id, cluster.organization_id)
+
+
+async def user_org_ids(db, user_id):
+    orgs = memberships.get(user_id)
+    if orgs is None:
+        orgs = frozenset((await db.execute(
+            select(models.UserOrganization.organization_id).where(models.UserOrganization.user_id == user_id)
+        )).scalars().all())
+        memberships.set(user_id, orgs)
+    return orgs
+
+
+async def _load_access(db, user_id, cluster_id):
+    # The user's organizations and the cluster's organization in one round trip
+    rows = (await db.execute(union_all(
+        select(models.UserOrganization.organization_id, literal(False).label("is_cluster"))
+        .where(models.UserOrganization.user_id == user_id),
+        select(models.Cluster.organization_id, literal(True).label("is_cluster"))
+        .where(models.Cluster.id == cluster_id),
+    ))).all()
+    orgs = frozenset(org_id for org_id, is_cluster in rows if not is_cluster)
+    memberships.set(user_id, orgs)
+    cluster_found = [org_id for org_id, is_cluster in rows if is_cluster]
+    if not cluster_found:
+        return False, None, orgs
+    cluster_orgs.set(cluster_id, cluster_found[0])
+    return True, cluster_found[0], orgs
+
+
+async def authorize_cluster(db, current_user, cluster_id):
+    """Raise 404/403 unless the cluster exists and the user may access it; returns its organization id."""
+    org_id = cluster_orgs.get(cluster_id)
+    orgs = memberships.get(current_user.id)
+    if org_id is not None and orgs is not None and org_id in orgs:
+        return org_id
+
+    found, org_id, orgs = await _load_access(db, current_user.id, cluster_id)
+    if not found:
+        raise HTTPException(status_code=404, detail="Cluster not found")
+    if org_id not in orgs:
+        raise HTTPException(status_code=403, detail="User does not have access to this cluster")
+    return org_id
+
+
+async def authorize_organization(db, current_user, org_id):
+    """Raise 403 unless the user belongs to the organization."""
+    if org_id in memberships.get(current_user.id, ()):
+        return org_id
+    memberships.pop(current_user.id)
+    if org_id not in await user_org_ids(db, current_user.id):
+        raise HTTPException(status_code=403, detail="User does not belong to this organization")
+    return org_id
+
+
+async def get_authorized_cluster(db, current_user, cluster_id):
+    """The cluster row, checked for access with a single query."""
+    row = (await db.execute(
+        select(models.Cluster, models.UserOrganization.user_id)
+        .outerjoin(models.UserOrganization, and_(
+            models.UserOrganization.organization_id == models.Cluster.organization_id,
+            models.UserOrganization.user_id == current_user.id,
+        ))
+        .where(models.Cluster.id == cluster_id)
+    )).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Cluster not found")
+    cluster, member = row
+    remember_cluster(cluster)
+    if member is None:
+        raise HTTPException(status_code=403, detail="User does not have access to this cluster")
+    return cluster
+
+
+async def get_authorized_deployment(db, current_user, deployment_id):
+    """The deployment row, checked for access through its cluster (or organization) with a single query."""
+    org_id = func.coalesce(models.Cluster.organization_id, models.Deployment.organization_id)
+    row = (await db.execute(
+        select(models.Deployment, org_id, models.UserOrganization.user_id)
+        .outerjoin(models.Cluster, models.Cluster.id == models.Deployment.cluster_id)
+        .outerjoin(models.UserOrganization, and_(
+            models.UserOrganization.organization_id == org_id,
+            models.UserOrganization.user_id == current_user.id,
+        ))
+        .where(models.Deployment.id == deployment_id)
+    )).first()
+    if row is None:
+        raise HTTPException(status_code=404, detail="Deployment not found")
+    deployment, org_id, member = row
+    if deployment.cluster_id is not None:
+        cluster_orgs.set(deployment.cluster_id, org_id)
+    if member is None:
+        raise HTTPException(status_code=403, detail="User does not have access to this deployment")
+    return deployment
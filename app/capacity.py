@@ -0,0 +1,139 @@
+"""
+Resident index of the free resources of an organization's clusters, used by
+the scheduler to place deployments submitted without a cluster.
+
+Each organization gets a segment tree over its clusters (by id when it is
+built, clusters created later are appended) whose nodes hold the largest
+free ram, cpu and gpu below them. An update is O(log n). A fit query walks
+down to the first cluster that can take the demand and only enters subtrees
+whose maxima all admit it, so it is O(log n) whenever one cluster dominates
+a subtree, and returns at the root in O(1) when nothing fits. Picking the
+first fit in a fixed order packs the fleet instead of spreading every
+organization thin.
+
+Indexes are built from the database the first time an organization needs
+one, then kept in sync by the scheduler: every cluster it schedules or finds
+dirty (allocations, releases, new clusters) is written back. They are only
+hints: a cluster found here is offered the deployment, and the claim in that
+cluster's own pass is what gives it the cluster and allocates.
+"""
+from sqlalchemy import select
+from app import models
+
+_EMPTY = (-1, -1, -1)
+
+
+def _max(a, b):
+    return (max(a[0], b[0]), max(a[1], b[1]), max(a[2], b[2]))
+
+
+def _fits(free, demand):
+    return free[0] >= demand[0] and free[1] >= demand[1] and free[2] >= demand[2]
+
+
+class CapacityIndex:
+    """Free (ram, cpu, gpu) per cluster of one organization."""
+
+    def __init__(self, clusters=()):
+        self._slots = {}
+        self._ids = []
+        self._size = 1
+        self._tree = [_EMPTY, _EMPTY]
+        for cluster_id, free in sorted(clusters):
+            self.update(cluster_id, free)
+
+    def __len__(self):
+        return len(self._slots)
+
+    def __contains__(self, cluster_id):
+        return cluster_id in self._slots
+
+    def get(self, cluster_id):
+        return self._tree[self._size + self._slots[cluster_id]]
+
+    def update(self, cluster_id, free):
+        slot = self._slots.get(cluster_id)
+        if slot is None:
+            slot = self._slots[cluster_id] = len(self._ids)
+            self._ids.append(cluster_id)
+            if slot == self._size:
+                self._grow()
+        i = self._size + slot
+        self._tree[i] = tuple(int(v) for v in free)
+        i //= 2
+        while i:
+            self._tree[i] = _max(self._tree[2 * i], self._tree[2 * i + 1])
+            i //= 2
+
+    def reserve(self, cluster_id, demand):
+        free = self.get(cluster_id)
+        self.update(cluster_id, (free[0] - demand[0], free[1] - demand[1], free[2] - demand[2]))
+
+    def find(self, demand, exclude=()):
+        """The first cluster (in index order) with room for `demand` and not in `exclude`, or None."""
+        tree = self._tree
+        if not _fits(tree[1], demand):
+            return None
+        stack = [1]
+        while stack:
+            i = stack.pop()
+            if i >= self._size:
+                if self._ids[i - self._size] not in exclude:
+                    return self._ids[i - self._size]
+                continue
+            # Right pushed first, so the left subtree is searched first
+            for child in (2 * i + 1, 2 * i):
+                if _fits(tree[child], demand):
+                    stack.append(child)
+        return None
+
+    def _grow(self):
+        leaves = self._tree[self._size:] + [_EMPTY] * self._size
+        self._size *= 2
+        self._tree = [_EMPTY] * self._size + leaves
+        for i in range(self._size - 1, 0, -1):
+            self._tree[i] = _max(self._tree[2 * i], self._tree[2 * i + 1])
+
+
+# organization id -> CapacityIndex, of this process
+indexes = {}
+# cluster id -> organization id, of the clusters seen by the scheduler
+cluster_orgs = {}
+
+
+async def load(db, org_id):
+    """The organization's index, built from its clusters the first time."""
+    index = indexes.get(org_id)
+    if index is None:
+        rows = (await db.execute(
+            select(models.Cluster.id, models.Cluster.available_ram, models.Cluster.available_cpu, models.Cluster.available_gpu)
+            .where(models.Cluster.organization_id == org_id)
+        )).all()
+        index = indexes[org_id] = CapacityIndex((row[0], row[1:4]) for row in rows)
+        for row in rows:
+            cluster_orgs[row[0]] = org_id
+    return index
+
+
+def update(org_id, cluster_id, free):
+    cluster_orgs[cluster_id] = org_id
+    index = indexes.get(org_id)
+    if index is not None:
+        index.update(cluster_id, free)
+
+
+async def refresh(db, cluster_id):
+    """Re-read a cluster whose capacity may have changed behind the scheduler's back, if it is indexed."""
+    if not indexes:
+        return
+    row = (await db.execute(
+        select(models.Cluster.organization_id, models.Cluster.available_ram, models.Cluster.available_cpu,
+               models.Cluster.available_gpu).where(models.Cluster.id == cluster_id)
+    )).first()
+    if row is not None:
+        update(row[0], cluster_id, row[1:4])
+
+
+def reset():
+    indexes.clear()
+    cluster_orgs.clear()
@@ -1,57 +1,84 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app import models, schemas
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import admission, models, queues, schemas, versions
 from app.database import get_db
 from app.auth import get_current_user
-from typing import List
+from app.authz import get_authorized_cluster, remember_cluster, user_org_ids
+from app.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, keyset, ndjson, page
+from app.scheduler import notify_scheduler
+from typing import List, Optional
 
 router = APIRouter()
 
 @router.post("/clusters", response_model=schemas.Cluster)
-def create_cluster(cluster: schemas.ClusterCreate, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_cluster(cluster: schemas.ClusterCreate, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
     # Check if user belongs to an organization
-    user_org = db.query(models.UserOrganization).filter(models.UserOrganization.user_id == current_user.id).first()
-    if not user_org:
+    org_ids = await user_org_ids(db, current_user.id)
+    if not org_ids:
         raise HTTPException(status_code=400, detail="User does not belong to any organization")
 
     db_cluster = models.Cluster(
         **cluster.dict(),
-        organization_id=user_org.organization_id,
+        organization_id=min(org_ids),
         available_ram=cluster.total_ram,
         available_cpu=cluster.total_cpu,
         available_gpu=cluster.total_gpu
     )
     db.add(db_cluster)
-    db.commit()
-    db.refresh(db_cluster)
+    await db.commit()
+    await db.refresh(db_cluster)
+    remember_cluster(db_cluster)
+    # Tags and cached pages of the organization's cluster list
+    await versions.bump(organization_ids=[db_cluster.organization_id])
+    # Counted in the organization's queue depth from now on
+    admission.org_clusters.pop(db_cluster.organization_id)
+    # New capacity for the deployments submitted to the organization
+    await queues.backend.wake([db_cluster.id])
+    notify_scheduler(db_cluster.id)
     return db_cluster
 
 
 @router.get("/clusters", response_model=List[schemas.Cluster])
-def get_all_clusters(current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_all_clusters(
+    request: Request,
+    response: Response,
+    cursor: Optional[int] = Query(None, description="X-Next-Cursor of the previous page"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    stream: bool = Query(False, description="every cluster as NDJSON, ignores limit"),
+    current_user: schemas.User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
     # Fetch all clusters for the user’s organization
-    user_org = db.query(models.UserOrganization).filter(models.UserOrganization.user_id == current_user.id).first()
-    if not user_org:
+    org_ids = await user_org_ids(db, current_user.id)
+    if not org_ids:
         raise HTTPException(status_code=400, detail="User does not belong to any organization")
 
-    clusters = db.query(models.Cluster).filter(models.Cluster.organization_id == user_org.organization_id).all()
-    
-    return clusters
+    # Clusters have no created_at, they are paged by id
+    org_id = min(org_ids)
+    query = keyset(select(models.Cluster).where(models.Cluster.organization_id == org_id), models.Cluster, cursor, created_at=False)
+    if stream:
+        return ndjson(db, query, schemas.Cluster)
+
+    async def load():
+        # Collects the next page headers
+        paging = Response()
+        rows = await page(db, query, limit, request, paging)
+        headers = {name: value for name, value in paging.headers.items() if name in ("x-next-cursor", "link")}
+        return scope, org_id, [schemas.Cluster.from_orm(row) for row in rows], headers
+
+    # Every page changes with the organization's version, a cluster's capacity included
+    scope = versions.organization_scope(org_id)
+    return await versions.conditional(request, db, current_user, "clusters", ("clusters", org_id, str(request.url)), load, scope)
 
 
 
 @router.get("/clusters/{cluster_id}", response_model=schemas.Cluster)
-def get_cluster(cluster_id: int, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    cluster = db.query(models.Cluster).filter(models.Cluster.id == cluster_id).first()
-    if not cluster:
-        raise HTTPException(status_code=404, detail="Cluster not found")
-    
-    # Check if user has access to the cluster
-    user_org = db.query(models.UserOrganization).filter(
-        models.UserOrganization.user_id == current_user.id,
-        models.UserOrganization.organization_id == cluster.organization_id
-    ).first()
-    if not user_org:
-        raise HTTPException(status_code=403, detail="User does not have access to this cluster")
-    
-    return cluster
\ No newline at end of file
+async def get_cluster(cluster_id: int, request: Request, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    async def load():
+        # Existence and access in one query
+        cluster = await get_authorized_cluster(db, current_user, cluster_id)
+        return scope, cluster.organization_id, schemas.Cluster.from_orm(cluster), {}
+
+    scope = versions.cluster_scope(cluster_id)
+    return await versions.conditional(request, db, current_user, "cluster", ("cluster", cluster_id), load, scope)
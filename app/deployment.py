@@ -1,77 +1,210 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from app import models, schemas
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import admission, authz, events, models, queues, schemas, versions
 from app.database import get_db
 from app.auth import get_current_user
-from typing import List
-import redis
+from app.authz import authorize_cluster, authorize_organization, get_authorized_deployment
+from app.pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, keyset, ndjson, page
+from app.scheduler import notify_scheduler
+from typing import List, Optional
+import os
 
-router = APIRouter()
+# Largest accepted POST /deployments/batch
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 5000))
 
-# Redis connection
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
+router = APIRouter()
 
 @router.post("/deployments", response_model=schemas.Deployment)
-def create_deployment(deployment: schemas.DeploymentCreate, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    # Check if cluster exists and user has access to it
-    cluster = db.query(models.Cluster).filter(models.Cluster.id == deployment.cluster_id).first()
-    if not cluster:
-        raise HTTPException(status_code=404, detail="Cluster not found")
-    
-    user_org = db.query(models.UserOrganization).filter(
-        models.UserOrganization.user_id == current_user.id,
-        models.UserOrganization.organization_id == cluster.organization_id
-    ).first()
-    if not user_org:
-        raise HTTPException(status_code=403, detail="User does not have access to this cluster")
-
-    db_deployment = models.Deployment(**deployment.dict(), status="pending")
+async def create_deployment(deployment: schemas.DeploymentCreate, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    # Check if cluster exists and user has access to it, or that they belong to the organization
+    if deployment.cluster_id is None:
+        org_id = await authorize_organization(db, current_user, deployment.organization_id)
+    else:
+        org_id = await authorize_cluster(db, current_user, deployment.cluster_id)
+    # 429 when the queue is full or the submission rate exceeded
+    await admission.admit(db, org_id, deployment.cluster_id)
+
+    db_deployment = models.Deployment(**dict(deployment.dict(), organization_id=org_id), status="pending")
     db.add(db_deployment)
-    db.commit()
-    db.refresh(db_deployment)
+    await db.commit()
+    await db.refresh(db_deployment)
 
-    # Add deployment to Redis queue
-    redis_client.zadd("deployment_queue", {db_deployment.id: deployment.priority})
+    # Add deployment to its cluster's queue, the backend wakes the other schedulers
+    await _enqueue([db_deployment])
 
     return db_deployment
 
+async def _enqueue(deployments):
+    # Every queue in one enqueue each, a single round trip on Redis
+    queued, auto = {}, {}
+    for row in deployments:
+        if row.cluster_id is None:
+            auto.setdefault(row.organization_id, {})[row.id] = row.priority
+        else:
+            queued.setdefault(row.cluster_id, {})[row.id] = row.priority
+    if queued:
+        await queues.backend.enqueue(queued)
+        for cluster_id in queued:
+            notify_scheduler(cluster_id)
+    if auto:
+        # The scheduler picks their clusters
+        await queues.backend.auto.enqueue(auto)
+        notify_scheduler(queues.AUTO_WAKEUP)
+    await events.publish([
+        events.event(row.id, "pending", None, row.cluster_id, row.organization_id) for row in deployments
+    ])
+
+@router.post("/deployments/batch", response_model=List[schemas.DeploymentBatchResult])
+async def create_deployments(deployments: List[schemas.DeploymentCreate], response: Response, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    if len(deployments) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_SIZE} deployments per batch")
+
+    # Check access once per distinct cluster or organization, a refused one only fails its own items
+    denied, orgs = {}, {}
+    for cluster_id, org_id in {(deployment.cluster_id, deployment.organization_id) for deployment in deployments}:
+        try:
+            if cluster_id is None:
+                orgs[cluster_id, org_id] = await authorize_organization(db, current_user, org_id)
+            else:
+                orgs[cluster_id, org_id] = await authorize_cluster(db, current_user, cluster_id)
+        except HTTPException as exc:
+            denied[cluster_id, org_id] = exc
+
+    # Then admission, for all the items of a cluster or organization at once
+    counts = {}
+    for deployment in deployments:
+        target = (deployment.cluster_id, deployment.organization_id)
+        if target not in denied:
+            counts[target] = counts.get(target, 0) + 1
+    for (cluster_id, org_id), count in counts.items():
+        try:
+            await admission.admit(db, orgs[cluster_id, org_id], cluster_id, count)
+        except HTTPException as exc:
+            denied[cluster_id, org_id] = exc
+            # The longest wait of the refused items
+            retry_after = max(int(exc.headers["Retry-After"]), int(response.headers.get("Retry-After", 0)))
+            response.headers["Retry-After"] = str(retry_after)
+
+    results = [None] * len(deployments)
+    accepted = []
+    for index, deployment in enumerate(deployments):
+        exc = denied.get((deployment.cluster_id, deployment.organization_id))
+        if exc is not None:
+            results[index] = schemas.DeploymentBatchResult(index=index, status_code=exc.status_code, error=exc.detail)
+        else:
+            accepted.append(index)
+
+    if accepted:
+        # One multi-row INSERT ... RETURNING, in one transaction
+        rows = (await db.scalars(
+            insert(models.Deployment).returning(models.Deployment, sort_by_parameter_order=True),
+            [
+                dict(deployments[index].dict(), status="pending",
+                     organization_id=orgs[deployments[index].cluster_id, deployments[index].organization_id])
+                for index in accepted
+            ],
+        )).all()
+        await db.commit()
+
+        for index, row in zip(accepted, rows):
+            results[index] = schemas.DeploymentBatchResult(index=index, status_code=200, deployment=row)
+        await _enqueue(rows)
+
+    return results
+
 @router.get("/deployments/{deployment_id}", response_model=schemas.Deployment)
-def get_deployment(deployment_id: int, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    deployment = db.query(models.Deployment).filter(models.Deployment.id == deployment_id).first()
-    if not deployment:
-        raise HTTPException(status_code=404, detail="Deployment not found")
-    
-    # Check if user has access to the deployment's cluster
-    cluster = db.query(models.Cluster).filter(models.Cluster.id == deployment.cluster_id).first()
-    user_org = db.query(models.UserOrganization).filter(
-        models.UserOrganization.user_id == current_user.id,
-        models.UserOrganization.organization_id == cluster.organization_id
-    ).first()
-    if not user_org:
-        raise HTTPException(status_code=403, detail="User does not have access to this deployment")
-    
+async def get_deployment(deployment_id: int, request: Request, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    async def load():
+        # Load the deployment and check access to its cluster in one query
+        deployment = await get_authorized_deployment(db, current_user, deployment_id)
+        if deployment.cluster_id is None:
+            scope, org_id = versions.organization_scope(deployment.organization_id), deployment.organization_id
+        else:
+            # Remembered by the access check
+            scope, org_id = versions.cluster_scope(deployment.cluster_id), authz.cluster_orgs.get(deployment.cluster_id)
+        return scope, org_id, schemas.Deployment.from_orm(deployment), {}
+
+    # Its scope is only known from its row, or from the cached response
+    return await versions.conditional(request, db, current_user, "deployment", ("deployment", deployment_id), load)
+
+async def _finish(db, current_user, deployment_id, status, allowed_from):
+    deployment = await get_authorized_deployment(db, current_user, deployment_id)
+    previous = deployment.status
+    if previous not in allowed_from:
+        raise HTTPException(status_code=409, detail=f"Deployment is {previous}, expected one of {', '.join(allowed_from)}")
+
+    # Conditional on the status we read, so a concurrent scheduler pass or request can't be undone
+    changed = (await db.execute(
+        update(models.Deployment)
+        .where(models.Deployment.id == deployment_id, models.Deployment.status == previous)
+        .values(status=status)
+    )).rowcount
+    if changed != 1:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Deployment changed state concurrently, try again")
+    if previous == "running":
+        # Give the resources back in the same transaction, as an increment
+        await db.execute(
+            update(models.Cluster)
+            .where(models.Cluster.id == deployment.cluster_id)
+            .values(
+                available_ram=models.Cluster.available_ram + deployment.required_ram,
+                available_cpu=models.Cluster.available_cpu + deployment.required_cpu,
+                available_gpu=models.Cluster.available_gpu + deployment.required_gpu,
+            )
+        )
+    await db.commit()
+    await db.refresh(deployment)
+
+    await events.publish([
+        events.event(deployment.id, status, previous, deployment.cluster_id, deployment.organization_id)
+    ])
+    if previous == "pending" and deployment.cluster_id is None:
+        # Still waiting for the scheduler to pick a cluster
+        await queues.backend.auto.remove(deployment.organization_id, [deployment_id])
+        return deployment
+    if previous == "pending":
+        await queues.backend.remove(deployment.cluster_id, [deployment_id])
+    # Freed capacity goes to the cluster's queue right away, in this process or the scheduler's;
+    # a pending one leaving can unblock the queue too (strict_priority)
+    await queues.backend.wake([deployment.cluster_id])
+    notify_scheduler(deployment.cluster_id)
     return deployment
 
+@router.post("/deployments/{deployment_id}/complete", response_model=schemas.Deployment)
+async def complete_deployment(deployment_id: int, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    return await _finish(db, current_user, deployment_id, "completed", ("running",))
+
+@router.post("/deployments/{deployment_id}/terminate", response_model=schemas.Deployment)
+async def terminate_deployment(deployment_id: int, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    # A pending deployment is just taken off the queue
+    return await _finish(db, current_user, deployment_id, "terminated", ("pending", "running"))
+
 @router.get("/clusters/{cluster_id}/deployments", response_model=List[schemas.Deployment])
-def get_cluster_deployments(
-    cluster_id: int, 
+async def get_cluster_deployments(
+    cluster_id: int,
+    request: Request,
+    response: Response,
+    status: Optional[str] = None,
+    priority: Optional[int] = None,
+    cursor: Optional[int] = Query(None, description="X-Next-Cursor of the previous page"),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    stream: bool = Query(False, description="every matching deployment as NDJSON, ignores limit"),
     current_user: schemas.User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    # Check if the cluster exists
-    cluster = db.query(models.Cluster).filter(models.Cluster.id == cluster_id).first()
-    if not cluster:
-        raise HTTPException(status_code=404, detail="Cluster not found")
-    
-    # Check if the user has access to this cluster
-    user_org = db.query(models.UserOrganization).filter(
-        models.UserOrganization.user_id == current_user.id,
-        models.UserOrganization.organization_id == cluster.organization_id
-    ).first()
-    if not user_org:
-        raise HTTPException(status_code=403, detail="User does not have access to this cluster")
-    
-    # Fetch all deployments for the cluster
-    deployments = db.query(models.Deployment).filter(models.Deployment.cluster_id == cluster_id).all()
-    
-    return deployments
\ No newline at end of file
+    # Check if the cluster exists and the user has access to it
+    await authorize_cluster(db, current_user, cluster_id)
+
+    # Fetch the cluster's deployments, one page at a time by (created_at, id)
+    query = select(models.Deployment).where(models.Deployment.cluster_id == cluster_id)
+    if status is not None:
+        query = query.where(models.Deployment.status == status)
+    if priority is not None:
+        query = query.where(models.Deployment.priority == priority)
+    query = keyset(query, models.Deployment, cursor)
+
+    if stream:
+        return ndjson(db, query, schemas.Deployment)
+    return await page(db, query, limit, request, response)
@@ -0,0 +1,239 @@
+"""
+Deployment status changes, pushed to subscribers as they happen.
+
+The API and the scheduler publish an event for every transition they make
+(submitted, placed on a cluster, running, evicted, completed, terminated).
+Clients follow a deployment, a cluster or an organization as server-sent
+events instead of polling GET /deployments/{id}.
+
+Each process has one broker. The in-memory one delivers within the process.
+The Redis one (EVENT_BACKEND=redis, the default when the queue is on Redis)
+publishes on the `deployment_events` channel, and each process runs a single
+subscription to it, dispatching to its own subscribers. An idle subscriber
+costs a small queue and its connection, no database session and no Redis
+connection of its own.
+"""
+from collections import deque
+from datetime import datetime, timezone
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import database, queues, schemas, versions
+from app.auth import get_current_user
+from app.authz import authorize_cluster, authorize_organization, get_authorized_deployment
+from app.database import get_db
+import asyncio
+import json
+import os
+import redis
+
+EVENTS_CHANNEL = "deployment_events"
+EVENT_BACKEND = os.getenv("EVENT_BACKEND", queues.QUEUE_BACKEND)
+# Events kept for a subscriber that doesn't keep up, older ones are dropped and it is told so
+EVENTS_BUFFER = int(os.getenv("EVENTS_BUFFER", 100))
+# Seconds between keep-alive comments on a stream with nothing to say
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", 15))
+
+FINAL_STATUSES = {"completed", "terminated"}
+
+router = APIRouter()
+
+
+def event(deployment_id, status, previous, cluster_id=None, organization_id=None):
+    return {
+        "deployment_id": deployment_id,
+        "cluster_id": cluster_id,
+        "organization_id": organization_id,
+        "status": status,
+        "previous": previous,
+        "at": datetime.now(timezone.utc).isoformat(),
+    }
+
+
+def _topics(event):
+    yield f"deployment:{event['deployment_id']}"
+    if event["cluster_id"] is not None:
+        yield f"cluster:{event['cluster_id']}"
+    if event["organization_id"] is not None:
+        yield f"organization:{event['organization_id']}"
+
+
+class Subscription:
+    def __init__(self, broker, topic):
+        self.broker = broker
+        self.topic = topic
+        self.events = deque(maxlen=EVENTS_BUFFER)
+        # Set when events were dropped because the buffer was full
+        self.lagged = False
+        self._ready = asyncio.Event()
+
+    def put(self, event):
+        if len(self.events) == self.events.maxlen:
+            self.lagged = True
+        self.events.append(event)
+        self._ready.set()
+
+    async def get(self, timeout):
+        """The buffered events, or [] after `timeout` seconds without any."""
+        if not self.events:
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        events = list(self.events)
+        self.events.clear()
+        return events
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    """Delivers events to the subscribers of this process."""
+
+    def __init__(self):
+        self._subscribers = {}
+
+    def subscribe(self, topic):
+        subscription = Subscription(self, topic)
+        self._subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscribers = self._subscribers.get(subscription.topic)
+        if subscribers is not None:
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.topic]
+
+    def subscribers(self):
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+    def dispatch(self, events):
+        for event in events:
+            for topic in _topics(event):
+                for subscription in self._subscribers.get(topic, ()):
+                    subscription.put(event)
+
+    async def publish(self, events):
+        self.dispatch(events)
+
+
+class RedisBroker(Broker):
+    """Publishes on EVENTS_CHANNEL; one subscription per process, started with the first subscriber."""
+
+    def __init__(self):
+        super().__init__()
+        self._listener = None
+
+    def subscribe(self, topic):
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+        return super().subscribe(topic)
+
+    async def publish(self, events):
+        # Every event of a transaction in one message
+        await database.redis_client.publish(EVENTS_CHANNEL, json.dumps(events))
+
+    async def _listen(self):
+        while True:
+            try:
+                async with database.redis_client.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(EVENTS_CHANNEL)
+                    async for message in pubsub.listen():
+                        self.dispatch(json.loads(message["data"]))
+            except redis.RedisError as e:
+                print(f"Lost {EVENTS_CHANNEL} subscription, retrying: {e}")
+                await asyncio.sleep(1)
+
+
+def create_broker(name=EVENT_BACKEND):
+    if name == "redis":
+        return RedisBroker()
+    if name == "memory":
+        return Broker()
+    raise ValueError(f"Unknown EVENT_BACKEND {name!r}, expected 'redis' or 'memory'")
+
+
+broker = create_broker()
+
+
+async def publish(events):
+    """
+    Best effort: a transition that is committed stays committed when its event can't be sent.
+    The versions of the clusters and organizations concerned are bumped first, so a client
+    reacting to the event doesn't get a cached response from before it.
+    """
+    if not events:
+        return
+    await versions.bump({item["cluster_id"] for item in events}, {item["organization_id"] for item in events})
+    try:
+        await broker.publish(events)
+    except redis.RedisError as e:
+        print(f"Could not publish {len(events)} deployment events: {e}")
+
+
+def _format(event):
+    return f"event: status\ndata: {json.dumps(event)}\n\n"
+
+
+async def _stream(subscription, request, first=None):
+    try:
+        if first is not None:
+            yield _format(first)
+            if first["status"] in FINAL_STATUSES:
+                return
+        while True:
+            events = await subscription.get(EVENTS_HEARTBEAT)
+            if subscription.lagged:
+                # Some events were dropped, the client should re-read the current state
+                subscription.lagged = False
+                yield "event: lagged\ndata: {}\n\n"
+            if not events:
+                if await request.is_disconnected():
+                    return
+                yield ": keep-alive\n\n"
+            for event in events:
+                yield _format(event)
+                if subscription.topic.startswith("deployment:") and event["status"] in FINAL_STATUSES:
+                    return
+    finally:
+        subscription.close()
+
+
+def _response(subscription, request, first=None):
+    return StreamingResponse(
+        _stream(subscription, request, first),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/deployments/{deployment_id}/events")
+async def deployment_events(deployment_id: int, request: Request, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    # Subscribed before the current state is read, so no transition falls in between
+    subscription = broker.subscribe(f"deployment:{deployment_id}")
+    try:
+        deployment = await get_authorized_deployment(db, current_user, deployment_id)
+    except BaseException:
+        subscription.close()
+        raise
+    first = event(deployment.id, deployment.status, None, deployment.cluster_id, deployment.organization_id)
+    # Nothing below needs the database, no connection is held for the life of the stream
+    await db.close()
+    return _response(subscription, request, first)
+
+
+@router.get("/clusters/{cluster_id}/events")
+async def cluster_events(cluster_id: int, request: Request, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    await authorize_cluster(db, current_user, cluster_id)
+    await db.close()
+    return _response(broker.subscribe(f"cluster:{cluster_id}"), request)
+
+
+@router.get("/organizations/{organization_id}/events")
+async def organization_events(organization_id: int, request: Request, current_user: schemas.User = Depends(get_current_user), db: AsyncSession = Depends(get_db)):
+    await authorize_organization(db, current_user, organization_id)
+    await db.close()
+    return _response(broker.subscribe(f"organization:{organization_id}"), request)
@@ -0,0 +1,92 @@
+"""
+Leader election for the scheduler worker.
+
+Only the holder of the leader lock schedules. The Redis lock is a key set
+with NX and a TTL, renewed by a heartbeat; a leader that stops renewing (hung,
+partitioned, killed) loses it once the TTL runs out and a standby takes over.
+The file lock is the local stand-in: an flock held for the life of the
+process, released by the OS when the process dies.
+
+Two leaders can still briefly overlap (a paused leader that hasn't noticed
+its lock expired); the scheduler's conditional UPDATEs keep that safe, the
+lock only keeps the schedulers from duplicating work.
+"""
+from app import database
+import fcntl
+import os
+import redis
+import socket
+import uuid
+
+LEADER_LOCK = os.getenv("LEADER_LOCK", "redis")
+LEADER_KEY = os.getenv("LEADER_KEY", "scheduler:leader")
+LEADER_TTL = float(os.getenv("LEADER_TTL", 15))
+LEADER_LOCK_FILE = os.getenv("LEADER_LOCK_FILE", "/tmp/deployment-scheduler.lock")
+
+
+class RedisLeaderLock:
+    def __init__(self, client, key=LEADER_KEY, ttl=LEADER_TTL):
+        self.client = client
+        self.key = key
+        self.ttl_ms = int(ttl * 1000)
+        # Identifies this holder, so we never renew or release someone else's lock
+        self.token = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex}".encode()
+
+    async def acquire(self):
+        return bool(await self.client.set(self.key, self.token, nx=True, px=self.ttl_ms))
+
+    async def renew(self):
+        return await self._if_held(lambda pipe: pipe.pexpire(self.key, self.ttl_ms))
+
+    async def release(self):
+        await self._if_held(lambda pipe: pipe.delete(self.key))
+
+    async def _if_held(self, command):
+        # Compare-and-act in a WATCH transaction: fails if the key changed in between
+        async with self.client.pipeline(transaction=True) as pipe:
+            try:
+                await pipe.watch(self.key)
+                if await pipe.get(self.key) != self.token:
+                    return False
+                pipe.multi()
+                command(pipe)
+                await pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+
+class FileLeaderLock:
+    def __init__(self, path=LEADER_LOCK_FILE):
+        self.path = path
+        self._file = None
+
+    async def acquire(self):
+        file = open(self.path, "a")
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return False
+        self._file = file
+        return True
+
+    async def renew(self):
+        return self._file is not None
+
+    async def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+def create_lock(kind=LEADER_LOCK):
+    """The configured leader lock, or None when every worker should schedule (LEADER_LOCK=none)."""
+    if kind == "redis":
+        return RedisLeaderLock(database.redis_client)
+    if kind == "file":
+        return FileLeaderLock()
+    if kind == "none":
+        return None
+    raise ValueError(f"Unknown LEADER_LOCK {kind!r}, expected 'redis', 'file' or 'none'")
@@ -1,22 +1,67 @@
+"""
+The API. create_app() builds it; importing this module builds nothing, the
+module's `app` is created on first access, so both
+
+    uvicorn app.main:app
+    uvicorn --factory app.main:create_app
+
+work. The schema is created, and an existing one upgraded (app/migrate.py),
+at startup (CREATE_SCHEMA=0 to leave it to migrations), never at import.
+"""
 from fastapi import FastAPI
-from app import auth, cluster, deployment, scheduler
-from app.database import engine, Base
+import asyncio
+import os
+
+# Set to 0 when the scheduler runs in its own process (python -m app.scheduler_worker)
+EMBEDDED_SCHEDULER = os.getenv("EMBEDDED_SCHEDULER", "1") == "1"
+# Set to 0 when the tables are managed elsewhere
+CREATE_SCHEMA = os.getenv("CREATE_SCHEMA", "1") == "1"
+
+
+def create_app(embedded_scheduler=EMBEDDED_SCHEDULER, create_schema=CREATE_SCHEMA):
+    from app import auth, cluster, database, deployment, events, metrics, migrate, monitoring, scheduler
+
+    app = FastAPI()
+    # Request latency per router, see GET /metrics
+    app.add_middleware(metrics.HTTPMetricsMiddleware)
+
+    # incliding all routers
+    app.include_router(auth.router)
+    app.include_router(cluster.router)
+    app.include_router(deployment.router)
+    app.include_router(scheduler.router)
+    app.include_router(monitoring.router)
+    app.include_router(events.router)
+
+    # Stops the embedded scheduler, set while it runs
+    stops = []
+
+    # Create db tables, start scheduler
+    @app.on_event("startup")
+    async def startup_event():
+        if create_schema:
+            await database.create_schema()
+            await migrate.upgrade()
+        if embedded_scheduler:
+            stops.append(scheduler.start_scheduler())
+        if auth.AUTH_CACHE_REDIS:
+            asyncio.get_running_loop().create_task(auth.listen_for_invalidations())
+
+    @app.on_event("shutdown")
+    async def shutdown_event():
+        while stops:
+            stops.pop()()
 
-app = FastAPI()
+    return app
 
-# Create db tables
-Base.metadata.create_all(bind=engine)
 
-# incliding all routers
-app.include_router(auth.router)
-app.include_router(cluster.router)
-app.include_router(deployment.router)
+def __getattr__(name):
+    if name == "app":
+        globals()["app"] = create_app()
+        return globals()["app"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
-# Start scheduler
-@app.on_event("startup")
-async def startup_event():
-    scheduler.start_scheduler()
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(create_app(), host="0.0.0.0", port=8000)
@@ -0,0 +1,270 @@
+"""
+In-process metrics, exposed in the Prometheus text format at GET /metrics.
+
+Histograms use fixed buckets, like Prometheus histograms, so recording is
+O(log buckets) and memory doesn't grow with traffic; quantiles are
+estimated from the buckets. Every process keeps its own: the numbers of the
+scheduler are in whichever process runs it, scrape every API worker and
+scheduler worker.
+
+Recording is a dict lookup and an addition, without locks: it happens on the
+event loop, a count lost to a race with a thread is not worth a lock on
+every query.
+"""
+from bisect import bisect_left
+from time import perf_counter
+
+# Seconds, from sub-millisecond wake-up driven placements to deployments that waited hours for capacity
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, float("inf"))
+# Seconds, for database queries and Redis round trips
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, float("inf"))
+# Deployments per scheduling pass
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000, float("inf"))
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate, interpolated linearly inside the bucket the quantile falls in."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if self.buckets[i] != float("inf") else lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-2]
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Value:
+    """A counter or gauge."""
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        self.value = value
+
+
+_registry = []
+
+
+class Metric:
+    """A metric family: one Value or Histogram per combination of label values."""
+
+    def __init__(self, kind, name, documentation, labelnames=(), buckets=None):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.children = {}
+        _registry.append(self)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = Histogram(self.buckets) if self.kind == "histogram" else Value()
+        return child
+
+    def clear(self):
+        self.children.clear()
+
+
+def counter(name, documentation, labelnames=()):
+    return Metric("counter", name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return Metric("gauge", name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    return Metric("histogram", name, documentation, labelnames, buckets)
+
+
+# API
+http_request_duration = histogram(
+    "http_request_duration_seconds", "Time to answer an HTTP request, per router", ("router", "method"), FAST_BUCKETS,
+)
+http_requests = counter("http_requests_total", "HTTP requests answered, per router and status class", ("router", "method", "status"))
+# Submissions refused by app/admission.py, per organization or cluster limit and kind of limit
+admission_rejections = counter(
+    "admission_rejections_total", "Submissions refused with 429, per scope and reason (rate or depth)", ("scope", "reason"),
+)
+# Conditional GETs: served from the response cache, answered 304, or read from the database
+http_cache = counter("http_cache_total", "Cacheable GETs, per resource and result", ("resource", "result"))
+
+# Scheduler
+scheduler_pass_duration = histogram("scheduler_pass_duration_seconds", "Duration of a scheduling pass", buckets=FAST_BUCKETS)
+scheduler_pass_placed = histogram("scheduler_pass_placed", "Deployments placed per scheduling pass", buckets=COUNT_BUCKETS)
+scheduler_pass_skipped = histogram(
+    "scheduler_pass_skipped", "Deployments left waiting for resources per scheduling pass", buckets=COUNT_BUCKETS,
+)
+# Incremental passes only look at the dirty clusters, full sweeps at every queue
+scheduler_pass_clusters = histogram(
+    "scheduler_pass_clusters", "Clusters evaluated per scheduling pass, per kind of pass", ("kind",), COUNT_BUCKETS,
+)
+# Submission to running, per deployment priority
+scheduling_latency = histogram(
+    "scheduler_scheduling_latency_seconds", "Time from submission to running, per priority", ("priority",),
+)
+# Deployments placed by evicting others, and deployments evicted back to pending
+preemptions = counter("scheduler_preemptions_total", "Deployments placed by evicting lower-priority ones")
+evictions = counter("scheduler_evictions_total", "Running deployments evicted back to the queue")
+auto_placements = counter("scheduler_auto_placements_total", "Deployments submitted to an organization given a cluster")
+# Queue entries repaired by app/reconcile.py: requeued, rescored or removed
+queue_reconciled = counter("queue_reconciled_total", "Queue entries repaired to match the database, per action", ("action",))
+queue_depth = gauge("queue_depth", "Deployments waiting in a cluster's queue", ("cluster_id",))
+cluster_utilization = gauge("cluster_utilization_ratio", "Allocated share of a cluster's resource", ("cluster_id", "resource"))
+
+# Database and Redis
+db_query_duration = histogram(
+    "db_query_duration_seconds", "Database query time, per statement type", ("operation",), FAST_BUCKETS,
+)
+redis_duration = histogram("redis_command_duration_seconds", "Redis round trip time, per command", ("command",), FAST_BUCKETS)
+
+_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE"}
+
+
+def observe_query(statement, seconds):
+    operation = statement[:6].upper()
+    db_query_duration.labels(operation if operation in _OPERATIONS else "OTHER").observe(seconds)
+
+
+def observe_scheduled(priority, seconds):
+    scheduling_latency.labels(priority).observe(seconds)
+
+
+def observe_pass(seconds, placed, skipped, clusters, kind):
+    scheduler_pass_duration.labels().observe(seconds)
+    scheduler_pass_placed.labels().observe(placed)
+    scheduler_pass_skipped.labels().observe(skipped)
+    scheduler_pass_clusters.labels(kind).observe(clusters)
+
+
+def record_preemption(placed, evicted):
+    preemptions.labels().inc(placed)
+    evictions.labels().inc(evicted)
+
+
+def record_auto_placement(count):
+    auto_placements.labels().inc(count)
+
+
+def record_reconciled(action, count):
+    queue_reconciled.labels(action).inc(count)
+
+
+def record_admission_rejection(scope, reason):
+    admission_rejections.labels(scope, reason).inc()
+
+
+def record_cache(resource, result):
+    http_cache.labels(resource, result).inc()
+
+
+def scheduler_stats():
+    return {
+        "latency_by_priority": {
+            priority: latency.summary() for (priority,), latency in sorted(scheduling_latency.children.items())
+        },
+        "preemptions": preemptions.labels().value,
+        "evictions": evictions.labels().value,
+    }
+
+
+def reset():
+    for metric in _registry:
+        metric.clear()
+
+
+def _router(scope):
+    # Routers are one per module (app/auth.py, app/cluster.py, ...), so the endpoint's module names it
+    route = scope.get("route")
+    if route is None:
+        return "unmatched"
+    return getattr(route.endpoint, "__module__", "").rpartition(".")[2]
+
+
+class HTTPMetricsMiddleware:
+    """Plain ASGI middleware, times every request until its response is fully sent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = perf_counter()
+        status = 500
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            router = _router(scope)
+            http_request_duration.labels(router, scope["method"]).observe(perf_counter() - start)
+            http_requests.labels(router, scope["method"], f"{status // 100}xx").inc()
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def render():
+    """Every metric in the Prometheus text exposition format."""
+    lines = []
+    for metric in _registry:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for values, child in list(metric.children.items()):
+            pairs = list(zip(metric.labelnames, values))
+            if metric.kind != "histogram":
+                lines.append(f"{metric.name}{_labels(pairs)} {_number(child.value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(child.buckets, child.counts):
+                cumulative += count
+                lines.append(f"{metric.name}_bucket{_labels(pairs + [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{metric.name}_sum{_labels(pairs)} {_number(child.sum)}")
+            lines.append(f"{metric.name}_count{_labels(pairs)} {child.count}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,73 @@
+"""
+Upgrade of an existing database to the current models.
+
+create_schema() only creates missing tables, a table created by an older
+version keeps its old columns. The steps below add what was added to
+existing tables since, in order. Each one checks the schema first, so they
+can run again and again: at startup after create_schema() (unless
+CREATE_SCHEMA=0), or by hand, before deploying a new version, with
+
+    python -m app.migrate
+"""
+from sqlalchemy import inspect, text
+from app import database, models
+import asyncio
+
+
+def _add_column(conn, table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN unless it is there; True when it was added."""
+    if column in {c["name"] for c in inspect(conn).get_columns(table)}:
+        return False
+    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+    print(f"[MIGRATE]: Added {table}.{column}")
+    return True
+
+
+def _cluster_placement_strategy(conn):
+    # NULL uses PLACEMENT_STRATEGY
+    _add_column(conn, "clusters", "placement_strategy", "VARCHAR")
+
+
+def _deployment_organization(conn):
+    # Deployments submitted to an organization; the existing ones belong to their cluster's
+    if _add_column(conn, "deployments", "organization_id", "INTEGER REFERENCES organizations (id)"):
+        count = conn.execute(text(
+            "UPDATE deployments SET organization_id = "
+            "(SELECT clusters.organization_id FROM clusters WHERE clusters.id = deployments.cluster_id) "
+            "WHERE organization_id IS NULL AND cluster_id IS NOT NULL"
+        )).rowcount
+        print(f"[MIGRATE]: Set the organization of {count} deployments")
+
+
+def _deployment_indexes(conn):
+    # Keyset pagination by cluster, and the pending range scan of the reconciliation
+    existing = {index["name"] for index in inspect(conn).get_indexes("deployments")}
+    for index in models.Deployment.__table__.indexes:
+        if index.name not in existing:
+            index.create(conn)
+            print(f"[MIGRATE]: Created index {index.name}")
+
+
+STEPS = [
+    _cluster_placement_strategy,
+    _deployment_organization,
+    _deployment_indexes,
+]
+
+
+def _upgrade(conn):
+    # Nothing to upgrade on a database without the tables, create_schema() makes them current
+    if not {"clusters", "deployments"} <= set(inspect(conn).get_table_names()):
+        return
+    for step in STEPS:
+        step(conn)
+
+
+async def upgrade(engine=None):
+    """Run every step, in one transaction."""
+    async with (engine or database.async_engine).begin() as conn:
+        await conn.run_sync(_upgrade)
+
+
+if __name__ == "__main__":
+    asyncio.run(upgrade())
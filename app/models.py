@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
@@ -41,6 +41,7 @@ class Cluster(Base):
     available_ram = Column(Integer)
     available_cpu = Column(Integer)
     available_gpu = Column(Integer)
+    placement_strategy = Column(String, nullable=True)  # None uses PLACEMENT_STRATEGY
     organization = relationship("Organization", back_populates="clusters")
     deployments = relationship("Deployment", back_populates="cluster")
 
@@ -48,7 +49,9 @@ class Deployment(Base):
     __tablename__ = "deployments"
 
     id = Column(Integer, primary_key=True, index=True)
+    # None until the scheduler places a deployment submitted to its organization only
     cluster_id = Column(Integer, ForeignKey("clusters.id"))
+    organization_id = Column(Integer, ForeignKey("organizations.id"), nullable=True)
     docker_image = Column(String)
     required_ram = Column(Integer)
     required_cpu = Column(Integer)
@@ -56,4 +59,11 @@ class Deployment(Base):
     priority = Column(Integer)
     status = Column(String)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
-    cluster = relationship("Cluster", back_populates="deployments")
\ No newline at end of file
+    cluster = relationship("Cluster", back_populates="deployments")
+
+    __table_args__ = (
+        # Keyset pagination of a cluster's deployments
+        Index("ix_deployments_cluster_created", "cluster_id", "created_at", "id"),
+        # The pending rows in id ranges, for the queue reconciliation
+        Index("ix_deployments_status_id", "status", "id"),
+    )
\ No newline at end of file
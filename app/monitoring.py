@@ -0,0 +1,39 @@
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import metrics, models, queues
+from app.database import get_db
+import redis
+
+router = APIRouter()
+
+RESOURCES = ("ram", "cpu", "gpu")
+
+
+async def collect_gauges(db):
+    """Queue depth and utilization are read at scrape time, so every process reports the shared state."""
+    metrics.cluster_utilization.clear()
+    for row in (await db.execute(select(
+        models.Cluster.id,
+        models.Cluster.total_ram, models.Cluster.total_cpu, models.Cluster.total_gpu,
+        models.Cluster.available_ram, models.Cluster.available_cpu, models.Cluster.available_gpu,
+    ))).all():
+        for resource, total, available in zip(RESOURCES, row[1:4], row[4:7]):
+            metrics.cluster_utilization.labels(row.id, resource).set((total - available) / total if total else 0.0)
+
+    try:
+        sizes = await queues.backend.sizes()
+    except redis.RedisError as e:
+        print(f"[WARNING]: Queue depth left out of /metrics, the queue is unreachable: {e}")
+        return
+    metrics.queue_depth.clear()
+    for cluster_id, size in sizes.items():
+        metrics.queue_depth.labels(cluster_id).set(size)
+
+
+# Unauthenticated like any scrape target, keep it on the internal network
+@router.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics(db: AsyncSession = Depends(get_db)):
+    await collect_gauges(db)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,64 @@
+"""
+Keyset pagination and NDJSON streaming for list endpoints.
+
+Pages are ordered by (created_at, id) and the cursor is the id of the last
+row of the previous page. The cursor row's created_at is looked up by the
+database itself, so the comparison never depends on how a driver formats
+timestamps. The next cursor is sent in the X-Next-Cursor header (and a Link
+header), and the body stays a plain JSON list.
+"""
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import and_, or_, select
+import os
+
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 1000))
+# Rows fetched from the server-side cursor per round trip when streaming
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", 1000))
+
+
+def keyset(query, model, cursor, created_at=True):
+    """Order `query` by (created_at, id), or by id alone, and start after the `cursor` row."""
+    if created_at:
+        query = query.order_by(model.created_at, model.id)
+    else:
+        query = query.order_by(model.id)
+    if cursor is None:
+        return query
+    if not created_at:
+        return query.where(model.id > cursor)
+    cursor_created_at = select(model.created_at).where(model.id == cursor).scalar_subquery()
+    return query.where(or_(
+        model.created_at > cursor_created_at,
+        and_(model.created_at == cursor_created_at, model.id > cursor),
+    ))
+
+
+async def page(db, query, limit, request: Request, response: Response):
+    # One extra row tells whether there is a next page
+    rows = (await db.execute(query.limit(limit + 1))).scalars().all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = str(rows[-1].id)
+        response.headers["X-Next-Cursor"] = cursor
+        response.headers["Link"] = f'<{request.url.include_query_params(cursor=cursor)}>; rel="next"'
+    return rows
+
+
+def ndjson(db, query, schema):
+    """
+    Stream every row of `query` as one JSON document per line, from a
+    server-side cursor so memory does not grow with the result size.
+    """
+    async def lines():
+        # The request's session was already handed back by its dependency; using it
+        # again checks out a fresh connection, which is released when the stream ends
+        try:
+            result = await db.stream(query.execution_options(yield_per=STREAM_BATCH_SIZE))
+            async for rows in result.scalars().partitions():
+                yield "".join(schema.from_orm(row).json() + "\n" for row in rows)
+        finally:
+            await db.close()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
@@ -0,0 +1,245 @@
+"""
+Placement engine used by the scheduler to decide which queued deployments
+of a cluster get resources in a pass.
+
+Every strategy works on one cluster at a time and receives the pending set as
+numpy arrays: `demands` (n x 3 of ram, cpu, gpu), `priorities` (n, lower value
+is scheduled first, same as the queue score), plus the cluster's `available`
+and `total` resources. Fit checks are vectorized over the whole pending set.
+"""
+from dataclasses import dataclass
+import os
+
+import numpy as np
+
+DEFAULT_STRATEGY = os.getenv("PLACEMENT_STRATEGY", "first_fit")
+
+
+@dataclass
+class PackingReport:
+    strategy: str
+    candidates: int
+    placed: int
+    utilization: tuple  # (ram, cpu, gpu) allocated / total after the pass
+
+    @property
+    def efficiency(self):
+        # Mean utilization over the resource dimensions the cluster actually has
+        used = [u for u in self.utilization if u is not None]
+        return sum(used) / len(used) if used else 0.0
+
+    @property
+    def placed_ratio(self):
+        return self.placed / self.candidates if self.candidates else 1.0
+
+
+def _normalized(demands, total):
+    return demands / np.where(total > 0, total, 1)
+
+
+def greedy_fit(demands, order, available):
+    """
+    Walk `order` and take every deployment that still fits, like a plain
+    first-fit loop, but a whole run of fitting deployments at a time.
+
+    Returns the selected indices (in walk order) and the remaining resources.
+    """
+    remaining = np.asarray(available, dtype=np.int64).copy()
+    idx = np.asarray(order, dtype=np.intp)
+    chosen = []
+    while idx.size:
+        # Capacity only shrinks during a pass, so anything that doesn't fit now never will
+        idx = idx[(demands[idx] <= remaining).all(axis=1)]
+        if not idx.size:
+            break
+        prefix = np.cumsum(demands[idx], axis=0)
+        fits = (prefix <= remaining).all(axis=1)
+        k = idx.size if fits.all() else int(np.argmin(fits))
+        chosen.append(idx[:k])
+        remaining -= prefix[k - 1]
+        idx = idx[k:]
+    selected = np.concatenate(chosen) if chosen else np.empty(0, dtype=np.intp)
+    return selected, remaining
+
+
+class PlacementStrategy:
+    name = None
+
+    def select(self, demands, priorities, available, total):
+        """Return (selected indices, remaining resources)."""
+        raise NotImplementedError
+
+    def place(self, demands, priorities, available, total):
+        demands = np.asarray(demands, dtype=np.int64).reshape(-1, 3)
+        priorities = np.asarray(priorities)
+        available = np.asarray(available, dtype=np.int64)
+        total = np.asarray(total, dtype=np.int64)
+        if len(demands):
+            selected, remaining = self.select(demands, priorities, available, total)
+        else:
+            selected, remaining = np.empty(0, dtype=np.intp), available.copy()
+        allocated = total - remaining
+        utilization = tuple(
+            float(allocated[i] / total[i]) if total[i] > 0 else None for i in range(3)
+        )
+        report = PackingReport(self.name, len(demands), len(selected), utilization)
+        return selected, remaining, report
+
+
+class FirstFit(PlacementStrategy):
+    """Queue order, take whatever fits. The scheduler's original behaviour."""
+    name = "first_fit"
+
+    def select(self, demands, priorities, available, total):
+        return greedy_fit(demands, np.argsort(priorities, kind="stable"), available)
+
+
+class StrictPriority(PlacementStrategy):
+    """
+    Priority tiers in order, and a lower tier only gets resources once every
+    deployment of the tiers above it has been placed.
+    """
+    name = "strict_priority"
+
+    def select(self, demands, priorities, available, total):
+        remaining = available
+        chosen = []
+        for tier in np.unique(priorities):
+            members = np.flatnonzero(priorities == tier)
+            selected, remaining = greedy_fit(demands, members, remaining)
+            chosen.append(selected)
+            if len(selected) < len(members):
+                break
+        return np.concatenate(chosen), remaining
+
+
+class BestFitDecreasing(PlacementStrategy):
+    """Inside each priority tier, the largest deployments (relative to the cluster) go first."""
+    name = "best_fit_decreasing"
+
+    def select(self, demands, priorities, available, total):
+        size = _normalized(demands, total).sum(axis=1)
+        return greedy_fit(demands, np.lexsort((-size, priorities)), available)
+
+
+class DominantResource(PlacementStrategy):
+    """
+    Inside each priority tier, the smallest dominant share goes first, which
+    places the largest number of deployments on the scarcest resource.
+    """
+    name = "dominant_resource"
+
+    def select(self, demands, priorities, available, total):
+        dominant = _normalized(demands, total).max(axis=1)
+        return greedy_fit(demands, np.lexsort((dominant, priorities)), available)
+
+
+class PriorityKnapsack(PlacementStrategy):
+    """
+    Priority tiers in order, each tier solved as a multi-dimensional knapsack
+    over the capacity left by the tiers above, maximizing allocated resources.
+    The knapsack is approximated by keeping the best of a few greedy orderings.
+    """
+    name = "priority_knapsack"
+
+    def select(self, demands, priorities, available, total):
+        value = _normalized(demands, total)
+        remaining = available
+        chosen = []
+        for tier in np.unique(priorities):
+            members = np.flatnonzero(priorities == tier)
+            size = value[members].sum(axis=1)
+            density = size / np.maximum(value[members].max(axis=1), 1e-9)
+            best = None
+            for order in (
+                members[np.argsort(-size, kind="stable")],
+                members[np.argsort(-density, kind="stable")],
+                members[np.argsort(value[members].max(axis=1), kind="stable")],
+            ):
+                selected, left = greedy_fit(demands, order, remaining)
+                score = (value[selected].sum(), len(selected))
+                if best is None or score > best[0]:
+                    best = (score, selected, left)
+            chosen.append(best[1])
+            remaining = best[2]
+        return np.concatenate(chosen), remaining
+
+
+STRATEGIES = {
+    strategy.name: strategy
+    for strategy in (FirstFit(), StrictPriority(), BestFitDecreasing(), DominantResource(), PriorityKnapsack())
+}
+
+
+def get_strategy(name=None):
+    """Strategy by name, falling back to PLACEMENT_STRATEGY (first_fit by default)."""
+    name = name or DEFAULT_STRATEGY
+    if name not in STRATEGIES:
+        raise ValueError(f"Unknown placement strategy {name!r}, expected one of {sorted(STRATEGIES)}")
+    return STRATEGIES[name]
+
+
+def find_victims(demand, available, running, running_priorities, priority):
+    """
+    Running deployments to evict so that `demand` fits next to `available`.
+
+    Only deployments of a lower priority (a larger value) than `priority` are
+    candidates, the least important ones first and, inside a tier, the ones
+    covering most of the shortfall. No victim in the returned set could be
+    spared. Returns indices into `running`, or None when evicting every
+    candidate still isn't enough.
+    """
+    running = np.asarray(running, dtype=np.int64).reshape(-1, 3)
+    running_priorities = np.asarray(running_priorities)
+    shortfall = np.maximum(np.asarray(demand, dtype=np.int64) - available, 0)
+    if not shortfall.any():
+        return np.empty(0, dtype=np.intp)
+
+    candidates = np.flatnonzero(running_priorities > priority)
+    if not candidates.size:
+        return None
+    coverage = (np.minimum(running[candidates], shortfall) / np.where(shortfall > 0, shortfall, 1)).sum(axis=1)
+    order = candidates[np.lexsort((-coverage, -running_priorities[candidates]))]
+    freed = np.cumsum(running[order], axis=0)
+    enough = np.flatnonzero((freed >= shortfall).all(axis=1))
+    if not enough.size:
+        return None
+
+    # The greedy prefix can pick up victims a later, bigger one made unnecessary;
+    # give them back, the most important first
+    chosen = order[:enough[0] + 1]
+    surplus = freed[enough[0]] - shortfall
+    keep = np.ones(len(chosen), dtype=bool)
+    for i in np.argsort(running_priorities[chosen], kind="stable"):
+        if (running[chosen[i]] <= surplus).all():
+            surplus -= running[chosen[i]]
+            keep[i] = False
+    return chosen[keep]
+
+
+def plan_preemption(waiting, waiting_priorities, available, running, running_priorities, limit=None):
+    """
+    Place `waiting` deployments (demands, in queue order) that don't fit by
+    evicting lower-priority `running` ones, as find_victims() does for each.
+
+    Returns (indices of waiting deployments to place, indices of running
+    deployments to evict, remaining resources).
+    """
+    waiting = np.asarray(waiting, dtype=np.int64).reshape(-1, 3)
+    running = np.asarray(running, dtype=np.int64).reshape(-1, 3)
+    running_priorities = np.asarray(running_priorities)
+    remaining = np.asarray(available, dtype=np.int64).copy()
+    alive = np.ones(len(running), dtype=bool)
+    placed, evicted = [], []
+    for i in range(len(waiting) if limit is None else min(limit, len(waiting))):
+        index = np.flatnonzero(alive)
+        victims = find_victims(waiting[i], remaining, running[index], running_priorities[index], waiting_priorities[i])
+        if victims is None or not victims.size:
+            # Not placeable, or placeable without evictions, which is up to the placement strategy
+            continue
+        victims = index[victims]
+        alive[victims] = False
+        remaining += running[victims].sum(axis=0) - waiting[i]
+        placed.append(i)
+        evicted.extend(victims.tolist())
+    return placed, evicted, remaining
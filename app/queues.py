@@ -0,0 +1,390 @@
+"""
+Deployment queue backends.
+
+Pending deployments wait in one priority queue per cluster, lowest score
+first. The Redis backend keeps them in sorted sets on the process-wide
+connection pool and is shared by every API replica and scheduler. The
+in-memory backend is a heap per cluster, for a single process and for tests.
+Both also keep the dirty set: the clusters that got submissions or freed
+capacity since the scheduler last took it, see schedule_changed().
+Deployments submitted without a cluster wait in `backend.auto`, a queue of
+the same kind with one shard per organization, until the scheduler finds
+them a cluster (see app/capacity.py).
+QUEUE_BACKEND picks one at import (`redis`, the default, or `memory`);
+callers always go through the module attribute `queues.backend`.
+"""
+from abc import ABC, abstractmethod
+from app import database
+import asyncio
+import heapq
+import os
+
+QUEUE_BACKEND = os.getenv("QUEUE_BACKEND", "redis")
+
+# One sorted set per cluster, plus the set of clusters that have one
+QUEUE_KEY = "deployment_queue"
+SHARDS_KEY = "deployment_queue:clusters"
+# Clusters whose pending set or capacity changed since a scheduler last looked at them
+DIRTY_KEY = "deployment_queue:dirty"
+# Per organization, deployments waiting for the scheduler to pick their cluster
+AUTO_QUEUE_KEY = "deployment_queue:auto"
+WAKEUP_CHANNEL = "scheduler_wakeup"
+# Published on WAKEUP_CHANNEL instead of a cluster id for the organization queues
+AUTO_WAKEUP = "auto"
+# Max members per ZADD/ZREM command
+CHUNK_SIZE = int(os.getenv("QUEUE_CHUNK_SIZE", 10000))
+
+
+def queue_key(cluster_id):
+    return f"{QUEUE_KEY}:{cluster_id}"
+
+
+class QueueBackend(ABC):
+    # Whether other processes see this queue and announce their submissions
+    shared = False
+
+    @property
+    @abstractmethod
+    def auto(self):
+        """The queue of the deployments without a cluster, its shard ids are organization ids."""
+
+    @abstractmethod
+    async def enqueue(self, entries):
+        """Add or rescore deployments, `entries` is {cluster_id: {deployment_id: score}}."""
+
+    @abstractmethod
+    async def peek(self, cluster_id, limit=None):
+        """Up to `limit` (deployment_id, score) pairs of a cluster, lowest score first, left queued."""
+
+    @abstractmethod
+    async def dequeue_batch(self, cluster_id, limit=None):
+        """Like peek(), but the returned entries are removed."""
+
+    @abstractmethod
+    async def remove(self, cluster_id, deployment_ids):
+        pass
+
+    @abstractmethod
+    async def size(self, cluster_id):
+        pass
+
+    @abstractmethod
+    async def clusters(self):
+        """Ids of the clusters with queued deployments, ascending."""
+
+    async def sizes(self):
+        """{cluster_id: queued deployments} of the clusters with queued deployments."""
+        return {cluster_id: await self.size(cluster_id) for cluster_id in await self.clusters()}
+
+    async def count(self, cluster_ids):
+        """Deployments queued over these clusters."""
+        return sum([await self.size(cluster_id) for cluster_id in cluster_ids])
+
+    @abstractmethod
+    async def scores(self, entries):
+        """{cluster_id: [score or None per deployment id]} for `entries`, {cluster_id: [deployment_id]}."""
+
+    @abstractmethod
+    async def scan(self, cluster_id, count=CHUNK_SIZE):
+        """Yields the queued deployment ids of a cluster in lists of about `count`, in no order."""
+        yield
+
+    @abstractmethod
+    async def mark_dirty(self, cluster_ids):
+        """Have the next incremental pass look at these clusters again."""
+
+    @abstractmethod
+    async def take_dirty(self):
+        """The set of dirty cluster ids, cleared."""
+
+    async def drain_legacy(self):
+        """{deployment_id: score} left over from an unsharded queue, removed from it."""
+        return {}
+
+    async def wake(self, cluster_ids):
+        """Mark these clusters dirty and tell the schedulers in other processes."""
+        await self.mark_dirty(cluster_ids)
+
+    async def wakeups(self):
+        """
+        Yields the cluster id of each wake-up from another process, None for
+        all clusters and AUTO_WAKEUP for submissions to the organization queues.
+        A backend that isn't shared has no other process to hear from: it
+        waits forever without yielding, its wake-ups are all local.
+        """
+        await asyncio.Event().wait()
+        yield
+
+
+class RedisQueue(QueueBackend):
+    shared = True
+
+    def __init__(self, client=None, prefix=QUEUE_KEY, wakeup=None):
+        # None is the process-wide client, only created on the first command
+        self._client = client
+        self.prefix = prefix
+        self.shards_key = f"{prefix}:clusters"
+        self.dirty_key = f"{prefix}:dirty"
+        # Published on submissions, None publishes the cluster ids
+        self.wakeup = wakeup
+        self._auto = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = database.redis_client
+        return self._client
+
+    @property
+    def auto(self):
+        if self._auto is None:
+            self._auto = RedisQueue(self._client, AUTO_QUEUE_KEY, AUTO_WAKEUP)
+        return self._auto
+
+    def key(self, shard_id):
+        return f"{self.prefix}:{shard_id}"
+
+    def _publish(self, pipe, cluster_ids):
+        if self.wakeup is not None:
+            pipe.publish(WAKEUP_CHANNEL, self.wakeup)
+            return
+        for cluster_id in cluster_ids:
+            pipe.publish(WAKEUP_CHANNEL, cluster_id)
+
+    async def enqueue(self, entries):
+        # Every shard, the shard index, the dirty set and the wake-ups in one round trip
+        entries = {cluster_id: scores for cluster_id, scores in entries.items() if scores}
+        if not entries:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for cluster_id, scores in entries.items():
+            items = list(scores.items())
+            for i in range(0, len(items), CHUNK_SIZE):
+                pipe.zadd(self.key(cluster_id), dict(items[i:i + CHUNK_SIZE]))
+        pipe.sadd(self.shards_key, *entries)
+        pipe.sadd(self.dirty_key, *entries)
+        self._publish(pipe, entries)
+        await pipe.execute()
+
+    async def peek(self, cluster_id, limit=None):
+        if limit is not None and limit <= 0:
+            return []
+        end = -1 if limit is None else limit - 1
+        queued = await self.client.zrange(self.key(cluster_id), 0, end, withscores=True)
+        return [(int(member), score) for member, score in queued]
+
+    async def dequeue_batch(self, cluster_id, limit=None):
+        if limit is None:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.zrange(self.key(cluster_id), 0, -1, withscores=True)
+            pipe.delete(self.key(cluster_id))
+            queued, _ = await pipe.execute()
+        elif limit > 0:
+            queued = await self.client.zpopmin(self.key(cluster_id), limit)
+        else:
+            queued = []
+        return [(int(member), score) for member, score in queued]
+
+    async def remove(self, cluster_id, deployment_ids):
+        deployment_ids = list(deployment_ids)
+        if not deployment_ids:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        for i in range(0, len(deployment_ids), CHUNK_SIZE):
+            pipe.zrem(self.key(cluster_id), *deployment_ids[i:i + CHUNK_SIZE])
+        await pipe.execute()
+
+    async def size(self, cluster_id):
+        return await self.client.zcard(self.key(cluster_id))
+
+    async def clusters(self):
+        return list(await self.sizes())
+
+    async def sizes(self):
+        cluster_ids = sorted(int(member) for member in await self.client.smembers(self.shards_key))
+        pipe = self.client.pipeline(transaction=False)
+        for cluster_id in cluster_ids:
+            pipe.zcard(self.key(cluster_id))
+        return {cluster_id: size for cluster_id, size in zip(cluster_ids, await pipe.execute()) if size}
+
+    async def count(self, cluster_ids):
+        pipe = self.client.pipeline(transaction=False)
+        for cluster_id in cluster_ids:
+            pipe.zcard(self.key(cluster_id))
+        return sum(await pipe.execute())
+
+    async def scores(self, entries):
+        # ZMSCORE per shard and chunk, all in one round trip
+        pipe = self.client.pipeline(transaction=False)
+        for cluster_id, deployment_ids in entries.items():
+            for i in range(0, len(deployment_ids), CHUNK_SIZE):
+                pipe.zmscore(self.key(cluster_id), deployment_ids[i:i + CHUNK_SIZE])
+        replies = iter(await pipe.execute())
+        return {
+            cluster_id: [score for i in range(0, len(deployment_ids), CHUNK_SIZE) for score in next(replies)]
+            for cluster_id, deployment_ids in entries.items()
+        }
+
+    async def scan(self, cluster_id, count=CHUNK_SIZE):
+        # ZSCAN returns every member present for the whole scan, removals along the way are fine
+        cursor = 0
+        while True:
+            cursor, queued = await self.client.zscan(self.key(cluster_id), cursor, count=count)
+            if queued:
+                yield [int(member) for member, _ in queued]
+            if not cursor:
+                return
+
+    async def drain_legacy(self):
+        # Entries of the old single deployment_queue, from before the per-cluster shards
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zrange(QUEUE_KEY, 0, -1, withscores=True)
+        pipe.delete(QUEUE_KEY)
+        queued, _ = await pipe.execute()
+        return {int(member): score for member, score in queued}
+
+    async def mark_dirty(self, cluster_ids):
+        cluster_ids = list(cluster_ids)
+        if cluster_ids:
+            await self.client.sadd(self.dirty_key, *cluster_ids)
+
+    async def take_dirty(self):
+        pipe = self.client.pipeline(transaction=True)
+        pipe.smembers(self.dirty_key)
+        pipe.delete(self.dirty_key)
+        dirty, _ = await pipe.execute()
+        return {int(member) for member in dirty}
+
+    async def wake(self, cluster_ids):
+        cluster_ids = list(cluster_ids)
+        if not cluster_ids:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        pipe.sadd(self.dirty_key, *cluster_ids)
+        self._publish(pipe, cluster_ids)
+        await pipe.execute()
+
+    async def wakeups(self):
+        async with self.client.pubsub(ignore_subscribe_messages=True) as pubsub:
+            await pubsub.subscribe(WAKEUP_CHANNEL)
+            async for message in pubsub.listen():
+                data = message["data"]
+                if isinstance(data, bytes):
+                    data = data.decode()
+                if data == AUTO_WAKEUP:
+                    yield AUTO_WAKEUP
+                    continue
+                try:
+                    yield int(data)
+                except ValueError:
+                    yield None
+
+
+class MemoryQueue(QueueBackend):
+    """
+    A heap per cluster with lazy deletion: each queued deployment maps to its
+    current heap entry, entries that are not current are skipped. Ties are
+    broken on the id as a string, like Redis orders equal scores.
+    Only touched from the event loop, no locking.
+    """
+
+    def __init__(self):
+        self._heaps = {}
+        self._entries = {}
+        self._dirty = set()
+        self._auto = None
+
+    @property
+    def auto(self):
+        if self._auto is None:
+            self._auto = MemoryQueue()
+        return self._auto
+
+    def _live(self, cluster_id, entry):
+        return self._entries[cluster_id].get(entry[2]) is entry
+
+    async def enqueue(self, entries):
+        for cluster_id, scores in entries.items():
+            if scores:
+                self._dirty.add(cluster_id)
+            heap = self._heaps.setdefault(cluster_id, [])
+            live = self._entries.setdefault(cluster_id, {})
+            for deployment_id, score in scores.items():
+                deployment_id, score = int(deployment_id), float(score)
+                current = live.get(deployment_id)
+                if current is not None and current[0] == score:
+                    continue
+                live[deployment_id] = entry = (score, str(deployment_id), deployment_id)
+                heapq.heappush(heap, entry)
+            self._compact(cluster_id)
+
+    async def peek(self, cluster_id, limit=None):
+        heap = self._heaps.get(cluster_id, [])
+        live = (entry for entry in heap if self._live(cluster_id, entry))
+        entries = sorted(live) if limit is None else heapq.nsmallest(limit, live)
+        return [(deployment_id, score) for score, _, deployment_id in entries]
+
+    async def dequeue_batch(self, cluster_id, limit=None):
+        heap = self._heaps.get(cluster_id, [])
+        live = self._entries.get(cluster_id, {})
+        taken = []
+        while heap and (limit is None or len(taken) < limit):
+            score, _, deployment_id = entry = heapq.heappop(heap)
+            if self._live(cluster_id, entry):
+                del live[deployment_id]
+                taken.append((deployment_id, score))
+        return taken
+
+    async def remove(self, cluster_id, deployment_ids):
+        live = self._entries.get(cluster_id)
+        if live is None:
+            return
+        for deployment_id in deployment_ids:
+            live.pop(int(deployment_id), None)
+        self._compact(cluster_id)
+
+    async def size(self, cluster_id):
+        return len(self._entries.get(cluster_id, ()))
+
+    async def clusters(self):
+        return sorted(cluster_id for cluster_id, live in self._entries.items() if live)
+
+    async def sizes(self):
+        return {cluster_id: len(self._entries[cluster_id]) for cluster_id in await self.clusters()}
+
+    async def scores(self, entries):
+        result = {}
+        for cluster_id, deployment_ids in entries.items():
+            live = self._entries.get(cluster_id, {})
+            result[cluster_id] = [live[i][0] if i in live else None for i in deployment_ids]
+        return result
+
+    async def scan(self, cluster_id, count=CHUNK_SIZE):
+        queued = list(self._entries.get(cluster_id, ()))
+        for i in range(0, len(queued), count):
+            yield queued[i:i + count]
+
+    async def mark_dirty(self, cluster_ids):
+        self._dirty.update(cluster_ids)
+
+    async def take_dirty(self):
+        dirty, self._dirty = self._dirty, set()
+        return dirty
+
+    def _compact(self, cluster_id):
+        # Rebuild once dead entries outnumber live ones, keeps the heap O(queued)
+        heap = self._heaps[cluster_id]
+        if len(heap) > 2 * len(self._entries[cluster_id]) + 64:
+            heap[:] = [entry for entry in heap if self._live(cluster_id, entry)]
+            heapq.heapify(heap)
+
+
+def create_backend(name=QUEUE_BACKEND):
+    if name == "redis":
+        return RedisQueue()
+    if name == "memory":
+        return MemoryQueue()
+    raise ValueError(f"Unknown QUEUE_BACKEND {name!r}, expected 'redis' or 'memory'")
+
+
+backend = create_backend()
@@ -0,0 +1,146 @@
+"""
+Reconciliation of the deployment queues with the database.
+
+The database is the source of truth: a deployment is queued exactly when it
+is pending, on its cluster's queue, or on its organization's queue while it
+has no cluster, scored with its priority. The queue can drift from it: a
+process dying between a commit and the queue write that follows it, or a
+Redis flush, leaves pending deployments that no pass will ever look at, or
+entries of deployments that are long done.
+
+reconcile() repairs both directions without loading either side whole:
+
+- The pending rows are read in id ranges of RECONCILE_BATCH_SIZE (an index
+  range scan on (status, id)), and each range is checked against the queues
+  with one pipelined ZMSCORE round trip. Missing entries are added back and
+  wrong scores fixed, in one pipelined write.
+- Every queue is walked with ZSCAN, and each chunk of ids is checked against
+  the database in one query. Entries of deployments that are not pending, or
+  not on that queue, are removed.
+
+It only ever adds entries for pending deployments and removes entries of
+deployments that aren't, and a scheduling pass re-checks every entry's status
+anyway, so it is safe to run next to live traffic and other schedulers. It
+runs when the scheduler starts and through POST /scheduler/reconcile.
+"""
+from sqlalchemy import select
+from app import database, metrics, models, queues
+import os
+import time
+
+# Pending rows read, and queued ids checked, per round trip
+RECONCILE_BATCH_SIZE = int(os.getenv("RECONCILE_BATCH_SIZE", 10000))
+
+
+def _queue(row):
+    """The backend and shard a pending row belongs to."""
+    if row.cluster_id is None:
+        return queues.backend.auto, row.organization_id
+    return queues.backend, row.cluster_id
+
+
+async def _requeue_missing(db, report):
+    last_id = 0
+    while True:
+        rows = (await db.execute(
+            select(models.Deployment.id, models.Deployment.cluster_id, models.Deployment.organization_id,
+                   models.Deployment.priority)
+            .where(models.Deployment.status == "pending", models.Deployment.id > last_id)
+            .order_by(models.Deployment.id)
+            .limit(RECONCILE_BATCH_SIZE)
+        )).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        report["pending"] += len(rows)
+        # No read transaction held between batches, sqlite writers would wait for it
+        await db.commit()
+
+        expected = {}
+        for row in rows:
+            backend, shard = _queue(row)
+            expected.setdefault(backend, {}).setdefault(shard, {})[row.id] = float(row.priority)
+        for backend, shards in expected.items():
+            found = await backend.scores({shard: list(scores) for shard, scores in shards.items()})
+            repairs = {}
+            for shard, scores in shards.items():
+                for (deployment_id, score), queued in zip(scores.items(), found[shard]):
+                    if queued != score:
+                        repairs.setdefault(shard, {})[deployment_id] = score
+                        report["requeued" if queued is None else "rescored"] += 1
+            if repairs:
+                # Marks the shards dirty and wakes the schedulers
+                await backend.enqueue(repairs)
+                report["clusters" if backend is queues.backend else "organizations"].update(repairs)
+
+
+async def _remove_orphans(db, backend, report):
+    # Chunks of several queues are checked together, small queues don't cost a query each
+    batch, size = [], 0
+    for shard in await backend.clusters():
+        async for deployment_ids in backend.scan(shard, RECONCILE_BATCH_SIZE):
+            batch.append((shard, deployment_ids))
+            size += len(deployment_ids)
+            if size >= RECONCILE_BATCH_SIZE:
+                await _check_queued(db, backend, batch, report)
+                batch, size = [], 0
+    if batch:
+        await _check_queued(db, backend, batch, report)
+
+
+async def _pending(db, deployment_ids):
+    rows = (await db.execute(
+        select(models.Deployment.id, models.Deployment.cluster_id, models.Deployment.organization_id,
+               models.Deployment.priority)
+        .where(models.Deployment.id.in_(deployment_ids), models.Deployment.status == "pending")
+    )).all()
+    await db.commit()
+    return {row.id: row for row in rows}
+
+
+async def _check_queued(db, backend, batch, report):
+    pending = await _pending(db, [deployment_id for _, deployment_ids in batch for deployment_id in deployment_ids])
+    orphans = {}
+    for shard, deployment_ids in batch:
+        for deployment_id in deployment_ids:
+            row = pending.get(deployment_id)
+            if row is None or _queue(row) != (backend, shard):
+                orphans.setdefault(shard, []).append(deployment_id)
+    if not orphans:
+        return
+    for shard, deployment_ids in orphans.items():
+        await backend.remove(shard, deployment_ids)
+    # One that became pending again meanwhile (an eviction) was re-enqueued before or after
+    # our removal; the one re-enqueued before it is put back
+    pending = await _pending(db, [deployment_id for deployment_ids in orphans.values() for deployment_id in deployment_ids])
+    back = {}
+    for shard, deployment_ids in orphans.items():
+        for deployment_id in deployment_ids:
+            row = pending.get(deployment_id)
+            if row is not None and _queue(row) == (backend, shard):
+                back.setdefault(shard, {})[deployment_id] = row.priority
+    if back:
+        await backend.enqueue(back)
+    report["removed"] += sum(map(len, orphans.values())) - sum(map(len, back.values()))
+
+
+async def reconcile():
+    """
+    Make the queues match the pending deployments in the database. Returns
+    counts of what was checked and repaired, and the clusters and
+    organizations that got deployments back, for the scheduler to look at.
+    """
+    start = time.perf_counter()
+    report = {"pending": 0, "requeued": 0, "rescored": 0, "removed": 0, "clusters": set(), "organizations": set()}
+    async with database.AsyncSessionLocal() as db:
+        await _requeue_missing(db, report)
+        await _remove_orphans(db, queues.backend, report)
+        await _remove_orphans(db, queues.backend.auto, report)
+    for action in ("requeued", "rescored", "removed"):
+        metrics.record_reconciled(action, report[action])
+    report["seconds"] = time.perf_counter() - start
+    report["clusters"] = sorted(report["clusters"])
+    report["organizations"] = sorted(report["organizations"])
+    print(f"[SUCCESS]: Reconciled {report['pending']} pending deployments with the queue in {report['seconds']:.2f}s: "
+          f"{report['requeued']} requeued, {report['rescored']} rescored, {report['removed']} removed")
+    return report
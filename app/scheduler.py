@@ -1,66 +1,452 @@
 from fastapi import Depends, APIRouter
-from sqlalchemy.orm import Session, sessionmaker
-from app import models
-from app.database import engine
+from sqlalchemy import select, update
+from app import capacity, database, events, metrics, models, queues, reconcile
+from app.placement import get_strategy, plan_preemption
+from app.queues import WAKEUP_CHANNEL
+import numpy as np
 import redis
-from app.auth import get_current_user
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from apscheduler.schedulers.background import BackgroundScheduler
-from dotenv import load_dotenv
+from app.auth import get_admin_user, get_current_user
+from datetime import datetime, timezone
+import asyncio
 import os
+import random
+import time
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 router = APIRouter()
 
-SCHEDULER_INTERVAL = int(os.getenv("SCHEDULER_INTERVAL", 60)) 
+# How often the clusters marked dirty but missed by the wake-ups are scheduled
+SCHEDULER_INTERVAL = int(os.getenv("SCHEDULER_INTERVAL", 60))
+# How often every cluster with queued deployments is re-evaluated, dirty or not
+SCHEDULER_FULL_SWEEP_INTERVAL = int(os.getenv("SCHEDULER_FULL_SWEEP_INTERVAL", 3600))
+# How long a wake-up waits for more submissions before running, so a burst becomes one pass
+SCHEDULER_COALESCE_MS = int(os.getenv("SCHEDULER_COALESCE_MS", 10))
 
-# Redis connection
-redis_client = redis.Redis(host='localhost', port=6379, db=0)
-async def schedule_deployments():
-    db = SessionLocal()  # Create a session manually
+# Max ids per IN (...) clause, keeps us under the bind parameter limits of sqlite/postgres
+ID_CHUNK_SIZE = int(os.getenv("SCHEDULER_ID_CHUNK_SIZE", 10000))
+# How many cluster shards are scheduled at the same time
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", 8))
+# Placements recomputed for one cluster in a pass when another replica changed it first
+SCHEDULER_CLAIM_RETRIES = int(os.getenv("SCHEDULER_CLAIM_RETRIES", 3))
+# Let waiting deployments evict lower-priority running ones when their cluster is full
+SCHEDULER_PREEMPTION = os.getenv("SCHEDULER_PREEMPTION", "0") == "1"
+# Waiting deployments considered for preemption per cluster and pass, highest priority first
+SCHEDULER_PREEMPTION_LIMIT = int(os.getenv("SCHEDULER_PREEMPTION_LIMIT", 100))
+# Repair the queues from the database when the scheduler starts, see app/reconcile.py
+SCHEDULER_RECONCILE_ON_START = os.getenv("SCHEDULER_RECONCILE_ON_START", "1") == "1"
+# Clusters a deployment submitted to its organization is offered per pass, one after the other
+SCHEDULER_AUTO_ROUNDS = int(os.getenv("SCHEDULER_AUTO_ROUNDS", 3))
+
+
+async def _load_queued(db, cluster_id, deployment_ids, org_id=None):
+    # Offered ones (org_id given) are still waiting in their organization's queue, without a cluster
+    if org_id is None:
+        on_queue = models.Deployment.cluster_id == cluster_id
+    else:
+        on_queue = (models.Deployment.cluster_id.is_(None)) & (models.Deployment.organization_id == org_id)
+    rows = []
+    for i in range(0, len(deployment_ids), ID_CHUNK_SIZE):
+        chunk = deployment_ids[i:i + ID_CHUNK_SIZE]
+        rows.extend((await db.execute(
+            select(
+                models.Deployment.id,
+                models.Deployment.required_ram,
+                models.Deployment.required_cpu,
+                models.Deployment.required_gpu,
+                models.Deployment.status,
+                models.Deployment.created_at,
+            )
+            .where(models.Deployment.id.in_(chunk), on_queue)
+        )).all())
+    return rows
+
+
+async def _load_cluster(db, cluster_id):
+    # Locks the row for the rest of the transaction where the database supports it (not sqlite);
+    # a cluster already being scheduled by another replica is skipped rather than waited for
+    return (await db.execute(
+        select(
+            models.Cluster.available_ram,
+            models.Cluster.available_cpu,
+            models.Cluster.available_gpu,
+            models.Cluster.total_ram,
+            models.Cluster.total_cpu,
+            models.Cluster.total_gpu,
+            models.Cluster.placement_strategy,
+            models.Cluster.organization_id,
+        ).where(models.Cluster.id == cluster_id).with_for_update(skip_locked=True)
+    )).first()
+
+
+async def _load_unplaced(db, org_id, deployment_ids):
+    rows = []
+    for i in range(0, len(deployment_ids), ID_CHUNK_SIZE):
+        chunk = deployment_ids[i:i + ID_CHUNK_SIZE]
+        rows.extend((await db.execute(
+            select(
+                models.Deployment.id,
+                models.Deployment.required_ram,
+                models.Deployment.required_cpu,
+                models.Deployment.required_gpu,
+                models.Deployment.status,
+                models.Deployment.cluster_id,
+            )
+            .where(models.Deployment.id.in_(chunk), models.Deployment.organization_id == org_id)
+        )).all())
+    return rows
+
+
+async def _load_running(db, cluster_id):
+    return (await db.execute(
+        select(
+            models.Deployment.id,
+            models.Deployment.required_ram,
+            models.Deployment.required_cpu,
+            models.Deployment.required_gpu,
+            models.Deployment.priority,
+        ).where(models.Deployment.cluster_id == cluster_id, models.Deployment.status == "running")
+    )).all()
+
+
+async def _claim(db, cluster_id, placed, used, evicted=(), assigned=()):
+    """
+    Commit the placement only if nothing changed underneath it: every placed
+    deployment is still pending, every evicted one still running, every
+    assigned one (offered from its organization's queue) still without a
+    cluster and the cluster still has the capacity. The checks are conditions
+    of the UPDATEs themselves, so they hold across replicas on any database,
+    with or without row locks.
+    """
+    for i in range(0, len(evicted), ID_CHUNK_SIZE):
+        chunk = evicted[i:i + ID_CHUNK_SIZE]
+        if (await db.execute(
+            update(models.Deployment)
+            .where(models.Deployment.id.in_(chunk), models.Deployment.status == "running")
+            .values(status="pending")
+        )).rowcount != len(chunk):
+            return False
+    claimed = 0
+    for i in range(0, len(placed), ID_CHUNK_SIZE):
+        chunk = placed[i:i + ID_CHUNK_SIZE]
+        claimed += (await db.execute(
+            update(models.Deployment)
+            .where(models.Deployment.id.in_(chunk), models.Deployment.status == "pending")
+            .values(status="running")
+        )).rowcount
+    if claimed != len(placed):
+        return False
+    claimed = 0
+    for i in range(0, len(assigned), ID_CHUNK_SIZE):
+        chunk = assigned[i:i + ID_CHUNK_SIZE]
+        claimed += (await db.execute(
+            update(models.Deployment)
+            .where(models.Deployment.id.in_(chunk), models.Deployment.status == "pending",
+                   models.Deployment.cluster_id.is_(None))
+            .values(status="running", cluster_id=cluster_id)
+        )).rowcount
+    if claimed != len(assigned):
+        return False
+    ram, cpu, gpu = used
+    return (await db.execute(
+        update(models.Cluster)
+        .where(
+            models.Cluster.id == cluster_id,
+            models.Cluster.available_ram >= ram,
+            models.Cluster.available_cpu >= cpu,
+            models.Cluster.available_gpu >= gpu,
+        )
+        .values(
+            available_ram=models.Cluster.available_ram - ram,
+            available_cpu=models.Cluster.available_cpu - cpu,
+            available_gpu=models.Cluster.available_gpu - gpu,
+        )
+    )).rowcount == 1
+
+
+# Set once the old single queue was drained by this process
+_legacy_drained = False
+
+
+async def _shard_legacy_queue():
+    # Entries left in the old single deployment_queue are moved to their cluster's shard,
+    # once per process: nothing writes that key any more
+    global _legacy_drained
+    if _legacy_drained:
+        return
+    scores = await queues.backend.drain_legacy()
+    _legacy_drained = True
+    if not scores:
+        return
+    ids = list(scores)
+    entries = {}
+    async with database.AsyncSessionLocal() as db:
+        for i in range(0, len(ids), ID_CHUNK_SIZE):
+            for deployment_id, cluster_id in (await db.execute(
+                select(models.Deployment.id, models.Deployment.cluster_id)
+                .where(models.Deployment.id.in_(ids[i:i + ID_CHUNK_SIZE]))
+            )).all():
+                entries.setdefault(cluster_id, {})[deployment_id] = scores[deployment_id]
+    await queues.backend.enqueue(entries)
+
+
+_pass_lock = asyncio.Lock()
+_wakeup = None
+_loop = None
+# Clusters woken up since the last pass, None in the set asks for every cluster
+_woken = set()
+
+
+async def schedule_deployments(cluster_ids=None, org_ids=()):
+    """
+    A pass over every cluster with queued deployments, or only over
+    `cluster_ids`. Then the deployments waiting in the queues of `org_ids`
+    (every organization in a full pass, and the ones of the clusters just
+    looked at) get a cluster where there is room, and those clusters a pass.
+    """
+    async with _pass_lock:
+        start = time.perf_counter()
+        limit = asyncio.Semaphore(SCHEDULER_CONCURRENCY)
+
+        async def run_shard(cluster_id, offered=None):
+            async with limit:
+                if offered is None:
+                    return await _schedule_cluster(cluster_id)
+                return await _schedule_cluster(cluster_id, offered)
+
+        if cluster_ids is None:
+            # Everything is looked at, the dirty marks taken so far are covered
+            await queues.backend.take_dirty()
+            await queues.backend.auto.take_dirty()
+            await _shard_legacy_queue()
+            shards = await queues.backend.clusters()
+            orgs = set(await queues.backend.auto.clusters())
+        else:
+            shards = list(cluster_ids)
+            orgs = set(org_ids)
+        # Replicas start from different clusters, so they split the work instead of queueing on the same locks
+        random.shuffle(shards)
+        results = await asyncio.gather(*(run_shard(cluster_id) for cluster_id in shards))
+
+        # Capacity freed on these clusters may fit what waits for a cluster in their organization
+        orgs.update(capacity.cluster_orgs[cluster_id] for cluster_id in shards
+                    if capacity.cluster_orgs.get(cluster_id) in capacity.indexes)
+        # What a cluster doesn't take is offered to the next one with room, a few rounds per pass
+        tried = {}
+        for _ in range(SCHEDULER_AUTO_ROUNDS):
+            offers = await _place_auto(sorted(orgs), tried)
+            if not offers:
+                break
+            shards += list(offers)
+            results += await asyncio.gather(*(run_shard(cluster_id, offered) for cluster_id, offered in offers.items()))
+            orgs = {capacity.cluster_orgs[cluster_id] for cluster_id in offers}
+        duration = time.perf_counter() - start
+
+    # Clusters that couldn't be scheduled this time are left for the next incremental pass
+    await queues.backend.mark_dirty([cluster_id for cluster_id, r in zip(shards, results) if r[4]])
+    placed = sum(r[0] for r in results)
+    waiting = sum(r[1] for r in results)
+    metrics.observe_pass(duration, placed, waiting, len(shards), "full" if cluster_ids is None else "incremental")
+    stale = sum(r[2] for r in results)
+    efficiency = [r[3] for r in results if r[3] is not None]
+    mean_efficiency = sum(efficiency) / len(efficiency) if efficiency else 0.0
+    print(f"[SUCCESS]: Scheduled {placed} deployments on {len(shards)} clusters, {waiting} waiting for resources, "
+          f"{stale} stale entries removed, packing efficiency {mean_efficiency:.2%}")
+
+
+async def schedule_changed(cluster_ids=()):
+    """
+    An incremental pass over the clusters marked dirty since the last one,
+    plus `cluster_ids`. A cluster whose deployments are waiting for resources
+    isn't looked at again until a submission, a release or an edit marks it,
+    so the cost of a pass follows the changes, not the size of the backlog.
+    """
+    dirty = set(cluster_ids) | await queues.backend.take_dirty()
+    orgs = await queues.backend.auto.take_dirty()
+    if dirty or orgs:
+        await schedule_deployments(sorted(dirty), sorted(orgs))
+
+
+async def _place_auto(org_ids, tried):
+    """
+    Find the deployments waiting in the organization queues a cluster, the
+    first one with room in the capacity index that they weren't offered to
+    yet (`tried`, {deployment_id: cluster ids}), in queue order. Returns the
+    offers, {cluster_id: {deployment_id: score}}: the deployments stay in
+    their organization's queue, without a cluster, until that cluster's pass
+    claims them.
+    """
+    offers, failed = {}, []
+    for org_id in org_ids:
+        try:
+            offers.update(await _place_organization(org_id, tried))
+        except Exception as e:
+            print(f"Error during cluster selection for organization {org_id}: {e}")
+            failed.append(org_id)
+    await queues.backend.auto.mark_dirty(failed)
+    return offers
+
+
+async def _place_organization(org_id, tried):
+    scores = dict(await queues.backend.auto.peek(org_id))
+    if not scores:
+        return {}
+    async with database.AsyncSessionLocal() as db:
+        index = await capacity.load(db, org_id)
+        rows = {row.id: row for row in await _load_unplaced(db, org_id, list(scores))}
+    stale, offers = [], {}
+    for deployment_id in scores:
+        row = rows.get(deployment_id)
+        if row is None or row.status != "pending" or row.cluster_id is not None:
+            stale.append(deployment_id)
+            continue
+        demand = (row.required_ram, row.required_cpu, row.required_gpu)
+        cluster_id = index.find(demand, tried.get(deployment_id, ()))
+        if cluster_id is not None:
+            # Held until the cluster's pass writes back what it really allocated
+            index.reserve(cluster_id, demand)
+            offers.setdefault(cluster_id, {})[deployment_id] = scores[deployment_id]
+            tried.setdefault(deployment_id, set()).add(cluster_id)
+    if stale:
+        await queues.backend.auto.remove(org_id, stale)
+    return offers
+
+
+async def _schedule_cluster(cluster_id, offered=None):
+    """
+    One cluster's shard, and the deployments of its organization's queue
+    `offered` to it ({deployment_id: score}); returns (placed, waiting,
+    stale, packing efficiency, retry).
+    """
+    offered = offered or {}
+    db = database.AsyncSessionLocal()  # Create a session manually
     try:
-        # getting pending deployments
-        pending_deployments = redis_client.zrange("deployment_queue", 0, -1, withscores=True)
-        # print(f"Processing deployments: {pending_deployments}")
-        
-        for deployment_id, priority in pending_deployments:
-            deployment = db.query(models.Deployment).filter(models.Deployment.id == int(deployment_id)).first()
-            # print(f"priorty depoloyment {deployment}, {priority}")
-            if not deployment:
-                print(f"No deployment found for {deployment_id}, removing from queue")
-                redis_client.zrem("deployment_queue", deployment_id)  # Clean up invalid entries
-                continue
-
-            cluster = db.query(models.Cluster).filter(models.Cluster.id == deployment.cluster_id).first()
-            if not cluster:
-                print(f"No cluster found for deployment {deployment_id}")
-                continue
-
-            # Check resource availability
-            if (cluster.available_ram >= deployment.required_ram and
-                cluster.available_cpu >= deployment.required_cpu and
-                cluster.available_gpu >= deployment.required_gpu):
-                
-                # Allocate resources
-                cluster.available_ram -= deployment.required_ram
-                cluster.available_cpu -= deployment.required_cpu
-                cluster.available_gpu -= deployment.required_gpu
-
-                # Update deployment status
-                deployment.status = "running"
-
-                # Remove from Redis queue
-                redis_client.zrem("deployment_queue", deployment_id)
-
-                print(f"[SUCCESS]: Deployment {deployment_id} got scheduled ")
-            else:
-                print(f"Insufficient resources for deployment {deployment_id}")
+        # getting pending deployments, lowest score first
+        scores = dict(await queues.backend.peek(cluster_id))
+        queued = list(scores)
+        scores.update(offered)
+        if not scores:
+            # Woken for freed or new capacity, which the organization's capacity index needs to see
+            await capacity.refresh(db, cluster_id)
+            return 0, 0, 0, None, False
 
-        db.commit()
+        # Another replica may change the cluster between our read and our write,
+        # a placement that no longer fits is recomputed from fresh state
+        for attempt in range(SCHEDULER_CLAIM_RETRIES):
+            cluster = await _load_cluster(db, cluster_id)
+            if cluster is None:
+                if await db.scalar(select(models.Cluster.id).where(models.Cluster.id == cluster_id)) is not None:
+                    # Locked, another replica is scheduling this cluster right now,
+                    # maybe from before the change that marked it
+                    return 0, 0, 0, None, True
+                print(f"No cluster found for {len(scores)} queued deployments of cluster {cluster_id}")
+                return 0, len(scores), 0, None, False
+
+            rows = {row.id: row for row in await _load_queued(db, cluster_id, queued)}
+            if offered:
+                rows.update((row.id, row) for row in await _load_queued(db, cluster_id, list(offered), cluster.organization_id))
+            stale = []
+            group = []
+            for deployment_id in scores:
+                row = rows.get(deployment_id)
+                if row is None or row.status != "pending":
+                    # Unknown or already handled deployments are cleaned up,
+                    # offered ones are left to their organization's queue
+                    if deployment_id not in offered:
+                        stale.append(deployment_id)
+                else:
+                    group.append(row)
+
+            # Let the cluster's placement strategy pick what runs
+            demands = np.array([(row.required_ram, row.required_cpu, row.required_gpu) for row in group], dtype=np.int64).reshape(-1, 3)
+            priorities = np.array([scores[row.id] for row in group])
+            selected, remaining, report = get_strategy(cluster.placement_strategy).place(
+                demands,
+                priorities,
+                (cluster.available_ram, cluster.available_cpu, cluster.available_gpu),
+                (cluster.total_ram, cluster.total_cpu, cluster.total_gpu),
+            )
+            evicted, preempting = [], 0
+            if SCHEDULER_PREEMPTION and len(selected) < len(group):
+                selected, evicted, preempting = await _preempt(db, cluster_id, demands, priorities, selected, remaining)
+            placed = [group[i].id for i in selected if group[i].id not in offered]
+            assigned = [group[i].id for i in selected if group[i].id in offered]
+            freed = np.array([row[1:4] for row in evicted], dtype=np.int64).reshape(-1, 3).sum(axis=0)
+            used = [int(total) for total in demands[selected].sum(axis=0) - freed]
+
+            if not (placed or assigned) or await _claim(db, cluster_id, placed, used, [row.id for row in evicted], assigned):
+                await db.commit()
+                capacity.update(cluster.organization_id, cluster_id, [
+                    available - allocated for available, allocated in zip(cluster[:3], used)
+                ])
+                break
+            await db.rollback()
+        else:
+            print(f"Cluster {cluster_id} kept changing during scheduling, retrying on the next pass")
+            return 0, len(scores), 0, None, True
+
+        # Remove placed and stale entries from the queue in one round trip,
+        # only after the allocations are committed
+        await queues.backend.remove(cluster_id, placed + stale)
+        if assigned:
+            await queues.backend.auto.remove(cluster.organization_id, assigned)
+            metrics.record_auto_placement(len(assigned))
+        placed += assigned
+        if evicted:
+            # Evicted deployments wait in the queue again, with their own priority
+            await queues.backend.enqueue({cluster_id: {row.id: row.priority for row in evicted}})
+        if preempting:
+            metrics.record_preemption(preempting, len(evicted))
+        await events.publish(
+            [events.event(deployment_id, "running", "pending", cluster_id, cluster.organization_id) for deployment_id in placed]
+            + [events.event(row.id, "pending", "running", cluster_id, cluster.organization_id) for row in evicted]
+        )
+
+        now = datetime.now(timezone.utc)
+        for deployment_id in placed:
+            created_at = rows[deployment_id].created_at
+            if created_at is not None:
+                if created_at.tzinfo is None:
+                    # sqlite hands back naive UTC timestamps
+                    created_at = created_at.replace(tzinfo=timezone.utc)
+                metrics.observe_scheduled(int(scores[deployment_id]), (now - created_at).total_seconds())
+
+        return len(placed), len(group) - len(placed), len(stale), report.efficiency, False
     except Exception as e:
-        print(f"Error during scheduling: {e}")
+        await db.rollback()
+        print(f"Error during scheduling of cluster {cluster_id}: {e}")
+        return 0, 0, 0, None, True
     finally:
-        db.close()
+        await db.close()
+
+
+async def _preempt(db, cluster_id, demands, priorities, selected, remaining):
+    """
+    Make room for what the strategy left waiting by evicting lower-priority
+    running deployments, including ones the strategy just picked (those then
+    simply stay queued). Returns the new selection (indices into the pending
+    group), the rows of the running deployments to evict and how many
+    deployments are placed through evictions.
+    """
+    running = await _load_running(db, cluster_id)
+    waiting = np.ones(len(demands), dtype=bool)
+    waiting[selected] = False
+    waiting = np.flatnonzero(waiting)
+    running_demands = np.concatenate([
+        np.array([row[1:4] for row in running], dtype=np.int64).reshape(-1, 3),
+        demands[selected],
+    ])
+    running_priorities = np.concatenate([
+        np.array([row.priority for row in running], dtype=priorities.dtype),
+        priorities[selected],
+    ])
+    preempting, victims, _ = plan_preemption(
+        demands[waiting], priorities[waiting], remaining, running_demands, running_priorities, SCHEDULER_PREEMPTION_LIMIT,
+    )
+    if not preempting:
+        return selected, [], 0
+    evicted = [running[v] for v in victims if v < len(running)]
+    displaced = {int(selected[v - len(running)]) for v in victims if v >= len(running)}
+    selected = np.array([i for i in selected if i not in displaced] + [int(waiting[i]) for i in preempting], dtype=np.intp)
+    return selected, evicted, len(preempting)
 
 
 @router.post("/trigger-scheduler")
@@ -68,10 +454,108 @@ async def trigger_scheduler(current_user: models.User = Depends(get_current_user
     await schedule_deployments()
     return { "success": True, "message": "Scheduler triggered successfully"}
 
+@router.post("/scheduler/reconcile")
+async def reconcile_queues(current_user: models.User = Depends(get_admin_user)):
+    return await reconcile_and_wake()
+
+@router.get("/scheduler/stats")
+async def scheduler_stats(current_user: models.User = Depends(get_current_user)):
+    # Only covers the scheduler running in this process
+    return {"preemption_enabled": SCHEDULER_PREEMPTION, **metrics.scheduler_stats()}
+
+
+def _wake(cluster_id):
+    _woken.add(cluster_id)
+    _wakeup.set()
+
+
+def notify_scheduler(cluster_id=None):
+    """
+    Wake the scheduler running in this process, for one cluster or for all of
+    them. Safe to call from any thread.
+    """
+    loop = _loop
+    if loop is not None and not loop.is_closed():
+        loop.call_soon_threadsafe(_wake, cluster_id)
+
+
+async def reconcile_and_wake():
+    report = await reconcile.reconcile()
+    # The Redis backend announced the requeued deployments to the other processes, this one is told here
+    for cluster_id in report["clusters"]:
+        notify_scheduler(cluster_id)
+    if report["organizations"]:
+        notify_scheduler(queues.AUTO_WAKEUP)
+    return report
+
+
+async def _reconcile_on_start():
+    try:
+        await reconcile_and_wake()
+    except Exception as e:
+        print(f"Queue reconciliation at startup failed, the queue is left as it is: {e}")
+
+
+async def run_event_loop():
+    # Runs a pass shortly after each wake-up; wake-ups that arrive while waiting
+    # or during a pass are folded into the next one
+    global _wakeup, _loop
+    _wakeup = asyncio.Event()
+    _loop = asyncio.get_running_loop()
+    try:
+        while True:
+            await _wakeup.wait()
+            await asyncio.sleep(SCHEDULER_COALESCE_MS / 1000)
+            _wakeup.clear()
+            woken = set(_woken)
+            _woken.clear()
+            # The organization queues are always looked at by schedule_changed()
+            woken.discard(queues.AUTO_WAKEUP)
+            if None in woken:
+                await schedule_deployments()
+            else:
+                await schedule_changed(woken)
+    finally:
+        _loop = None
+
+
+async def listen_for_wakeups():
+    # Submissions handled by other processes announce themselves on WAKEUP_CHANNEL
+    while True:
+        try:
+            async for cluster_id in queues.backend.wakeups():
+                notify_scheduler(cluster_id)
+        except redis.RedisError as e:
+            print(f"Lost {WAKEUP_CHANNEL} subscription, relying on local wake-ups and the sweep: {e}")
+            await asyncio.sleep(SCHEDULER_INTERVAL)
+
 
 def start_scheduler():
+    """Start scheduling on the running loop; returns a function that stops it again."""
+    # Only needed where the scheduler runs
+    from apscheduler.schedulers.asyncio import AsyncIOScheduler
+
+    loop = asyncio.get_running_loop()
+    tasks = [loop.create_task(run_event_loop())]
+    if queues.backend.shared:
+        tasks.append(loop.create_task(listen_for_wakeups()))
+    if SCHEDULER_RECONCILE_ON_START:
+        # In the background, the first passes don't wait for it
+        tasks.append(loop.create_task(_reconcile_on_start()))
+
+    # Both jobs are safety nets, new submissions and releases wake the scheduler directly:
+    # the dirty clusters whose wake-up was lost, and rarely everything
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(schedule_deployments, 'interval', seconds=SCHEDULER_INTERVAL)
+    scheduler.add_job(schedule_changed, 'interval', seconds=SCHEDULER_INTERVAL)
+    scheduler.add_job(schedule_deployments, 'interval', seconds=SCHEDULER_FULL_SWEEP_INTERVAL)
     scheduler.start()
     print("Scheduler started!")
 
+    def stop():
+        scheduler.shutdown(wait=False)
+        for task in tasks:
+            task.cancel()
+        print("Scheduler stopped!")
+
+    return stop
+
@@ -0,0 +1,82 @@
+"""
+The scheduler as its own process:
+
+    python -m app.scheduler_worker
+
+Run the API with EMBEDDED_SCHEDULER=0 and as many of these as you like: one
+is elected leader and schedules, the others wait on standby and take over
+when it goes away (see app/leader.py). Submissions reach the leader over the
+queue backend's wake-up channel, so the queue must be shared (Redis).
+"""
+from app import leader, queues, scheduler
+import asyncio
+import redis
+import signal
+
+# A lock backend failing (a Redis blip) costs the leadership, not the worker
+LOCK_ERRORS = (redis.RedisError, OSError)
+
+
+async def lead(lock, heartbeat):
+    """Schedule for as long as the lock is held."""
+    stop = scheduler.start_scheduler()
+    try:
+        while True:
+            await asyncio.sleep(heartbeat)
+            try:
+                held = await lock.renew()
+            except LOCK_ERRORS as e:
+                print(f"[WARNING]: Could not renew scheduler leadership, standing by: {e}")
+                return
+            if not held:
+                print("[WARNING]: Lost scheduler leadership")
+                return
+    finally:
+        stop()
+
+
+async def run(lock, heartbeat=leader.LEADER_TTL / 3):
+    if lock is None:
+        # No election, every worker schedules; the cluster row locks split the work
+        stop = scheduler.start_scheduler()
+        try:
+            await asyncio.Event().wait()
+        finally:
+            stop()
+        return
+
+    try:
+        while True:
+            try:
+                elected = await lock.acquire()
+            except LOCK_ERRORS as e:
+                print(f"[WARNING]: Could not reach the leader lock, retrying in {heartbeat:g}s: {e}")
+                elected = False
+            if elected:
+                print("[SUCCESS]: Elected scheduler leader")
+                await lead(lock, heartbeat)
+            else:
+                await asyncio.sleep(heartbeat)
+    finally:
+        try:
+            await lock.release()
+        except LOCK_ERRORS as e:
+            # Expires on its own after LEADER_TTL
+            print(f"[WARNING]: Could not release the leader lock: {e}")
+
+
+async def main():
+    if not queues.backend.shared:
+        raise SystemExit("The scheduler worker needs a shared queue, set QUEUE_BACKEND=redis")
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, task.cancel)
+    try:
+        await run(leader.create_lock())
+    except asyncio.CancelledError:
+        print("Scheduler worker shut down")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
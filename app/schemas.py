@@ -1,4 +1,4 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, root_validator, validator
 from datetime import datetime
 from typing import Optional
 
@@ -40,6 +40,15 @@ class ClusterBase(BaseModel):
     total_ram: int
     total_cpu: int
     total_gpu: int
+    placement_strategy: Optional[str] = None
+
+    @validator("placement_strategy")
+    def known_strategy(cls, v):
+        # Imported here, the placement engine pulls in numpy
+        from app.placement import STRATEGIES
+        if v is not None and v not in STRATEGIES:
+            raise ValueError(f"must be one of {sorted(STRATEGIES)}")
+        return v
 
 class ClusterCreate(ClusterBase):
     pass
@@ -62,12 +71,28 @@ class DeploymentBase(BaseModel):
     priority: int
 
 class DeploymentCreate(DeploymentBase):
-    cluster_id: int
+    # Either a cluster, or an organization whose clusters the scheduler picks from
+    cluster_id: Optional[int] = None
+    organization_id: Optional[int] = None
+
+    @root_validator(skip_on_failure=True)
+    def cluster_or_organization(cls, values):
+        if (values.get("cluster_id") is None) == (values.get("organization_id") is None):
+            raise ValueError("set exactly one of cluster_id and organization_id")
+        return values
 
 class Deployment(DeploymentBase):
     id: int
     status: str
     created_at: datetime
+    cluster_id: Optional[int] = None
+    organization_id: Optional[int] = None
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+class DeploymentBatchResult(BaseModel):
+    index: int
+    status_code: int
+    deployment: Optional[Deployment] = None
+    error: Optional[str] = None
@@ -0,0 +1,195 @@
+"""
+Version counters of clusters and organizations, ETags and a read-through
+cache of serialized responses.
+
+Every published transition (see events.publish) increments the version of
+the deployment's cluster and of its organization, so does creating a
+cluster. A cluster's version covers the cluster and the deployments on it,
+an organization's covers its cluster list and its deployments waiting for a
+cluster. Versions are read before the rows they describe: a response is
+tagged and cached with a version at most as new as its content, never the
+other way around.
+
+GET /clusters, /clusters/{id} and /deployments/{id} answer with an ETag
+derived from the version; a matching If-None-Match gets a 304. Their bodies
+are kept in RESPONSE_CACHE_SIZE entries per process, served as long as the
+version hasn't moved, after the same access check on cached memberships. A
+dashboard polling unchanged resources then costs a version read (a Redis
+HMGET, or a dict lookup) and no query. RESPONSE_CACHE_TTL bounds how long a
+change the counters missed (a manual UPDATE) stays hidden.
+
+With VERSION_BACKEND=redis (the default when the queue is on Redis) the
+counters are in the `resource_versions` hash, shared by every API replica
+and scheduler; `memory` keeps them in the process, for a single process.
+"""
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from app import authz, database, metrics, queues
+from app.cache import TTLCache
+import hashlib
+import json
+import os
+import redis
+import uuid
+
+VERSION_BACKEND = os.getenv("VERSION_BACKEND", queues.QUEUE_BACKEND)
+VERSIONS_KEY = "resource_versions"
+# Serialized responses kept per process, 0 disables the cache (ETags still work)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 10000))
+# Seconds a cached response may be served without its version moving
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 300))
+
+responses = TTLCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+
+def cluster_scope(cluster_id):
+    return f"cluster:{cluster_id}"
+
+
+def organization_scope(org_id):
+    return f"organization:{org_id}"
+
+
+class MemoryVersions:
+    def __init__(self):
+        # Tells this process's versions from those of an earlier one
+        self.epoch = uuid.uuid4().hex[:8]
+        self._counts = {}
+
+    async def get(self, scope):
+        return f"{self.epoch}.{self._counts.get(scope, 0)}"
+
+    async def bump(self, scopes):
+        for scope in scopes:
+            self._counts[scope] = self._counts.get(scope, 0) + 1
+
+
+class RedisVersions:
+    async def get(self, scope):
+        epoch, count = await database.redis_client.hmget(VERSIONS_KEY, "epoch", scope)
+        if epoch is None:
+            # New or flushed hash, counters restart and must not match the old tags
+            await database.redis_client.hsetnx(VERSIONS_KEY, "epoch", uuid.uuid4().hex[:8])
+            epoch, count = await database.redis_client.hmget(VERSIONS_KEY, "epoch", scope)
+        return f"{_str(epoch)}.{_str(count or 0)}"
+
+    async def bump(self, scopes):
+        pipe = database.redis_client.pipeline(transaction=False)
+        for scope in scopes:
+            pipe.hincrby(VERSIONS_KEY, scope, 1)
+        await pipe.execute()
+
+
+def _str(value):
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+
+def create_backend(name=VERSION_BACKEND):
+    if name == "redis":
+        return RedisVersions()
+    if name == "memory":
+        return MemoryVersions()
+    raise ValueError(f"Unknown VERSION_BACKEND {name!r}, expected 'redis' or 'memory'")
+
+
+backend = create_backend()
+
+
+async def bump(cluster_ids=(), organization_ids=()):
+    """
+    Invalidate the tags and cached responses of these clusters and organizations, and of
+    their clusters' organizations. Best effort, like the events: what it misses expires
+    after RESPONSE_CACHE_TTL.
+    """
+    cluster_ids = {cluster_id for cluster_id in cluster_ids if cluster_id is not None}
+    organization_ids = set(organization_ids) | {authz.cluster_orgs.get(cluster_id) for cluster_id in cluster_ids}
+    organization_ids.discard(None)
+    scopes = [cluster_scope(cluster_id) for cluster_id in cluster_ids] + [organization_scope(org_id) for org_id in organization_ids]
+    if not scopes:
+        return
+    try:
+        await backend.bump(scopes)
+    except redis.RedisError as e:
+        print(f"Could not bump the versions of {len(scopes)} clusters and organizations: {e}")
+
+
+async def _version(scope):
+    try:
+        return await backend.get(scope)
+    except redis.RedisError as e:
+        # Answered from the database, untagged
+        print(f"Could not read the version of {scope}: {e}")
+        return None
+
+
+class Entry:
+    __slots__ = ("scope", "version", "org_id", "etag", "body", "headers")
+
+    def __init__(self, scope, version, org_id, etag, body, headers):
+        self.scope = scope
+        self.version = version
+        self.org_id = org_id
+        self.etag = etag
+        self.body = body
+        self.headers = headers
+
+
+def _etag(key, scope, version):
+    # The scope too: a deployment placed on a cluster changes scope, and counters of different scopes collide
+    return '"' + hashlib.sha1(f"{key}|{scope}|{version}".encode()).hexdigest()[:24] + '"'
+
+
+def _matches(request, etag):
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag in tags or "*" in tags
+
+
+def _reply(request, resource, etag, body, headers, result):
+    headers = {**headers, "ETag": etag, "Cache-Control": "private, no-cache"}
+    if _matches(request, etag):
+        metrics.record_cache(resource, "not_modified")
+        return Response(status_code=304, headers=headers)
+    metrics.record_cache(resource, result)
+    return Response(body(), media_type="application/json", headers=headers)
+
+
+def _serialize(content):
+    return json.dumps(jsonable_encoder(content), ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+
+async def conditional(request, db, current_user, resource, key, load, scope=None):
+    """
+    The JSON response of the GET cached under `key`: its cached body while
+    the version of its scope hasn't moved, a 304 when the client has it.
+    `load()` reads it from the database, access checks included, and returns
+    (scope, organization id, content, headers). `scope` is given when it is
+    known before reading; a deployment's is only known from its row, or from
+    the cached entry.
+    """
+    entry = responses.get(key)
+    if scope is None and entry is not None:
+        scope = entry.scope
+    version = None if scope is None else await _version(scope)
+    if (entry is not None and version is not None and entry.scope == scope and entry.version == version
+            and entry.org_id in await authz.user_org_ids(db, current_user.id)):
+        return _reply(request, resource, entry.etag, lambda: entry.body, entry.headers, "hit")
+
+    loaded_scope, org_id, content, headers = await load()
+    if loaded_scope != scope:
+        # Read before its version was, or moved to a cluster since: read again after the version
+        scope = loaded_scope
+        version = await _version(scope)
+        loaded_scope, org_id, content, headers = await load()
+    if version is None or loaded_scope != scope:
+        metrics.record_cache(resource, "miss")
+        return Response(_serialize(content), media_type="application/json", headers=headers)
+
+    etag = _etag(key, scope, version)
+    body = None
+    if RESPONSE_CACHE_SIZE:
+        body = _serialize(content)
+        responses.set(key, Entry(scope, version, org_id, etag, body, headers))
+    return _reply(request, resource, etag, lambda: body if body is not None else _serialize(content), headers, "miss")
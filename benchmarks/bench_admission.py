@@ -0,0 +1,166 @@
+"""
+Queue depth and scheduling pass time under bursty submissions, without and
+with admission control.
+
+    python -m benchmarks.bench_admission --rounds 300 --rate 10 --burst 5000
+
+One organization owns --clusters clusters. Every round (one second of a
+simulated clock), --rate deployments are submitted in batches of --batch,
+plus a --burst of them every --every rounds: a runaway pipeline. A
+scheduling pass runs, and deployments that have run their lifetime complete
+and release their resources. Submissions go through admission.admit() the
+way the batch endpoint does, a refused batch is dropped (its client would
+come back after Retry-After). Reported per mode: accepted and refused
+submissions, the largest and final queue depth, the p95 and max pass time,
+and the mean wait from submission to running.
+
+Runs the scheduler in this process on an in-memory queue, events and
+versions, and a throwaway sqlite database.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+import types
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_admission_")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/bench.db"
+
+from fastapi import HTTPException  # noqa: E402
+from sqlalchemy import insert, select, update  # noqa: E402
+
+from app import admission, capacity, events, models, queues, scheduler, versions  # noqa: E402
+from app.database import AsyncSessionLocal, Base, engine  # noqa: E402
+
+RAM, CPU = 64 * 1024, 32
+
+
+def seed(clusters):
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(insert(models.Organization), [{"id": 1, "name": "bench", "invite_code": "BENCH"}])
+        conn.execute(insert(models.Cluster), [{
+            "id": i, "organization_id": 1, "name": f"bench-{i}", "total_ram": RAM, "total_cpu": CPU, "total_gpu": 0,
+            "available_ram": RAM, "available_cpu": CPU, "available_gpu": 0,
+        } for i in range(1, clusters + 1)])
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else None
+
+
+async def complete(deployments):
+    released = {}
+    async with AsyncSessionLocal() as db:
+        for deployment_id, cluster_id, cpu in deployments:
+            await db.execute(update(models.Deployment).where(models.Deployment.id == deployment_id).values(status="completed"))
+            released[cluster_id] = released.get(cluster_id, 0) + cpu
+        for cluster_id, cpu in released.items():
+            await db.execute(update(models.Cluster).where(models.Cluster.id == cluster_id).values(
+                available_ram=models.Cluster.available_ram + cpu * 1024, available_cpu=models.Cluster.available_cpu + cpu,
+            ))
+        await db.commit()
+    await queues.backend.wake(released)
+
+
+async def run(args, clock):
+    rng = random.Random(args.seed)
+    submitted, lifetime, sizes, started, ends = {}, {}, {}, {}, {}
+    accepted = refused = depth_max = 0
+    pass_seconds = []
+    next_id = 1
+    for now in range(args.rounds):
+        clock.now = float(now)
+        count = args.rate + (args.burst if now % args.every == args.every // 2 else 0)
+        async with AsyncSessionLocal() as db:
+            for start in range(0, count, args.batch):
+                size = min(args.batch, count - start)
+                cluster_id = rng.randint(1, args.clusters)
+                try:
+                    await admission.admit(db, 1, cluster_id, size)
+                except HTTPException:
+                    refused += size
+                    continue
+                rows, scores = [], {}
+                for deployment_id in range(next_id, next_id + size):
+                    cpu = rng.randint(1, 4)
+                    rows.append({
+                        "id": deployment_id, "cluster_id": cluster_id, "organization_id": 1, "docker_image": "bench:latest",
+                        "required_ram": cpu * 1024, "required_cpu": cpu, "required_gpu": 0, "priority": 1, "status": "pending",
+                    })
+                    scores[deployment_id] = 1
+                    submitted[deployment_id], lifetime[deployment_id], sizes[deployment_id] = now, rng.randint(3, 12), cpu
+                next_id += size
+                accepted += size
+                await db.execute(insert(models.Deployment), rows)
+                await db.commit()
+                await queues.backend.enqueue({cluster_id: scores})
+        depth_max = max(depth_max, await queues.backend.count(range(1, args.clusters + 1)))
+
+        start = time.perf_counter()
+        await scheduler.schedule_changed()
+        pass_seconds.append(time.perf_counter() - start)
+
+        async with AsyncSessionLocal() as db:
+            running = (await db.execute(
+                select(models.Deployment.id, models.Deployment.cluster_id).where(models.Deployment.status == "running")
+            )).all()
+        for deployment_id, cluster_id in running:
+            if deployment_id not in started:
+                started[deployment_id] = now
+                ends.setdefault(now + lifetime[deployment_id], []).append((deployment_id, cluster_id, sizes[deployment_id]))
+        if now in ends:
+            await complete(ends.pop(now))
+
+    waits = [started[i] - submitted[i] for i in started]
+    return {
+        "accepted": accepted,
+        "refused": refused,
+        "depth_max": depth_max,
+        "depth_end": await queues.backend.count(range(1, args.clusters + 1)),
+        "pass_p95": percentile(pass_seconds, 95) * 1000,
+        "pass_max": max(pass_seconds) * 1000,
+        "wait": sum(waits) / len(waits) if waits else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clusters", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=300)
+    parser.add_argument("--rate", type=int, default=10, help="steady submissions per round")
+    parser.add_argument("--burst", type=int, default=5000, help="submissions of a burst")
+    parser.add_argument("--every", type=int, default=60, help="rounds between bursts")
+    parser.add_argument("--batch", type=int, default=50, help="submissions per batch request")
+    parser.add_argument("--org-rate", type=float, default=50, help="ADMISSION_ORG_RATE of the limited run")
+    parser.add_argument("--org-burst", type=int, default=500, help="ADMISSION_ORG_BURST of the limited run")
+    parser.add_argument("--max-pending", type=int, default=200, help="ADMISSION_CLUSTER_MAX_PENDING of the limited run")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Rounds are seconds of a simulated clock, for the buckets too
+    clock = types.SimpleNamespace(now=0.0)
+    admission.time = types.SimpleNamespace(time=lambda: clock.now)
+    events.broker = events.Broker()
+    versions.backend = versions.MemoryVersions()
+
+    print(f"{'limits':<8} {'accepted':>9} {'refused':>8} {'depth max':>10} {'depth end':>10} "
+          f"{'pass p95 (ms)':>14} {'pass max (ms)':>14} {'wait mean':>10}")
+    for limited in (False, True):
+        admission.ADMISSION_ORG_RATE, admission.ADMISSION_ORG_BURST = (args.org_rate, args.org_burst) if limited else (0, 0)
+        admission.ADMISSION_CLUSTER_MAX_PENDING = args.max_pending if limited else 0
+        admission.backend = admission.MemoryBuckets()
+        seed(args.clusters)
+        capacity.reset()
+        queues.backend = queues.MemoryQueue()
+        result = asyncio.run(run(args, clock))
+        print(f"{'on' if limited else 'off':<8} {result['accepted']:>9} {result['refused']:>8} {result['depth_max']:>10} "
+              f"{result['depth_end']:>10} {result['pass_p95']:>14.1f} {result['pass_max']:>14.1f} {result['wait']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+API latency while a large scheduling pass runs in the same event loop.
+
+    python -m benchmarks.bench_api_latency --queue 50000 --fake-redis
+
+Requests go to the app in-process through httpx's ASGI transport, so they
+share the event loop with the scheduler exactly like under uvicorn. Latency of
+GET /clusters/{id} is measured with the scheduler idle and then while a pass
+over --queue deployments is running; a blocking pass shows up as a tail spike.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_api_latency_")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/bench.db"
+# Status events and resource versions in this process, a pass doesn't wait on a Redis that isn't there
+os.environ.setdefault("EVENT_BACKEND", "memory")
+os.environ.setdefault("VERSION_BACKEND", "memory")
+
+import httpx  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+from app import models, queues, scheduler  # noqa: E402
+from app.auth import create_access_token  # noqa: E402
+from app.database import REDIS_DB, REDIS_HOST, REDIS_PORT, Base, engine  # noqa: E402
+from app.main import app  # noqa: E402
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def seed(queue, clusters, redis_client):
+    rng = random.Random(queue)
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    redis_client.flushdb()
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [{"id": 1, "username": "bench", "hashed_password": "-"}])
+        conn.execute(insert(models.Organization), [{"id": 1, "name": "bench", "invite_code": "BENCH"}])
+        conn.execute(insert(models.UserOrganization), [{"user_id": 1, "organization_id": 1}])
+        conn.execute(insert(models.Cluster), [
+            {
+                "id": cluster_id, "organization_id": 1, "name": f"cluster-{cluster_id}",
+                "total_ram": 512 * 1024, "total_cpu": 256, "total_gpu": 16,
+                "available_ram": 512 * 1024, "available_cpu": 256, "available_gpu": 16,
+            }
+            for cluster_id in range(1, clusters + 1)
+        ])
+        deployments = [
+            {
+                "id": deployment_id, "cluster_id": rng.randint(1, clusters), "docker_image": "bench:latest",
+                "required_ram": rng.choice([512, 1024, 4096]), "required_cpu": rng.choice([1, 2, 4]),
+                "required_gpu": rng.choice([0, 0, 0, 1]), "priority": rng.randint(1, 5), "status": "pending",
+            }
+            for deployment_id in range(1, queue + 1)
+        ]
+        conn.execute(insert(models.Deployment), deployments)
+    pipe = redis_client.pipeline(transaction=False)
+    for d in deployments:
+        pipe.zadd(queues.queue_key(d["cluster_id"]), {d["id"]: d["priority"]})
+        pipe.sadd(queues.SHARDS_KEY, d["cluster_id"])
+    pipe.execute()
+
+
+async def measure(client, headers, until=None, count=200):
+    latencies = []
+    while (until is None and len(latencies) < count) or (until is not None and not until.done()):
+        start = time.perf_counter()
+        response = await client.get("/clusters/1", headers=headers)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.text
+    return latencies
+
+
+async def run(args):
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': 'bench'})}"}
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        idle = await measure(client, headers)
+        start = time.perf_counter()
+        schedule_pass = asyncio.create_task(scheduler.schedule_deployments())
+        busy = await measure(client, headers, until=schedule_pass)
+        pass_time = time.perf_counter() - start
+    return idle, busy, pass_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queue", type=int, default=50000)
+    parser.add_argument("--clusters", type=int, default=50)
+    parser.add_argument("--fake-redis", action="store_true")
+    args = parser.parse_args()
+
+    if args.fake_redis:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        redis_client = fakeredis.FakeRedis(server=server)
+        queues.backend = queues.RedisQueue(fakeredis.FakeAsyncRedis(server=server))
+    else:
+        import redis
+        redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+
+    seed(args.queue, args.clusters, redis_client)
+    idle, busy, pass_time = asyncio.run(run(args))
+    print(f"scheduling pass over {args.queue} queued deployments took {pass_time:.2f}s")
+    print(f"{'':>16} {'requests':>9} {'p50 (ms)':>9} {'p99 (ms)':>9} {'max (ms)':>9}")
+    for label, values in (("scheduler idle", idle), ("during pass", busy)):
+        print(f"{label:>16} {len(values):>9} {percentile(values, 50) * 1000:9.1f} "
+              f"{percentile(values, 99) * 1000:9.1f} {max(values) * 1000:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+Deployments pinned to a cluster against deployments submitted to their
+organization and placed by the scheduler through the capacity index, and
+the cost of a fit query against scanning the cluster rows.
+
+    python -m benchmarks.bench_autoplace --clusters 20 --rounds 200 --rate 30
+
+One organization owns --clusters equal clusters. Every round, --rate
+deployments of random size and lifetime (in rounds) are submitted, an
+incremental scheduling pass runs, and the deployments whose lifetime is over
+complete and release their resources. Pinned submissions pick their cluster
+with a --skew Zipf preference, the way users stick to the clusters they
+know; auto submissions name only the organization. Time is counted in
+rounds, so the results don't depend on the machine. Reported per mode: time
+to running (mean and p95), what is still waiting at the end, and the mean
+allocated share of the fleet's cpu and ram over the rounds.
+
+Runs the scheduler in this process on an in-memory queue and a throwaway
+sqlite database.
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_autoplace_")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/bench.db"
+# Status events and resource versions in this process, a pass doesn't wait on a Redis that isn't there
+os.environ.setdefault("EVENT_BACKEND", "memory")
+os.environ.setdefault("VERSION_BACKEND", "memory")
+
+from sqlalchemy import func, insert, select, update  # noqa: E402
+
+from app import capacity, models, queues, scheduler  # noqa: E402
+from app.database import AsyncSessionLocal, Base, engine  # noqa: E402
+
+RAM, CPU = 64 * 1024, 32
+
+
+def seed(free):
+    """One organization and a cluster per (id, (free ram, cpu, gpu)) of `free`."""
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(insert(models.Organization), [{"id": 1, "name": "bench", "invite_code": "BENCH"}])
+        conn.execute(insert(models.Cluster), [{
+            "id": i, "organization_id": 1, "name": f"bench-{i}", "total_ram": RAM, "total_cpu": CPU, "total_gpu": 0,
+            "available_ram": ram, "available_cpu": cpu, "available_gpu": gpu,
+        } for i, (ram, cpu, gpu) in free])
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else None
+
+
+async def complete(deployments):
+    released = {}
+    async with AsyncSessionLocal() as db:
+        for deployment_id, cluster_id, ram, cpu in deployments:
+            await db.execute(update(models.Deployment).where(models.Deployment.id == deployment_id).values(status="completed"))
+            freed = released.setdefault(cluster_id, [0, 0])
+            freed[0] += ram
+            freed[1] += cpu
+        for cluster_id, (ram, cpu) in released.items():
+            await db.execute(update(models.Cluster).where(models.Cluster.id == cluster_id).values(
+                available_ram=models.Cluster.available_ram + ram, available_cpu=models.Cluster.available_cpu + cpu,
+            ))
+        await db.commit()
+    await queues.backend.wake(released)
+
+
+async def run(args, auto):
+    rng = random.Random(args.seed)
+    weights = [1 / (i + 1) ** args.skew for i in range(args.clusters)]
+    submitted, lifetime, sizes, started, ends = {}, {}, {}, {}, {}
+    utilization, pass_seconds = [], []
+    next_id = 1
+    for now in range(args.rounds):
+        rows, entries = [], {}
+        for _ in range(args.rate):
+            ram, cpu = rng.choice([1024, 2048, 4096, 8192]), rng.randint(1, 4)
+            cluster_id = None if auto else rng.choices(range(1, args.clusters + 1), weights)[0]
+            rows.append({
+                "id": next_id, "cluster_id": cluster_id, "organization_id": 1, "docker_image": "bench:latest",
+                "required_ram": ram, "required_cpu": cpu, "required_gpu": 0, "priority": 1, "status": "pending",
+            })
+            key = (queues.backend.auto, 1) if auto else (queues.backend, cluster_id)
+            entries.setdefault(key, {})[next_id] = 1
+            submitted[next_id], lifetime[next_id], sizes[next_id] = now, rng.randint(3, 12), (ram, cpu)
+            next_id += 1
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(models.Deployment), rows)
+            await db.commit()
+        for (backend, shard), scores in entries.items():
+            await backend.enqueue({shard: scores})
+
+        start = time.perf_counter()
+        await scheduler.schedule_changed()
+        pass_seconds.append(time.perf_counter() - start)
+
+        async with AsyncSessionLocal() as db:
+            running = (await db.execute(
+                select(models.Deployment.id, models.Deployment.cluster_id).where(models.Deployment.status == "running")
+            )).all()
+            free_ram, free_cpu = (await db.execute(
+                select(func.sum(models.Cluster.available_ram), func.sum(models.Cluster.available_cpu))
+            )).one()
+        for deployment_id, cluster_id in running:
+            if deployment_id not in started:
+                started[deployment_id] = now
+                ends.setdefault(now + lifetime[deployment_id], []).append((deployment_id, cluster_id, *sizes[deployment_id]))
+        total_ram, total_cpu = RAM * args.clusters, CPU * args.clusters
+        utilization.append(((total_cpu - free_cpu) / total_cpu, (total_ram - free_ram) / total_ram))
+        if now in ends:
+            await complete(ends.pop(now))
+
+    waits = [started[i] - submitted[i] for i in started]
+    return {
+        "mean_wait": sum(waits) / len(waits) if waits else None,
+        "p95_wait": percentile(waits, 95),
+        "waiting": len(submitted) - len(started),
+        "cpu": sum(u[0] for u in utilization) / len(utilization),
+        "ram": sum(u[1] for u in utilization) / len(utilization),
+        "pass_ms": sorted(pass_seconds)[len(pass_seconds) // 2] * 1000,
+    }
+
+
+async def fit_query_costs(sizes, queries=2000):
+    """
+    Time to find the first cluster with room for a demand that fits somewhere
+    and for one that fits nowhere: the index, a scan of the rows in memory,
+    and a query.
+    """
+    rng = random.Random(9)
+    print(f"\n{'clusters':>8} {'index (us)':>11} {'scan (us)':>10} {'index, none':>12} {'scan, none':>11} {'SQL (us)':>9}")
+    for size in sizes:
+        # A busy fleet: every cpu taken but on a few clusters
+        free = [
+            (i, (rng.randrange(RAM), rng.randrange(CPU), 0) if rng.random() < 0.002 else (rng.randrange(RAM), 0, 0))
+            for i in range(1, size + 1)
+        ]
+        index = capacity.CapacityIndex(free)
+        fitting = [(rng.choice([1024, 2048, 4096, 8192]), rng.randint(1, 4), 0) for _ in range(queries)]
+        unfit = [(1024, CPU + 1, 0)] * queries
+
+        def timed(find, demands):
+            start = time.perf_counter()
+            for demand in demands:
+                find(demand)
+            return (time.perf_counter() - start) / len(demands) * 1e6
+
+        def scan(demand):
+            return next((i for i, f in free if f[0] >= demand[0] and f[1] >= demand[1] and f[2] >= demand[2]), None)
+
+        seed(free)
+        async with AsyncSessionLocal() as db:
+            start = time.perf_counter()
+            for demand in fitting[:200]:
+                await db.scalar(select(models.Cluster.id).where(
+                    models.Cluster.organization_id == 1, models.Cluster.available_ram >= demand[0],
+                    models.Cluster.available_cpu >= demand[1], models.Cluster.available_gpu >= demand[2],
+                ).order_by(models.Cluster.id).limit(1))
+            queried = (time.perf_counter() - start) / 200 * 1e6
+        print(f"{size:>8} {timed(index.find, fitting):>11.1f} {timed(scan, fitting):>10.1f} "
+              f"{timed(index.find, unfit):>12.1f} {timed(scan, unfit):>11.1f} {queried:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clusters", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=200)
+    parser.add_argument("--rate", type=int, default=30, help="submissions per round")
+    parser.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of the pinned cluster choice")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'mode':<8} {'wait mean':>10} {'wait p95':>9} {'waiting':>8} {'cpu used':>9} {'ram used':>9} {'pass (ms)':>10}")
+    for auto in (False, True):
+        seed([(i, (RAM, CPU, 0)) for i in range(1, args.clusters + 1)])
+        capacity.reset()
+        queues.backend = queues.MemoryQueue()
+        result = asyncio.run(run(args, auto))
+        print(f"{'auto' if auto else 'pinned':<8} {result['mean_wait']:>10.2f} {result['p95_wait']:>9} "
+              f"{result['waiting']:>8} {result['cpu']:>9.1%} {result['ram']:>9.1%} {result['pass_ms']:>10.1f}")
+    asyncio.run(fit_query_costs([100, 1000, 10000]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Dashboard polling with and without conditional GETs and the response cache,
+on one spawned uvicorn worker.
+
+    python -m benchmarks.bench_cache --clients 50 --duration 10
+
+--clients dashboards each poll GET /clusters, GET /clusters/{id} of every
+cluster and GET /deployments/{id} of a few deployments, as fast as the
+worker answers. Meanwhile a deployment is submitted every --change-interval
+seconds, so the versions move and the cached responses are invalidated the
+way the scheduler does it. Three runs, a fresh worker each:
+
+    plain   RESPONSE_CACHE_SIZE=0, no If-None-Match: every poll queries and serializes
+    etag    RESPONSE_CACHE_SIZE=0, If-None-Match: a 304 after the query
+    cached  the response cache and If-None-Match: a 304 without a query
+
+Reported: requests per second, p50/p95 latency, the share answered 304, and
+SELECTs run per request (db_query_duration_seconds_count from /metrics).
+
+The worker runs on a throwaway sqlite database with the in-memory queue,
+event broker and version counters, and its embedded scheduler.
+"""
+import argparse
+import asyncio
+import os
+import re
+import tempfile
+import time
+import uuid
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_cache_")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmpdir}/bench.db")
+os.environ.setdefault("QUEUE_BACKEND", "memory")
+os.environ.setdefault("EVENT_BACKEND", "memory")
+os.environ.setdefault("VERSION_BACKEND", "memory")
+
+import httpx  # noqa: E402
+
+from benchmarks.bench_load import spawn_worker  # noqa: E402
+
+PASSWORD = "cache-bench-password"
+MODES = {"plain": ("0", False), "etag": ("0", True), "cached": (None, True)}
+
+
+async def prepare(client, clusters, deployments):
+    run = uuid.uuid4().hex[:8]
+    await client.post("/create-organization", json={"name": f"cache-{run}", "invite_code": f"CA-{run}"})
+    await client.post("/register", json={"username": f"cache-{run}", "password": PASSWORD})
+    token = (await client.post("/token", data={"username": f"cache-{run}", "password": PASSWORD})).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    await client.post(f"/join-organization?invite_code=CA-{run}", headers=headers)
+    cluster_ids = []
+    for i in range(clusters):
+        cluster_ids.append((await client.post("/clusters", headers=headers, json={
+            "name": f"cache-{run}-{i}", "total_ram": 1024 * 1024, "total_cpu": 1024, "total_gpu": 0,
+        })).json()["id"])
+    deployment_ids = [await submit(client, headers, cluster_ids[i % clusters]) for i in range(deployments)]
+    return headers, cluster_ids, deployment_ids
+
+
+async def submit(client, headers, cluster_id):
+    response = await client.post("/deployments", headers=headers, json={
+        "cluster_id": cluster_id, "docker_image": "cache:latest", "required_ram": 1, "required_cpu": 1,
+        "required_gpu": 0, "priority": 1,
+    })
+    return response.json()["id"]
+
+
+async def selects(client):
+    text = (await client.get("/metrics")).text
+    match = re.search(r'^db_query_duration_seconds_count\{operation="SELECT"\} (\S+)$', text, re.M)
+    return float(match.group(1)) if match else 0.0
+
+
+async def run(args, conditional):
+    process, url = spawn_worker()
+    try:
+        limits = httpx.Limits(max_connections=args.clients + 5, max_keepalive_connections=args.clients + 5)
+        async with httpx.AsyncClient(base_url=url, limits=limits, timeout=60) as client:
+            headers, cluster_ids, deployment_ids = await prepare(client, args.clusters, args.deployments)
+            urls = ["/clusters"] + [f"/clusters/{i}" for i in cluster_ids] + [f"/deployments/{i}" for i in deployment_ids]
+            latencies, not_modified = [], 0
+            stop = time.perf_counter() + args.duration
+
+            async def dashboard():
+                nonlocal not_modified
+                tags = {}
+                while time.perf_counter() < stop:
+                    for path in urls:
+                        request_headers = dict(headers)
+                        if conditional and path in tags:
+                            request_headers["If-None-Match"] = tags[path]
+                        start = time.perf_counter()
+                        response = await client.get(path, headers=request_headers)
+                        latencies.append(time.perf_counter() - start)
+                        if response.status_code == 304:
+                            not_modified += 1
+                        elif "etag" in response.headers:
+                            tags[path] = response.headers["etag"]
+
+            async def changes():
+                while time.perf_counter() < stop:
+                    await asyncio.sleep(args.change_interval)
+                    await submit(client, headers, cluster_ids[0])
+
+            before = await selects(client)
+            await asyncio.gather(changes(), *(dashboard() for _ in range(args.clients)))
+            queried = await selects(client) - before
+    finally:
+        process.terminate()
+        process.wait()
+    latencies.sort()
+    return {
+        "throughput": len(latencies) / args.duration,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "not_modified": not_modified / len(latencies),
+        "selects": queried / len(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--clusters", type=int, default=5)
+    parser.add_argument("--deployments", type=int, default=5, help="polled by every dashboard")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--change-interval", type=float, default=1.0, help="seconds between submissions")
+    args = parser.parse_args()
+
+    print(f"{'mode':<7} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'304':>6} {'SELECT/req':>11}")
+    for mode, (cache_size, conditional) in MODES.items():
+        if cache_size is None:
+            os.environ.pop("RESPONSE_CACHE_SIZE", None)
+        else:
+            os.environ["RESPONSE_CACHE_SIZE"] = cache_size
+        result = asyncio.run(run(args, conditional))
+        print(f"{mode:<7} {result['throughput']:>8.1f} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} "
+              f"{result['not_modified']:>6.1%} {result['selects']:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Status streaming against polling, on one spawned uvicorn worker.
+
+    python -m benchmarks.bench_events --subscribers 100 1000 --duration 10
+
+For each subscriber count, that many clients follow a cluster over
+GET /clusters/{id}/events and sit idle for --duration seconds, then the same
+number poll GET /deployments/{id} every --poll-interval seconds. Reported:
+the worker's memory and cpu time for each, and how long it takes a submitted
+deployment to be seen running by a stream and by a poller.
+
+The worker runs on a throwaway sqlite database with the in-memory queue and
+event broker, and its embedded scheduler. The clients share the machine with
+the worker, its cpu time is read from /proc (Linux only).
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import uuid
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_events_")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmpdir}/bench.db")
+os.environ.setdefault("QUEUE_BACKEND", "memory")
+os.environ.setdefault("EVENT_BACKEND", "memory")
+
+import httpx  # noqa: E402
+
+from benchmarks.bench_load import spawn_worker  # noqa: E402
+
+PASSWORD = "events-bench-password"
+
+
+def worker_usage(pid):
+    """(resident MiB, cpu seconds) of the worker."""
+    with open(f"/proc/{pid}/status") as f:
+        rss = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:")) / 1024
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return rss, (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+async def prepare(client):
+    run = uuid.uuid4().hex[:8]
+    await client.post("/create-organization", json={"name": f"events-{run}", "invite_code": f"EV-{run}"})
+    await client.post("/register", json={"username": f"events-{run}", "password": PASSWORD})
+    token = (await client.post("/token", data={"username": f"events-{run}", "password": PASSWORD})).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    await client.post(f"/join-organization?invite_code=EV-{run}", headers=headers)
+    cluster = (await client.post("/clusters", headers=headers, json={
+        "name": f"events-{run}", "total_ram": 1024 * 1024, "total_cpu": 1024, "total_gpu": 0,
+    })).json()
+    return headers, cluster["id"]
+
+
+async def submit(client, headers, cluster_id):
+    response = await client.post("/deployments", headers=headers, json={
+        "cluster_id": cluster_id, "docker_image": "events:latest", "required_ram": 1, "required_cpu": 1,
+        "required_gpu": 0, "priority": 1,
+    })
+    return response.json()["id"], time.perf_counter()
+
+
+async def streams(client, headers, cluster_id, count, duration, pid, samples):
+    connected = 0
+    seen = {}
+
+    async def follow():
+        nonlocal connected
+        async with client.stream("GET", f"/clusters/{cluster_id}/events", headers=headers) as response:
+            connected += 1
+            async for line in response.aiter_lines():
+                if line.startswith("data: ") and '"status": "running"' in line:
+                    deployment_id = int(line.split('"deployment_id": ', 1)[1].split(",", 1)[0])
+                    seen.setdefault(deployment_id, time.perf_counter())
+
+    before = worker_usage(pid)
+    tasks = [asyncio.create_task(follow()) for _ in range(count)]
+    while connected < count:
+        await asyncio.sleep(0.05)
+    idle_start = worker_usage(pid)
+    await asyncio.sleep(duration)
+    idle_end = worker_usage(pid)
+
+    latencies = []
+    for _ in range(samples):
+        deployment_id, start = await submit(client, headers, cluster_id)
+        while deployment_id not in seen:
+            await asyncio.sleep(0.001)
+        latencies.append(seen[deployment_id] - start)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return idle_start[0] - before[0], idle_end[1] - idle_start[1], latencies
+
+
+async def pollers(client, headers, cluster_id, count, duration, interval, pid, samples):
+    deployment_id, _ = await submit(client, headers, cluster_id)
+    stop = time.perf_counter() + duration
+
+    async def poll(url):
+        while time.perf_counter() < stop:
+            try:
+                await client.get(url, headers=headers)
+            except httpx.HTTPError:
+                # The worker closing a keep-alive connection as it is reused, or overloaded
+                errors.append(url)
+            await asyncio.sleep(interval)
+
+    errors = []
+
+    start_usage = worker_usage(pid)
+    await asyncio.gather(*(poll(f"/deployments/{deployment_id}") for _ in range(count)))
+    end_usage = worker_usage(pid)
+
+    latencies = []
+    for _ in range(samples):
+        deployment_id, start = await submit(client, headers, cluster_id)
+        # A poller started at a random point of its interval
+        await asyncio.sleep(interval * (len(latencies) + 0.5) / samples)
+        while (await client.get(f"/deployments/{deployment_id}", headers=headers)).json()["status"] != "running":
+            await asyncio.sleep(interval)
+        latencies.append(time.perf_counter() - start)
+    if errors:
+        print(f"{len(errors)} polls failed")
+    return end_usage[0] - start_usage[0], end_usage[1] - start_usage[1], latencies
+
+
+async def run(args, url, pid):
+    limits = httpx.Limits(max_connections=max(args.subscribers) + 10, max_keepalive_connections=max(args.subscribers) + 10)
+    timeout = httpx.Timeout(60, read=None)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=timeout) as client:
+        headers, cluster_id = await prepare(client)
+        print(f"{'clients':>8} {'mode':<7} {'worker MiB':>11} {'cpu s/s':>8} {'to running p50 (ms)':>20} {'p95 (ms)':>9}")
+        for count in args.subscribers:
+            for mode in ("stream", "poll"):
+                if mode == "stream":
+                    memory, cpu, latencies = await streams(client, headers, cluster_id, count, args.duration, pid, args.samples)
+                else:
+                    memory, cpu, latencies = await pollers(client, headers, cluster_id, count, args.duration,
+                                                           args.poll_interval, pid, args.samples)
+                latencies.sort()
+                p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+                print(f"{count:>8} {mode:<7} {memory:>+11.1f} {cpu / args.duration:>8.3f} "
+                      f"{statistics.median(latencies) * 1000:>20.1f} {p95 * 1000:>9.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--duration", type=float, default=10, help="seconds of idle streams, or of polling")
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--samples", type=int, default=20, help="submissions timed per mode")
+    args = parser.parse_args()
+
+    process, url = spawn_worker()
+    try:
+        asyncio.run(run(args, url, process.pid))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    main()
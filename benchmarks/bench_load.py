@@ -0,0 +1,297 @@
+"""
+HTTP load driver: virtual users send a mix of logins, signups, cluster
+listings, deployment submissions and status polls, at increasing concurrency,
+to find where a single API worker saturates.
+
+    python -m benchmarks.bench_load                       # spawns one uvicorn worker
+    python -m benchmarks.bench_load --in-process          # app.main:app through httpx's ASGI transport
+    python -m benchmarks.bench_load --url http://localhost:8000
+    python -m benchmarks.bench_load --concurrency 1 4 16 64 --duration 10 \\
+        --mix login=1,register=1,clusters=4,submit=2,poll=8 --output load.json
+
+The spawned worker runs app.main:app on a throwaway sqlite database with the
+in-memory queue (QUEUE_BACKEND=memory), so no Postgres or Redis is needed;
+BCRYPT_ROUNDS and the other settings come from the environment as usual.
+In-process, requests skip the network and the HTTP parsing and the startup
+event (the embedded scheduler) doesn't run. Every target is prepared through
+the API itself: an organization, --users users in it, --clusters clusters.
+
+Each step runs `concurrency` users for --duration seconds, each sending its
+next request as soon as the previous one is answered. Reported per step:
+throughput and p50/p95/p99 per endpoint, and errors (non-2xx). The
+saturation point is the first step that doesn't add --saturation more
+throughput than the best one before it. The driver shares the machine with
+a spawned worker: compare runs on the same machine, or point --url at a
+worker elsewhere for absolute numbers.
+"""
+from datetime import datetime, timezone
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_load_")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmpdir}/bench.db")
+os.environ.setdefault("QUEUE_BACKEND", "memory")
+
+import httpx  # noqa: E402
+
+DEFAULT_MIX = "login=1,register=1,clusters=4,submit=2,poll=8"
+PASSWORD = "load-test-password"
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise SystemExit(f"Unknown operation {name!r} in --mix, expected some of {', '.join(OPERATIONS)}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class User:
+    def __init__(self, username, token):
+        self.username = username
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.deployments = []
+
+
+class Load:
+    """The target's state shared by the virtual users, and the recorded latencies."""
+
+    def __init__(self, client, invite_code, clusters, rng):
+        self.client = client
+        self.invite_code = invite_code
+        self.clusters = clusters
+        self.rng = rng
+        self.latencies = {}
+        self.errors = {}
+
+    async def request(self, endpoint, method, url, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+            return None
+        self.latencies.setdefault(endpoint, []).append(time.perf_counter() - start)
+        if response.status_code >= 300:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+        return response
+
+    async def sign_up(self, username):
+        """Register, log in and join the organization; the new User, or None."""
+        await self.request("POST /register", "POST", "/register", json={"username": username, "password": PASSWORD})
+        response = await self.request("POST /token", "POST", "/token", data={"username": username, "password": PASSWORD})
+        if response is None or response.status_code != 200:
+            return None
+        user = User(username, response.json()["access_token"])
+        await self.request("POST /join-organization", "POST", f"/join-organization?invite_code={self.invite_code}",
+                           headers=user.headers)
+        return user
+
+
+async def login(load, user):
+    await load.request("POST /token", "POST", "/token", data={"username": user.username, "password": PASSWORD})
+
+
+async def register(load, user):
+    await load.sign_up(f"load-{uuid.uuid4().hex[:12]}")
+
+
+async def list_clusters(load, user):
+    await load.request("GET /clusters", "GET", "/clusters", headers=user.headers)
+
+
+async def submit(load, user):
+    response = await load.request("POST /deployments", "POST", "/deployments", headers=user.headers, json={
+        "cluster_id": load.rng.choice(load.clusters), "docker_image": "load:latest",
+        "required_ram": load.rng.choice([256, 512, 1024]), "required_cpu": 1, "required_gpu": 0,
+        "priority": load.rng.randint(1, 5),
+    })
+    if response is not None and response.status_code == 200:
+        user.deployments.append(response.json()["id"])
+
+
+async def poll(load, user):
+    if not user.deployments:
+        return await submit(load, user)
+    deployment_id = load.rng.choice(user.deployments[-20:])
+    await load.request("GET /deployments/{id}", "GET", f"/deployments/{deployment_id}", headers=user.headers)
+
+
+OPERATIONS = {"login": login, "register": register, "clusters": list_clusters, "submit": submit, "poll": poll}
+
+
+async def prepare(client, users, clusters, rng):
+    run = uuid.uuid4().hex[:8]
+    invite_code = f"LOAD-{run}"
+    response = await client.post("/create-organization", json={"name": f"load-{run}", "invite_code": invite_code})
+    response.raise_for_status()
+    load = Load(client, invite_code, [], rng)
+    prepared = await asyncio.gather(*(load.sign_up(f"load-{run}-{i}") for i in range(users)))
+    if None in prepared:
+        raise SystemExit("Could not sign up the load test users")
+    for i in range(clusters):
+        response = await client.post("/clusters", headers=prepared[0].headers, json={
+            "name": f"load-{run}-{i}", "total_ram": 1024 * 1024, "total_cpu": 1024, "total_gpu": 0,
+        })
+        response.raise_for_status()
+        load.clusters.append(response.json()["id"])
+    return load, prepared
+
+
+async def run_step(load, users, concurrency, duration, mix):
+    load.latencies, load.errors = {}, {}
+    names, weights = list(mix), list(mix.values())
+    deadline = time.perf_counter() + duration
+
+    async def virtual_user(user):
+        while time.perf_counter() < deadline:
+            await OPERATIONS[load.rng.choices(names, weights)[0]](load, user)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(virtual_user(users[i % len(users)]) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    endpoints = {
+        endpoint: {
+            "requests": len(latencies),
+            "errors": load.errors.get(endpoint, 0),
+            "throughput": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+        }
+        for endpoint, latencies in sorted(load.latencies.items())
+    }
+    total = sum(len(latencies) for latencies in load.latencies.values())
+    return {"concurrency": concurrency, "seconds": elapsed, "throughput": total / elapsed,
+            "errors": sum(load.errors.values()), "endpoints": endpoints}
+
+
+def saturation_point(steps, gain):
+    """The concurrency of the first step that didn't gain enough (None if every step did), and the best step."""
+    best = None
+    for step in steps:
+        if best is not None and step["throughput"] < best["throughput"] * (1 + gain):
+            return step["concurrency"], best
+        if best is None or step["throughput"] > best["throughput"]:
+            best = step
+    return None, best
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def spawn_worker():
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", "1", "--log-level", "warning"],
+        stdout=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise SystemExit("The API worker exited during startup")
+        try:
+            httpx.get(f"{url}/metrics", timeout=1)
+            return process, url
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    process.terminate()
+    raise SystemExit("The API worker didn't come up within 30s")
+
+
+async def run(args, target, transport=None):
+    mix = parse_mix(args.mix)
+    concurrency = max(args.concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=target, transport=transport, limits=limits, timeout=args.timeout) as client:
+        load, users = await prepare(client, args.users or concurrency, args.clusters, random.Random(args.seed))
+        steps = []
+        print(f"{'concurrency':>11} {'endpoint':<26} {'req/s':>8} {'p50 (ms)':>9} {'p95 (ms)':>9} {'p99 (ms)':>9} {'errors':>7}")
+        for step_concurrency in args.concurrency:
+            step = await run_step(load, users, step_concurrency, args.duration, mix)
+            steps.append(step)
+            for endpoint, stats in step["endpoints"].items():
+                print(f"{step_concurrency:>11} {endpoint:<26} {stats['throughput']:>8.1f} {stats['p50_ms']:>9.1f} "
+                      f"{stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} {stats['errors']:>7}")
+            print(f"{step_concurrency:>11} {'total':<26} {step['throughput']:>8.1f} {'':>9} {'':>9} {'':>9} {step['errors']:>7}")
+    return steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="load an API that is already running")
+    parser.add_argument("--in-process", action="store_true", help="app.main:app through httpx's ASGI transport")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64], help="virtual users per step")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per step")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"operation weights (default {DEFAULT_MIX})")
+    parser.add_argument("--users", type=int, help="users signed up beforehand (default: the highest concurrency)")
+    parser.add_argument("--clusters", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=30, help="per request, seconds")
+    parser.add_argument("--saturation", type=float, default=0.05, help="throughput gain below which a step saturates")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    process = None
+    if args.url:
+        target, transport, mode = args.url, None, "url"
+    elif args.in_process:
+        from app import database
+        from app.main import app
+        # The ASGI transport doesn't run the startup event that creates the tables
+        asyncio.run(database.create_schema())
+        target, transport, mode = "http://bench", httpx.ASGITransport(app=app), "in-process"
+    else:
+        process, target = spawn_worker()
+        transport, mode = None, "uvicorn"
+    try:
+        steps = asyncio.run(run(args, target, transport))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    concurrency, best = saturation_point(steps, args.saturation)
+    if concurrency is None:
+        print(f"\nNot saturated up to {steps[-1]['concurrency']} users, {best['throughput']:.1f} req/s")
+    else:
+        print(f"\nSaturated at {concurrency} users, best {best['throughput']:.1f} req/s with {best['concurrency']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({
+                "timestamp": datetime.now(timezone.utc).isoformat(),
+                "target": args.url or mode,
+                "mix": parse_mix(args.mix),
+                "duration": args.duration,
+                "saturated_at": concurrency,
+                "max_throughput": best["throughput"],
+                "steps": steps,
+            }, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
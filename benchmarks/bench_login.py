@@ -0,0 +1,102 @@
+"""
+/token throughput, and /clusters latency while logins are running.
+
+    python -m benchmarks.bench_login --concurrency 32 --duration 5
+    python -m benchmarks.bench_login --inline    # bcrypt on the event loop, for comparison
+
+Requests go to the app in-process through httpx's ASGI transport. BCRYPT_ROUNDS
+and PASSWORD_HASH_WORKERS are read from the environment as usual.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_login_")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/bench.db"
+
+import httpx  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+
+from app import auth, models  # noqa: E402
+from app.database import Base, engine  # noqa: E402
+from app.main import app  # noqa: E402
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def seed(users):
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    hashed = auth.get_password_hash("password")
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [
+            {"id": i, "username": f"user{i}", "hashed_password": hashed} for i in range(1, users + 1)
+        ])
+        conn.execute(insert(models.Organization), [{"id": 1, "name": "bench", "invite_code": "BENCH"}])
+        conn.execute(insert(models.UserOrganization), [{"user_id": 1, "organization_id": 1}])
+        conn.execute(insert(models.Cluster), [{
+            "id": 1, "organization_id": 1, "name": "bench", "total_ram": 1024, "total_cpu": 8, "total_gpu": 0,
+            "available_ram": 1024, "available_cpu": 8, "available_gpu": 0,
+        }])
+
+
+async def run(concurrency, duration, users):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        headers = {"Authorization": f"Bearer {auth.create_access_token({'sub': 'user1'})}"}
+        deadline = time.perf_counter() + duration
+        logins = []
+        reads = []
+
+        async def login(worker):
+            i = worker
+            while time.perf_counter() < deadline:
+                data = {"username": f"user{i % users + 1}", "password": "password"}
+                start = time.perf_counter()
+                response = await client.post("/token", data=data)
+                logins.append(time.perf_counter() - start)
+                assert response.status_code == 200, response.text
+                i += concurrency
+
+        async def read():
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                response = await client.get("/clusters", headers=headers)
+                reads.append(time.perf_counter() - start)
+                assert response.status_code == 200, response.text
+                await asyncio.sleep(0.01)
+
+        await asyncio.gather(read(), *(login(worker) for worker in range(concurrency)))
+    return logins, reads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent logins")
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--inline", action="store_true", help="hash on the event loop instead of the pool")
+    args = parser.parse_args()
+
+    if args.inline:
+        async def inline(fn, *fn_args):
+            return fn(*fn_args)
+        auth._in_hash_pool = inline
+
+    seed(args.users)
+    logins, reads = asyncio.run(run(args.concurrency, args.duration, args.users))
+    mode = "inline" if args.inline else f"pool of {auth.PASSWORD_HASH_WORKERS}"
+    print(f"bcrypt rounds {auth.BCRYPT_ROUNDS}, hashing {mode}, {args.concurrency} concurrent logins")
+    print(f"/token    {len(logins) / args.duration:8.1f} logins/s  p50 {percentile(logins, 50) * 1000:7.1f}ms"
+          f"  p99 {percentile(logins, 99) * 1000:7.1f}ms")
+    print(f"/clusters {len(reads):8d} requests   p50 {percentile(reads, 50) * 1000:7.1f}ms"
+          f"  p99 {percentile(reads, 99) * 1000:7.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Cost of the /metrics instrumentation: what one recording costs, and what it
+adds to an HTTP request, a database query and a Redis round trip compared to
+the same thing uninstrumented.
+
+    python -m benchmarks.bench_metrics --requests 2000 --queries 5000
+
+HTTP requests go in-process through httpx's ASGI transport to a one-route
+app, queries to an in-memory sqlite database through aiosqlite, Redis
+commands to fakeredis (skipped if it isn't installed). Instrumented and
+plain runs alternate, the medians of the rounds are reported.
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_metrics_")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/bench.db"
+
+import httpx  # noqa: E402
+import redis.asyncio as aioredis  # noqa: E402
+from fastapi import APIRouter, FastAPI  # noqa: E402
+from sqlalchemy import text  # noqa: E402
+from sqlalchemy.ext.asyncio import create_async_engine  # noqa: E402
+
+from app import metrics  # noqa: E402
+from app.database import InstrumentedRedis, instrument_engine  # noqa: E402
+
+ROUNDS = 5
+
+
+def per_call(fn, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n
+
+
+def recording(n):
+    histogram = metrics.Histogram(metrics.FAST_BUCKETS)
+    return {
+        "Histogram.observe": per_call(lambda: histogram.observe(0.003), n),
+        "labels().observe": per_call(lambda: metrics.db_query_duration.labels("SELECT").observe(0.003), n),
+        "labels().inc": per_call(lambda: metrics.http_requests.labels("cluster", "GET", "2xx").inc(), n),
+        "observe_query": per_call(lambda: metrics.observe_query("SELECT clusters.id FROM clusters", 0.003), n),
+    }
+
+
+def make_app(instrumented):
+    app = FastAPI()
+    router = APIRouter()
+
+    @router.get("/ping")
+    async def ping():
+        return {"ok": True}
+
+    app.include_router(router)
+    if instrumented:
+        app.add_middleware(metrics.HTTPMetricsMiddleware)
+    return app
+
+
+async def http_round(app, n):
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as client:
+        await client.get("/ping")
+        start = time.perf_counter()
+        for _ in range(n):
+            await client.get("/ping")
+        return (time.perf_counter() - start) / n
+
+
+async def db_round(engine, n):
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+        start = time.perf_counter()
+        for _ in range(n):
+            (await conn.execute(text("SELECT 1"))).scalar()
+        return (time.perf_counter() - start) / n
+
+
+async def redis_round(client, n):
+    await client.set("key", "value")
+    start = time.perf_counter()
+    for _ in range(n):
+        await client.get("key")
+    return (time.perf_counter() - start) / n
+
+
+async def compare(plain, instrumented):
+    """Alternating rounds of both, (median plain, median instrumented) seconds per operation."""
+    timings = ([], [])
+    for _ in range(ROUNDS):
+        timings[0].append(await plain())
+        timings[1].append(await instrumented())
+    return statistics.median(timings[0]), statistics.median(timings[1])
+
+
+async def overheads(args):
+    apps = make_app(False), make_app(True)
+    # The async engine and driver the app uses
+    engines = create_async_engine("sqlite+aiosqlite://"), create_async_engine("sqlite+aiosqlite://")
+    instrument_engine(engines[1].sync_engine)
+    results = {
+        "HTTP request": await compare(lambda: http_round(apps[0], args.requests), lambda: http_round(apps[1], args.requests)),
+        "sqlite query": await compare(lambda: db_round(engines[0], args.queries), lambda: db_round(engines[1], args.queries)),
+    }
+    try:
+        import fakeredis
+    except ImportError:
+        print("fakeredis is not installed, skipping Redis")
+    else:
+        server = fakeredis.FakeServer()
+        clients = [
+            cls(connection_pool=aioredis.ConnectionPool(connection_class=fakeredis.aioredis.FakeConnection, server=server))
+            for cls in (aioredis.Redis, InstrumentedRedis)
+        ]
+        results["Redis GET"] = await compare(lambda: redis_round(clients[0], args.queries),
+                                             lambda: redis_round(clients[1], args.queries))
+    for engine in engines:
+        await engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=2000, help="HTTP requests per round")
+    parser.add_argument("--queries", type=int, default=5000, help="queries and Redis commands per round")
+    parser.add_argument("--calls", type=int, default=200000, help="recordings per recording benchmark")
+    args = parser.parse_args()
+
+    print(f"{'recording':<20} {'ns':>8}")
+    for name, seconds in recording(args.calls).items():
+        print(f"{name:<20} {seconds * 1e9:>8.0f}")
+
+    results = asyncio.run(overheads(args))
+    print(f"\n{'operation':<14} {'plain (us)':>11} {'instrumented (us)':>18} {'overhead (us)':>14} {'overhead':>9}")
+    for name, (plain, instrumented) in results.items():
+        print(f"{name:<14} {plain * 1e6:>11.2f} {instrumented * 1e6:>18.2f} {(instrumented - plain) * 1e6:>14.2f} "
+              f"{(instrumented - plain) / plain:>9.1%}")
+
+    # A scrape with 1000 clusters' gauges on top of the histograms recorded above
+    for cluster_id in range(1000):
+        metrics.queue_depth.labels(cluster_id).set(cluster_id)
+        for resource in ("ram", "cpu", "gpu"):
+            metrics.cluster_utilization.labels(cluster_id, resource).set(0.5)
+    start = time.perf_counter()
+    body = metrics.render()
+    print(f"\nrender with 1000 clusters: {(time.perf_counter() - start) * 1000:.1f} ms, {len(body) / 1024:.0f} KiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Compare placement strategies: time per cluster pass and packing efficiency.
+
+    python -m benchmarks.bench_placement --candidates 50000
+    python -m benchmarks.bench_placement --live
+
+The default run uses a synthetic pending set on one cluster. --live reads the
+current queue shards and clusters (DATABASE_URL, Redis) and evaluates each
+strategy on every cluster without writing anything back.
+"""
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from app.placement import STRATEGIES
+
+
+def synthetic(candidates, seed):
+    rng = np.random.default_rng(seed)
+    demands = np.column_stack([
+        rng.choice([512, 1024, 2048, 4096, 16384], candidates, p=[0.3, 0.3, 0.2, 0.15, 0.05]),
+        rng.choice([1, 2, 4, 8], candidates, p=[0.4, 0.3, 0.2, 0.1]),
+        rng.choice([0, 1, 2], candidates, p=[0.8, 0.15, 0.05]),
+    ])
+    priorities = rng.integers(1, 6, candidates)
+    total = np.array([2 * 1024 * 1024, 1024, 64])
+    return [(demands, priorities, total, total)]
+
+
+async def live():
+    from app import queues, scheduler
+    from app.database import AsyncSessionLocal
+
+    clusters = []
+    async with AsyncSessionLocal() as db:
+        for cluster_id in await queues.backend.clusters():
+            scores = dict(await queues.backend.peek(cluster_id))
+            cluster = await scheduler._load_cluster(db, cluster_id)
+            group = [r for r in await scheduler._load_queued(db, cluster_id, list(scores)) if r.status == "pending"]
+            if cluster is None or not group:
+                continue
+            clusters.append((
+                np.array([(r.required_ram, r.required_cpu, r.required_gpu) for r in group], dtype=np.int64),
+                np.array([scores[r.id] for r in group]),
+                np.array([cluster.available_ram, cluster.available_cpu, cluster.available_gpu]),
+                np.array([cluster.total_ram, cluster.total_cpu, cluster.total_gpu]),
+            ))
+    return clusters
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--candidates", type=int, default=50000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--live", action="store_true")
+    args = parser.parse_args()
+
+    clusters = asyncio.run(live()) if args.live else synthetic(args.candidates, args.seed)
+    candidates = sum(len(c[0]) for c in clusters)
+    print(f"{len(clusters)} clusters, {candidates} pending deployments")
+    print(f"{'strategy':>20} {'time (ms)':>10} {'placed':>8} {'efficiency':>11}")
+    for name, strategy in STRATEGIES.items():
+        placed = 0
+        efficiency = []
+        start = time.perf_counter()
+        for demands, priorities, available, total in clusters:
+            _, _, report = strategy.place(demands, priorities, available, total)
+            placed += report.placed
+            efficiency.append(report.efficiency)
+        elapsed = (time.perf_counter() - start) * 1000
+        mean = sum(efficiency) / len(efficiency) if efficiency else 0.0
+        print(f"{name:>20} {elapsed:10.2f} {placed:>8} {mean:11.2%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""
+Scheduling latency per priority on a saturated cluster, with and without
+preemption, and the victim search time against the number of running
+deployments.
+
+    python -m benchmarks.bench_preemption --rate 50 --duration 10
+
+The cluster starts full of priority 5 deployments. Submissions of random
+priority (1 to 5) arrive at a fixed rate and running deployments complete at
+a lower one, so the cluster stays oversubscribed. Runs the scheduler's event
+loop in this process on an in-memory queue and a throwaway sqlite database.
+"""
+from datetime import datetime, timezone
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_preemption_")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/bench.db"
+# Status events and resource versions in this process, a pass doesn't wait on a Redis that isn't there
+os.environ.setdefault("EVENT_BACKEND", "memory")
+os.environ.setdefault("VERSION_BACKEND", "memory")
+
+import numpy as np  # noqa: E402
+from sqlalchemy import func, insert, select, update  # noqa: E402
+
+from app import metrics, models, queues, scheduler  # noqa: E402
+from app.database import AsyncSessionLocal, Base, engine  # noqa: E402
+from app.placement import find_victims  # noqa: E402
+
+CAPACITY = 100
+
+
+def seed():
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(insert(models.Cluster), [{
+            "id": 1, "organization_id": None, "name": "bench", "total_ram": CAPACITY, "total_cpu": CAPACITY,
+            "total_gpu": 0, "available_ram": 0, "available_cpu": 0, "available_gpu": 0,
+        }])
+        conn.execute(insert(models.Deployment), [{
+            "id": i, "cluster_id": 1, "docker_image": "bench:latest", "required_ram": 1, "required_cpu": 1,
+            "required_gpu": 0, "priority": 5, "status": "running",
+        } for i in range(1, CAPACITY + 1)])
+
+
+async def complete_one(rng):
+    async with AsyncSessionLocal() as db:
+        running = (await db.execute(
+            select(models.Deployment.id).where(models.Deployment.status == "running")
+        )).scalars().all()
+        if not running:
+            return
+        done = rng.choice(running)
+        if (await db.execute(
+            update(models.Deployment).where(models.Deployment.id == done, models.Deployment.status == "running")
+            .values(status="completed")
+        )).rowcount:
+            await db.execute(update(models.Cluster).where(models.Cluster.id == 1).values(
+                available_ram=models.Cluster.available_ram + 1, available_cpu=models.Cluster.available_cpu + 1,
+            ))
+        await db.commit()
+    scheduler.notify_scheduler(1)
+
+
+async def run(rate, completion_rate, duration, seed_value):
+    rng = random.Random(seed_value)
+    task = asyncio.create_task(scheduler.run_event_loop())
+    next_id = CAPACITY + 1
+    start = time.perf_counter()
+    next_completion = start
+    while time.perf_counter() - start < duration:
+        priority = rng.randint(1, 5)
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(models.Deployment), [{
+                "id": next_id, "cluster_id": 1, "docker_image": "bench:latest", "required_ram": 1,
+                "required_cpu": 1, "required_gpu": 0, "priority": priority, "status": "pending",
+                # sqlite's CURRENT_TIMESTAMP only has whole seconds
+                "created_at": datetime.now(timezone.utc),
+            }])
+            await db.commit()
+        await queues.backend.enqueue({1: {next_id: priority}})
+        scheduler.notify_scheduler(1)
+        next_id += 1
+        if time.perf_counter() >= next_completion:
+            await complete_one(rng)
+            next_completion += 1 / completion_rate
+        await asyncio.sleep(1 / rate)
+    await asyncio.sleep(0.5)
+    task.cancel()
+
+    async with AsyncSessionLocal() as db:
+        waiting = dict((await db.execute(
+            select(models.Deployment.priority, func.count())
+            .where(models.Deployment.status == "pending").group_by(models.Deployment.priority)
+        )).all())
+    return waiting
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=50, help="submissions per second")
+    parser.add_argument("--completion-rate", type=float, default=10, help="completions per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    args = parser.parse_args()
+
+    for preemption in (False, True):
+        seed()
+        metrics.reset()
+        queues.backend = queues.MemoryQueue()
+        scheduler.SCHEDULER_PREEMPTION = preemption
+        waiting = asyncio.run(run(args.rate, args.completion_rate, args.duration, 1))
+        stats = metrics.scheduler_stats()
+        print(f"\npreemption {'on' if preemption else 'off'}: {stats['preemptions']} preemptions, {stats['evictions']} evictions")
+        print(f"{'priority':>8} {'scheduled':>10} {'p50 (ms)':>9} {'p99 (ms)':>9} {'waiting':>8}")
+        for priority in range(1, 6):
+            latency = stats["latency_by_priority"].get(priority, metrics.Histogram().summary())
+            p50, p99 = (f"{v * 1000:.0f}" if v is not None else "-" for v in (latency["p50"], latency["p99"]))
+            print(f"{priority:>8} {latency['count']:>10} {p50:>9} {p99:>9} {waiting.get(priority, 0):>8}")
+
+    print(f"\n{'running':>8} {'victim search p50 (ms)':>23} {'max (ms)':>9}")
+    rng = np.random.default_rng(5)
+    for size in (1000, 5000, 20000):
+        running = np.column_stack([rng.integers(256, 4096, size), rng.integers(1, 8, size), rng.integers(0, 2, size)])
+        priorities = rng.integers(1, 6, size)
+        timings = []
+        for _ in range(50):
+            start = time.perf_counter()
+            find_victims((64 * 1024, 32, 4), (0, 0, 0), running, priorities, 1)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        print(f"{size:>8} {timings[len(timings) // 2] * 1000:>23.2f} {timings[-1] * 1000:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Throughput of the queue backends' bulk operations.
+
+    python -m benchmarks.bench_queues --clusters 4 --entries 5000
+
+Each cycle enqueues --entries deployments on each of --clusters shards,
+peeks every shard, removes half of it and dequeues the rest. Reported per
+backend: queue operations (one per entry enqueued, removed or dequeued) per
+second, over --repeat cycles. --queue fakeredis runs the Redis queue code on
+fakeredis (in process, so round trips cost a function call, not a network
+hop); a per-entry round trip would show up as a rate orders of magnitude
+lower.
+"""
+import argparse
+import asyncio
+import time
+
+from app import queues
+
+
+def create_queue(kind):
+    if kind == "memory":
+        return queues.MemoryQueue()
+    import fakeredis
+    return queues.RedisQueue(fakeredis.FakeAsyncRedis())
+
+
+async def cycle(backend, clusters, entries):
+    queued = {cluster_id: {cluster_id * 1000000 + i: i % 5 for i in range(entries)} for cluster_id in range(1, clusters + 1)}
+    start = time.perf_counter()
+    await backend.enqueue(queued)
+    for cluster_id in await backend.clusters():
+        head = (await backend.peek(cluster_id))[:entries // 2]
+        await backend.remove(cluster_id, [deployment_id for deployment_id, _ in head])
+        await backend.dequeue_batch(cluster_id)
+    elapsed = time.perf_counter() - start
+    assert await backend.clusters() == []
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clusters", type=int, default=4)
+    parser.add_argument("--entries", type=int, default=5000, help="entries per cluster and cycle")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--queue", choices=["memory", "fakeredis"], nargs="+", default=["memory", "fakeredis"])
+    args = parser.parse_args()
+
+    print(f"{'queue':<10} {'ops/s':>10} {'cycle (ms)':>11}")
+    for kind in args.queue:
+        backend = create_queue(kind)
+        seconds = min(asyncio.run(cycle(backend, args.clusters, args.entries)) for _ in range(args.repeat))
+        ops = args.clusters * args.entries * 2
+        print(f"{kind:<10} {ops / seconds:>10.0f} {seconds * 1000:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Time of a queue reconciliation against the size of the deployments table.
+
+    python -m benchmarks.bench_reconcile --rows 100000 1000000 --pending 0.2
+
+For each size, --rows deployments over --clusters clusters, a --pending
+share of them pending, are written to a throwaway sqlite database and the
+pending ones queued. Then the queue is damaged: --lost of the pending
+entries are removed, as many entries of finished deployments are added, and
+reconcile() is timed and checked to have repaired exactly that.
+
+--queue fakeredis runs the Redis queue code on fakeredis (in process, so
+round trips cost a function call, not a network hop).
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_reconcile_")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/bench.db"
+
+from sqlalchemy import insert  # noqa: E402
+
+from app import models, queues, reconcile  # noqa: E402
+from app.database import Base, engine  # noqa: E402
+
+
+def create_queue(kind):
+    if kind == "memory":
+        return queues.MemoryQueue()
+    import fakeredis
+    return queues.RedisQueue(fakeredis.FakeAsyncRedis())
+
+
+def seed(rows, clusters, pending, rng):
+    """Returns {cluster_id: {deployment_id: priority}} of the pending deployments, and the ids of the others."""
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    queued, finished = {}, []
+    with engine.begin() as conn:
+        conn.execute(insert(models.Organization), [{"id": 1, "name": "bench", "invite_code": "BENCH"}])
+        conn.execute(insert(models.Cluster), [{
+            "id": i, "organization_id": 1, "name": f"bench-{i}", "total_ram": 1, "total_cpu": 1, "total_gpu": 0,
+            "available_ram": 1, "available_cpu": 1, "available_gpu": 0,
+        } for i in range(1, clusters + 1)])
+        for start in range(1, rows + 1, 50000):
+            batch = []
+            for deployment_id in range(start, min(start + 50000, rows + 1)):
+                cluster_id, priority = rng.randint(1, clusters), rng.randint(1, 5)
+                status = "pending" if rng.random() < pending else rng.choice(["running", "completed", "terminated"])
+                if status == "pending":
+                    queued.setdefault(cluster_id, {})[deployment_id] = priority
+                else:
+                    finished.append((cluster_id, deployment_id))
+                batch.append({
+                    "id": deployment_id, "cluster_id": cluster_id, "organization_id": 1, "docker_image": "bench:latest",
+                    "required_ram": 1, "required_cpu": 1, "required_gpu": 0, "priority": priority, "status": status,
+                })
+            conn.execute(insert(models.Deployment), batch)
+    return queued, finished
+
+
+async def damage(queued, finished, lost, rng):
+    await queues.backend.enqueue(queued)
+    pending = [(cluster_id, deployment_id) for cluster_id, scores in queued.items() for deployment_id in scores]
+    removed = rng.sample(pending, int(len(pending) * lost))
+    orphans = rng.sample(finished, min(len(finished), len(removed)))
+    for cluster_id, deployment_id in removed:
+        await queues.backend.remove(cluster_id, [deployment_id])
+    entries = {}
+    for cluster_id, deployment_id in orphans:
+        entries.setdefault(cluster_id, {})[deployment_id] = 1
+    await queues.backend.enqueue(entries)
+    await queues.backend.take_dirty()
+    return len(removed), len(orphans)
+
+
+async def run(args, rows, rng):
+    queued, finished = seed(rows, args.clusters, args.pending, rng)
+    queues.backend = create_queue(args.queue)
+    removed, orphans = await damage(queued, finished, args.lost, rng)
+    start = time.perf_counter()
+    report = await reconcile.reconcile()
+    seconds = time.perf_counter() - start
+    assert (report["requeued"], report["removed"]) == (removed, orphans), report
+    return report["pending"], removed, orphans, seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[100000, 1000000])
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--pending", type=float, default=0.2, help="share of the rows that are pending")
+    parser.add_argument("--lost", type=float, default=0.01, help="share of the queue entries damaged")
+    parser.add_argument("--queue", choices=["memory", "fakeredis"], default="memory")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"{'rows':>9} {'pending':>9} {'requeued':>9} {'removed':>8} {'seconds':>8} {'pending rows/s':>15}")
+    for rows in args.rows:
+        pending, removed, orphans, seconds = asyncio.run(run(args, rows, random.Random(args.seed)))
+        print(f"{rows:>9} {pending:>9} {removed:>9} {orphans:>8} {seconds:>8.2f} {pending / seconds:>15.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Several scheduler replicas, each in its own process, draining one shared
+queue: throughput against the number of replicas, and a check that no
+cluster was allocated past its capacity.
+
+    python -m benchmarks.bench_replicas --replicas 1 2 4 --queue 50000
+
+Uses DATABASE_URL when set (point it at postgres to see the row locks at
+work), a throwaway sqlite database otherwise; sqlite serializes every write,
+so replicas there only show correctness, not speedup. Flushes the Redis db it
+is pointed at; --fake-redis serves one over TCP from this process instead
+(needs the fakeredis package).
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_replicas_")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmpdir}/bench.db")
+# Status events and resource versions in this process, a pass doesn't wait on a Redis that isn't there
+os.environ.setdefault("EVENT_BACKEND", "memory")
+os.environ.setdefault("VERSION_BACKEND", "memory")
+
+import redis  # noqa: E402
+from sqlalchemy import func, insert, select  # noqa: E402
+
+from app import models, queues  # noqa: E402
+from app.database import REDIS_DB, REDIS_HOST, REDIS_PORT, Base, engine  # noqa: E402
+
+
+def seed(size, clusters, redis_client, rng):
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    redis_client.flushdb()
+    # Roughly half of the queue fits, so the capacity checks are exercised
+    ram = size * 2048 // clusters // 2
+    with engine.begin() as conn:
+        conn.execute(insert(models.Cluster), [
+            {
+                "id": cluster_id, "organization_id": None, "name": f"cluster-{cluster_id}",
+                "total_ram": ram, "total_cpu": ram, "total_gpu": ram,
+                "available_ram": ram, "available_cpu": ram, "available_gpu": ram,
+            }
+            for cluster_id in range(1, clusters + 1)
+        ])
+        deployments = [
+            {
+                "id": deployment_id, "cluster_id": rng.randint(1, clusters), "docker_image": "bench:latest",
+                "required_ram": rng.choice([1024, 2048, 3072]), "required_cpu": 1, "required_gpu": 0,
+                "priority": rng.randint(1, 5), "status": "pending",
+            }
+            for deployment_id in range(1, size + 1)
+        ]
+        conn.execute(insert(models.Deployment), deployments)
+    pipe = redis_client.pipeline(transaction=False)
+    for d in deployments:
+        pipe.zadd(queues.queue_key(d["cluster_id"]), {d["id"]: d["priority"]})
+        pipe.sadd(queues.SHARDS_KEY, d["cluster_id"])
+    pipe.execute()
+
+
+def replica(start):
+    from app import scheduler
+
+    async def drain():
+        # Pass after pass, until a pass leaves the queue as it found it
+        previous = None
+        while True:
+            await scheduler.schedule_deployments()
+            queued = 0
+            for cluster_id in await queues.backend.clusters():
+                queued += await queues.backend.size(cluster_id)
+            if queued == previous:
+                return
+            previous = queued
+
+    start.wait()
+    asyncio.run(drain())
+
+
+def check():
+    with engine.connect() as conn:
+        used = dict(conn.execute(
+            select(models.Deployment.cluster_id, func.sum(models.Deployment.required_ram))
+            .where(models.Deployment.status == "running")
+            .group_by(models.Deployment.cluster_id)
+        ).all())
+        placed = conn.execute(select(func.count()).where(models.Deployment.status == "running")).scalar()
+        overallocated = [
+            cluster.id
+            for cluster in conn.execute(select(models.Cluster)).all()
+            if cluster.available_ram < 0 or cluster.total_ram - cluster.available_ram != used.get(cluster.id, 0)
+        ]
+    return placed, overallocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replicas", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--queue", type=int, default=20000)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--fake-redis", action="store_true")
+    args = parser.parse_args()
+
+    host, port = REDIS_HOST, REDIS_PORT
+    if args.fake_redis:
+        from fakeredis import TcpFakeServer
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            host, port = s.getsockname()
+        server = TcpFakeServer((host, port), server_type="redis")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        # The replicas read these when they import app.database
+        os.environ["REDIS_HOST"], os.environ["REDIS_PORT"] = host, str(port)
+    redis_client = redis.Redis(host=host, port=port, db=REDIS_DB)
+
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'replicas':>8} {'placed':>7} {'time (s)':>9} {'placed/s':>9} {'speedup':>8} {'over-allocated':>15}")
+    baseline = None
+    for count in args.replicas:
+        seed(args.queue, args.clusters, redis_client, random.Random(args.queue))
+        start = ctx.Event()
+        processes = [ctx.Process(target=replica, args=(start,)) for _ in range(count)]
+        for process in processes:
+            process.start()
+        # Imports take a while, only the scheduling is timed
+        time.sleep(3)
+        began = time.perf_counter()
+        start.set()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - began
+        placed, overallocated = check()
+        rate = placed / elapsed
+        baseline = baseline or rate
+        print(f"{count:>8} {placed:>7} {elapsed:>9.2f} {rate:>9.0f} {rate / baseline:>7.2f}x {len(overallocated):>15}")
+
+
+if __name__ == "__main__":
+    main()
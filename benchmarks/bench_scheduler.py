@@ -0,0 +1,125 @@
+"""
+Scheduling pass time against queue size, per-row pass vs batched pass over
+per-cluster queue shards.
+
+    python -m benchmarks.bench_scheduler --sizes 1000 10000 50000
+
+Uses a throwaway sqlite database and flushes the Redis db it is pointed at.
+Pass --fake-redis to run without a Redis server (needs the fakeredis package).
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_scheduler_")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/bench.db"
+# Status events and resource versions in this process, a pass doesn't wait on a Redis that isn't there
+os.environ.setdefault("EVENT_BACKEND", "memory")
+os.environ.setdefault("VERSION_BACKEND", "memory")
+
+from sqlalchemy import insert  # noqa: E402
+
+from app import models, queues, scheduler  # noqa: E402
+from app.database import REDIS_DB, REDIS_HOST, REDIS_PORT, Base, SessionLocal, engine  # noqa: E402
+
+
+def legacy_schedule_deployments(db, redis_client):
+    # The pre-batching pass: two lookups and one zrem per queue entry
+    pending_deployments = redis_client.zrange(queues.QUEUE_KEY, 0, -1, withscores=True)
+    for deployment_id, priority in pending_deployments:
+        deployment = db.query(models.Deployment).filter(models.Deployment.id == int(deployment_id)).first()
+        if not deployment:
+            redis_client.zrem(queues.QUEUE_KEY, deployment_id)
+            continue
+        cluster = db.query(models.Cluster).filter(models.Cluster.id == deployment.cluster_id).first()
+        if not cluster:
+            continue
+        if (cluster.available_ram >= deployment.required_ram and
+            cluster.available_cpu >= deployment.required_cpu and
+            cluster.available_gpu >= deployment.required_gpu):
+            cluster.available_ram -= deployment.required_ram
+            cluster.available_cpu -= deployment.required_cpu
+            cluster.available_gpu -= deployment.required_gpu
+            deployment.status = "running"
+            redis_client.zrem(queues.QUEUE_KEY, deployment_id)
+    db.commit()
+
+
+def seed(size, clusters, redis_client, rng, sharded=True):
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    redis_client.flushdb()
+    with engine.begin() as conn:
+        conn.execute(insert(models.Organization), [{"id": 1, "name": "bench", "invite_code": "BENCH"}])
+        conn.execute(insert(models.Cluster), [
+            {
+                "id": cluster_id, "organization_id": 1, "name": f"cluster-{cluster_id}",
+                "total_ram": 512 * 1024, "total_cpu": 256, "total_gpu": 16,
+                "available_ram": 512 * 1024, "available_cpu": 256, "available_gpu": 16,
+            }
+            for cluster_id in range(1, clusters + 1)
+        ])
+        deployments = [
+            {
+                "id": deployment_id, "cluster_id": rng.randint(1, clusters), "docker_image": "bench:latest",
+                "required_ram": rng.choice([512, 1024, 4096]), "required_cpu": rng.choice([1, 2, 4]),
+                "required_gpu": rng.choice([0, 0, 0, 1]), "priority": rng.randint(1, 5), "status": "pending",
+            }
+            for deployment_id in range(1, size + 1)
+        ]
+        conn.execute(insert(models.Deployment), deployments)
+    pipe = redis_client.pipeline(transaction=False)
+    for d in deployments:
+        if sharded:
+            pipe.zadd(queues.queue_key(d["cluster_id"]), {d["id"]: d["priority"]})
+            pipe.sadd(queues.SHARDS_KEY, d["cluster_id"])
+        else:
+            pipe.zadd(queues.QUEUE_KEY, {d["id"]: d["priority"]})
+    pipe.execute()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 10000, 50000])
+    parser.add_argument("--clusters", type=int, default=50)
+    parser.add_argument("--fake-redis", action="store_true")
+    parser.add_argument("--skip-legacy-above", type=int, default=50000,
+                        help="don't run the per-row pass for queues larger than this")
+    args = parser.parse_args()
+
+    # The per-row pass and the seeding use a sync client on the same data as the scheduler's
+    if args.fake_redis:
+        import fakeredis
+        server = fakeredis.FakeServer()
+        redis_client = fakeredis.FakeRedis(server=server)
+        queues.backend = queues.RedisQueue(fakeredis.FakeAsyncRedis(server=server))
+    else:
+        import redis
+        redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
+
+    print(f"{'queue size':>10} {'per-row (s)':>12} {'batched (s)':>12} {'speedup':>8}")
+    for size in args.sizes:
+        legacy = None
+        if size <= args.skip_legacy_above:
+            seed(size, args.clusters, redis_client, random.Random(size), sharded=False)
+            db = SessionLocal()
+            start = time.perf_counter()
+            legacy_schedule_deployments(db, redis_client)
+            legacy = time.perf_counter() - start
+            db.close()
+
+        seed(size, args.clusters, redis_client, random.Random(size))
+        start = time.perf_counter()
+        asyncio.run(scheduler.schedule_deployments())
+        batched = time.perf_counter() - start
+
+        legacy_col = f"{legacy:12.3f}" if legacy is not None else f"{'-':>12}"
+        speedup = f"{legacy / batched:7.1f}x" if legacy is not None else f"{'-':>8}"
+        print(f"{size:>10} {legacy_col} {batched:12.3f} {speedup}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+"""
+Scheduler benchmark suite on synthetic workloads (see benchmarks/workload.py),
+with results saved as JSON to compare commits.
+
+    python -m benchmarks.bench_suite --scenario smoke many-clusters --output before.json
+    python -m benchmarks.bench_suite --scenario smoke many-clusters --output after.json --compare before.json
+    python -m benchmarks.bench_suite --clusters 3000 --deployments 500000 --cluster-skew 1.2
+
+Each scenario is seeded once into a throwaway sqlite database, then every
+repetition restores that database, fills the queue (in memory, or fakeredis
+with --queue fakeredis) and times one full scheduling pass, followed by a
+second pass over what is left (nothing fits any more, the cost of a pass on
+a saturated system, the full sweep), and an incremental pass after
+--changed of the clusters with queued deployments were marked dirty, as
+releases would. One more repetition runs under tracemalloc for the peak
+memory of a pass, so the timed ones aren't slowed down by it.
+
+Reported per scenario: pass latency (median of the repetitions), placements
+per second, peak memory, and packing efficiency, the mean allocated share
+of the resources of the clusters that still have deployments waiting.
+--compare prints the change against an earlier run and exits with 1 when a
+scenario got slower, placed less per second or used more memory by more
+than --threshold.
+"""
+from datetime import datetime, timezone
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_suite_")
+DB_PATH = f"{_tmpdir}/bench.db"
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_PATH}"
+# Status events and resource versions in this process, a pass doesn't wait on a Redis that isn't there
+os.environ.setdefault("EVENT_BACKEND", "memory")
+os.environ.setdefault("VERSION_BACKEND", "memory")
+
+import numpy as np  # noqa: E402
+from sqlalchemy import func, insert, select  # noqa: E402
+
+from app import models, queues, scheduler  # noqa: E402
+from app.database import AsyncSessionLocal, Base, async_engine, engine  # noqa: E402
+from benchmarks.workload import SCENARIOS, Workload  # noqa: E402
+
+INSERT_CHUNK = 50000
+# Lower is better for these, higher for placements_per_second
+REGRESSION_CHECKS = {"pass_seconds": 1, "placements_per_second": -1, "peak_memory_mib": 1}
+
+
+def seed(data):
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(insert(models.Cluster), [
+            {
+                "id": i + 1, "organization_id": None, "name": f"cluster-{i + 1}",
+                "total_ram": int(ram), "total_cpu": int(cpu), "total_gpu": int(gpu),
+                "available_ram": int(ram), "available_cpu": int(cpu), "available_gpu": int(gpu),
+            }
+            for i, (ram, cpu, gpu) in enumerate(data["capacity"])
+        ])
+        for start in range(0, len(data["cluster_id"]), INSERT_CHUNK):
+            end = start + INSERT_CHUNK
+            conn.execute(insert(models.Deployment), [
+                {
+                    "id": start + i + 1, "cluster_id": int(cluster_id), "docker_image": "bench:latest",
+                    "required_ram": int(ram), "required_cpu": int(cpu), "required_gpu": int(gpu),
+                    "priority": int(priority), "status": "pending",
+                }
+                for i, (cluster_id, (ram, cpu, gpu), priority) in enumerate(zip(
+                    data["cluster_id"][start:end], data["demands"][start:end], data["priority"][start:end],
+                ))
+            ])
+    engine.dispose()
+
+
+def queue_entries(data):
+    entries = {}
+    for deployment_id, (cluster_id, priority) in enumerate(zip(data["cluster_id"].tolist(), data["priority"].tolist()), 1):
+        entries.setdefault(cluster_id, {})[deployment_id] = priority
+    return entries
+
+
+def create_queue(kind):
+    if kind == "memory":
+        return queues.MemoryQueue()
+    import fakeredis
+    return queues.RedisQueue(fakeredis.FakeAsyncRedis())
+
+
+async def outcome():
+    """Deployments placed, and the packing efficiency over the clusters that still have some waiting."""
+    async with AsyncSessionLocal() as db:
+        placed = await db.scalar(select(func.count()).where(models.Deployment.status == "running"))
+        pending = await db.scalar(select(func.count()).where(models.Deployment.status == "pending"))
+        waiting = set((await db.execute(
+            select(models.Deployment.cluster_id).where(models.Deployment.status == "pending").distinct()
+        )).scalars())
+        rows = (await db.execute(select(
+            models.Cluster.id,
+            models.Cluster.total_ram, models.Cluster.total_cpu, models.Cluster.total_gpu,
+            models.Cluster.available_ram, models.Cluster.available_cpu, models.Cluster.available_gpu,
+        ))).all()
+    ids = np.array([row[0] for row in rows])
+    total = np.array([row[1:4] for row in rows], dtype=np.float64).reshape(-1, 3)
+    available = np.array([row[4:7] for row in rows], dtype=np.float64).reshape(-1, 3)
+    # Same definition as PackingReport.efficiency: mean over the dimensions a cluster has
+    has = total > 0
+    used = np.where(has, (total - available) / np.where(has, total, 1), 0.0)
+    efficiency = used.sum(axis=1) / np.maximum(has.sum(axis=1), 1)
+    contended = np.isin(ids, list(waiting))
+    return {
+        "placed": int(placed),
+        "waiting": int(pending),
+        "packing_efficiency": float(efficiency[contended].mean()) if contended.any() else None,
+        "mean_utilization": float(efficiency.mean()) if len(efficiency) else None,
+    }
+
+
+async def run_scenario(entries, queue, repeat, changed):
+    template = f"{_tmpdir}/template.db"
+    shutil.copyfile(DB_PATH, template)
+    pass_seconds, idle_seconds, changed_seconds, peak = [], [], [], None
+    dirty = sorted(entries)[::max(1, round(1 / changed))] if changed else []
+    result = None
+    for i in range(repeat + 1):
+        traced = i == repeat
+        await async_engine.dispose()
+        shutil.copyfile(template, DB_PATH)
+        # Connect once before the pass: concurrent first connections of a disposed
+        # pool deadlock on SQLAlchemy's first-connect mutex
+        async with async_engine.connect():
+            pass
+        queues.backend = create_queue(queue)
+        await queues.backend.enqueue(entries)
+
+        if traced:
+            tracemalloc.start()
+        start = time.perf_counter()
+        await scheduler.schedule_deployments()
+        elapsed = time.perf_counter() - start
+        if traced:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            continue
+        pass_seconds.append(elapsed)
+        if result is None:
+            result = await outcome()
+
+        start = time.perf_counter()
+        await scheduler.schedule_deployments()
+        idle_seconds.append(time.perf_counter() - start)
+
+        await queues.backend.mark_dirty(dirty)
+        start = time.perf_counter()
+        await scheduler.schedule_changed()
+        changed_seconds.append(time.perf_counter() - start)
+
+    median = statistics.median(pass_seconds)
+    return {
+        "pass_seconds": median,
+        "pass_seconds_all": pass_seconds,
+        "idle_pass_seconds": statistics.median(idle_seconds),
+        "changed_clusters": len(dirty),
+        "changed_pass_seconds": statistics.median(changed_seconds),
+        "placements_per_second": result["placed"] / median if median else None,
+        "peak_memory_mib": peak / 2 ** 20,
+        **result,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Print the change of every scenario also in `baseline`, return the regressions."""
+    before = {scenario["name"]: scenario["results"] for scenario in baseline["scenarios"]}
+    regressions = []
+    print(f"\ncompared to {baseline.get('commit') or 'baseline'} ({baseline.get('timestamp', '?')})")
+    print(f"{'scenario':<16} {'metric':<22} {'before':>12} {'after':>12} {'change':>8}")
+    for scenario in results:
+        old = before.get(scenario["name"])
+        if old is None:
+            continue
+        for metric in ("pass_seconds", "idle_pass_seconds", "changed_pass_seconds", "placements_per_second", "peak_memory_mib", "packing_efficiency"):
+            a, b = old.get(metric), scenario["results"].get(metric)
+            if a is None or b is None:
+                continue
+            change = (b - a) / a if a else 0.0
+            flag = ""
+            if metric in REGRESSION_CHECKS and change * REGRESSION_CHECKS[metric] > threshold:
+                flag = " REGRESSION"
+                regressions.append((scenario["name"], metric))
+            print(f"{scenario['name']:<16} {metric:<22} {a:>12.4g} {b:>12.4g} {change:>8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", nargs="+", choices=sorted(SCENARIOS), help="named workloads (default: smoke many-clusters)")
+    parser.add_argument("--clusters", type=int, help="custom workload instead of named ones")
+    parser.add_argument("--deployments", type=int, default=Workload.deployments)
+    parser.add_argument("--cluster-skew", type=float, default=Workload.cluster_skew)
+    parser.add_argument("--resources", choices=["uniform", "skewed"], default=Workload.resources)
+    parser.add_argument("--priorities", choices=["uniform", "skewed"], default=Workload.priorities)
+    parser.add_argument("--seed", type=int, default=Workload.seed)
+    parser.add_argument("--queue", choices=["memory", "fakeredis"], default="memory")
+    parser.add_argument("--repeat", type=int, default=3, help="timed passes per scenario")
+    parser.add_argument("--changed", type=float, default=0.01, help="share of the queued clusters dirty in the incremental pass")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative change counted as a regression")
+    args = parser.parse_args()
+
+    if args.clusters is not None:
+        workloads = {"custom": Workload(
+            clusters=args.clusters, deployments=args.deployments, cluster_skew=args.cluster_skew,
+            resources=args.resources, priorities=args.priorities, seed=args.seed,
+        )}
+    else:
+        workloads = {name: SCENARIOS[name] for name in args.scenario or ["smoke", "many-clusters"]}
+
+    results = []
+    print(f"{'scenario':<16} {'deployments':>11} {'pass (s)':>9} {'idle (s)':>9} {'changed (s)':>11} {'placed/s':>10} "
+          f"{'peak MiB':>9} {'packing':>8} {'placed':>8} {'waiting':>8}")
+    for name, workload in workloads.items():
+        data = workload.generate()
+        seed(data)
+        entries = queue_entries(data)
+        result = asyncio.run(run_scenario(entries, args.queue, args.repeat, args.changed))
+        results.append({"name": name, "workload": workload.config(), "results": result})
+        packing = f"{result['packing_efficiency']:.1%}" if result["packing_efficiency"] is not None else "-"
+        print(f"{name:<16} {workload.deployments:>11} {result['pass_seconds']:>9.3f} {result['idle_pass_seconds']:>9.3f} "
+              f"{result['changed_pass_seconds']:>11.3f} "
+              f"{result['placements_per_second']:>10.0f} {result['peak_memory_mib']:>9.1f} {packing:>8} "
+              f"{result['placed']:>8} {result['waiting']:>8}")
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "queue": args.queue,
+        "repeat": args.repeat,
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.output}")
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
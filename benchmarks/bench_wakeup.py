@@ -0,0 +1,106 @@
+"""
+Submit-to-running latency with event-driven wake-ups.
+
+    python -m benchmarks.bench_wakeup --rate 500 --duration 5 --fake-redis
+
+Submissions are inserted and queued the way POST /deployments does it, at a
+fixed rate, while the scheduler's event loop runs in the same process. The
+interval sweep is not started, so every placement comes from a wake-up.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+_tmpdir = tempfile.mkdtemp(prefix="bench_wakeup_")
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmpdir}/bench.db"
+# Status events and resource versions in this process, a pass doesn't wait on a Redis that isn't there
+os.environ.setdefault("EVENT_BACKEND", "memory")
+os.environ.setdefault("VERSION_BACKEND", "memory")
+
+from sqlalchemy import insert, select  # noqa: E402
+
+from app import models, queues, scheduler  # noqa: E402
+from app.database import AsyncSessionLocal, Base, engine  # noqa: E402
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run(rate, duration):
+    submitted = {}
+    latencies = []
+    schedule_pass = scheduler.schedule_deployments
+
+    async def timed_pass(cluster_ids=None):
+        await schedule_pass(cluster_ids)
+        now = time.perf_counter()
+        async with AsyncSessionLocal() as db:
+            running = (await db.execute(
+                select(models.Deployment.id)
+                .where(models.Deployment.id.in_(list(submitted)), models.Deployment.status == "running")
+            )).scalars().all()
+        for deployment_id in running:
+            latencies.append(now - submitted.pop(deployment_id))
+
+    scheduler.schedule_deployments = timed_pass
+    await queues.backend.dequeue_batch(1)
+    task = asyncio.create_task(scheduler.run_event_loop())
+    await asyncio.sleep(0)
+
+    next_id = 1
+    interval = 1 / rate
+    start = time.perf_counter()
+    while time.perf_counter() - start < duration:
+        async with AsyncSessionLocal() as db:
+            await db.execute(insert(models.Deployment), [{
+                "id": next_id, "cluster_id": 1, "docker_image": "bench:latest", "required_ram": 1,
+                "required_cpu": 1, "required_gpu": 0, "priority": 1, "status": "pending",
+            }])
+            await db.commit()
+        submitted[next_id] = time.perf_counter()
+        await queues.backend.enqueue({1: {next_id: 1}})
+        scheduler.notify_scheduler(1)
+        next_id += 1
+        await asyncio.sleep(interval)
+
+    # Let the last wake-ups drain
+    deadline = time.perf_counter() + 5
+    while submitted and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    scheduler.schedule_deployments = schedule_pass
+    return next_id - 1, latencies, len(submitted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rate", type=float, default=200, help="submissions per second")
+    parser.add_argument("--duration", type=float, default=5, help="seconds")
+    parser.add_argument("--fake-redis", action="store_true")
+    args = parser.parse_args()
+
+    if args.fake_redis:
+        import fakeredis
+        queues.backend = queues.RedisQueue(fakeredis.FakeAsyncRedis())
+
+    Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    big = 10 ** 9
+    with engine.begin() as conn:
+        conn.execute(insert(models.Cluster), [{
+            "id": 1, "organization_id": None, "name": "bench", "total_ram": big, "total_cpu": big, "total_gpu": big,
+            "available_ram": big, "available_cpu": big, "available_gpu": big,
+        }])
+
+    total, latencies, lost = asyncio.run(run(args.rate, args.duration))
+    print(f"submitted {total}, running {len(latencies)}, still pending {lost}")
+    if latencies:
+        print(" ".join(f"p{p}={percentile(latencies, p) * 1000:.1f}ms" for p in (50, 95, 99)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Synthetic scheduler workloads: clusters of mixed sizes and a queue of pending
+deployments, generated with numpy from a seed, so the same Workload gives the
+same rows on every machine and commit.
+
+Skew is what makes scheduling hard, so each dimension can be skewed:
+- cluster_skew spreads deployments over clusters with a Zipf law (0 is
+  uniform, 1.5 puts most of the queue on a few hot clusters)
+- resources="skewed" draws heavy-tailed RAM, mostly small CPU requests and
+  rare, larger GPU requests; "uniform" draws from a few equal sizes
+- priorities="skewed" makes urgent deployments rare; "uniform" is 1-5 evenly
+"""
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+# (ram MiB, cpu, gpu) and how common each cluster size is
+CLUSTER_TIERS = np.array([(64 * 1024, 32, 0), (256 * 1024, 128, 4), (1024 * 1024, 512, 16)], dtype=np.int64)
+CLUSTER_TIER_WEIGHTS = (0.5, 0.35, 0.15)
+# Queue scores 1 (most important) to 5
+SKEWED_PRIORITY_WEIGHTS = (0.05, 0.1, 0.2, 0.3, 0.35)
+
+
+@dataclass
+class Workload:
+    clusters: int = 100
+    deployments: int = 10000
+    cluster_skew: float = 0.0
+    resources: str = "skewed"
+    priorities: str = "skewed"
+    seed: int = 0
+
+    def config(self):
+        return asdict(self)
+
+    def generate(self):
+        """
+        Returns a dict of arrays: `capacity` (clusters x 3), and per deployment
+        `cluster_id` (1-based), `demands` (n x 3) and `priority`.
+        """
+        rng = np.random.default_rng(self.seed)
+        n = self.deployments
+
+        if self.resources == "uniform":
+            capacity = np.repeat(CLUSTER_TIERS[1:2], self.clusters, axis=0)
+        else:
+            capacity = CLUSTER_TIERS[rng.choice(len(CLUSTER_TIERS), self.clusters, p=CLUSTER_TIER_WEIGHTS)]
+
+        if self.cluster_skew > 0:
+            # Zipf weights over a random ranking of the clusters, so the hot ones aren't always the first ids
+            weights = 1.0 / np.arange(1, self.clusters + 1) ** self.cluster_skew
+            weights = weights[rng.permutation(self.clusters)]
+            cluster_id = rng.choice(self.clusters, n, p=weights / weights.sum()) + 1
+        else:
+            cluster_id = rng.integers(1, self.clusters + 1, n)
+
+        if self.resources == "uniform":
+            demands = np.column_stack([
+                rng.choice([512, 1024, 2048, 4096], n),
+                rng.choice([1, 2, 4], n),
+                rng.choice([0, 1], n, p=[0.9, 0.1]),
+            ])
+        elif self.resources == "skewed":
+            # Log-normal RAM around 1 GiB in 128 MiB steps, from 128 MiB to 64 GiB
+            ram = np.clip(np.round(rng.lognormal(np.log(1024), 1.2, n) / 128) * 128, 128, 64 * 1024)
+            demands = np.column_stack([
+                ram,
+                rng.choice([1, 2, 4, 8, 16, 32], n, p=[0.45, 0.25, 0.15, 0.08, 0.05, 0.02]),
+                np.where(rng.random(n) < 0.07, rng.choice([1, 2, 4, 8], n, p=[0.6, 0.25, 0.1, 0.05]), 0),
+            ])
+        else:
+            raise ValueError(f"Unknown resources {self.resources!r}, expected 'uniform' or 'skewed'")
+
+        if self.priorities == "uniform":
+            priority = rng.integers(1, 6, n)
+        elif self.priorities == "skewed":
+            priority = rng.choice(np.arange(1, 6), n, p=SKEWED_PRIORITY_WEIGHTS)
+        else:
+            raise ValueError(f"Unknown priorities {self.priorities!r}, expected 'uniform' or 'skewed'")
+
+        return {
+            "capacity": capacity,
+            "cluster_id": cluster_id.astype(np.int64),
+            "demands": demands.astype(np.int64),
+            "priority": priority.astype(np.int64),
+        }
+
+
+# Named workloads, so runs on different commits measure the same thing
+SCENARIOS = {
+    "smoke": Workload(clusters=20, deployments=2000, resources="uniform", priorities="uniform"),
+    "many-clusters": Workload(clusters=5000, deployments=200000, cluster_skew=0.5),
+    "hot-clusters": Workload(clusters=200, deployments=200000, cluster_skew=1.5),
+    "1m": Workload(clusters=2000, deployments=1000000, cluster_skew=1.0),
+}
@@ -0,0 +1,132 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app import admission, authz, capacity, database, events, queues, versions
+from app.database import get_db, Base
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+engine = create_engine("sqlite:///./test.db", connect_args={"check_same_thread": False})
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+async def override_get_db():
+    async with TestingSessionLocal() as db:
+        yield db
+
+app.dependency_overrides[get_db] = override_get_db
+
+client = TestClient(app)
+
+@pytest.fixture(autouse=True)
+def setup_db(monkeypatch):
+    # Queue, events, versions and buckets in process, no Redis server needed
+    monkeypatch.setattr(queues, "backend", queues.MemoryQueue())
+    monkeypatch.setattr(events, "broker", events.Broker())
+    monkeypatch.setattr(versions, "backend", versions.MemoryVersions())
+    monkeypatch.setattr(admission, "backend", admission.MemoryBuckets())
+    # The scheduler's own sessions go to the test database too, not DATABASE_URL
+    monkeypatch.setattr(database, "AsyncSessionLocal", TestingSessionLocal)
+    Base.metadata.create_all(bind=engine)
+    yield
+    Base.metadata.drop_all(bind=engine)
+    # Ids are reused by the next test's rows
+    versions.responses.clear()
+    authz.memberships.clear()
+    authz.cluster_orgs.clear()
+    admission.org_clusters.clear()
+    capacity.reset()
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission.time, "time", lambda: now[0])
+    return now
+
+@pytest.fixture
+def member():
+    client.post("/create-organization", json={"name": "Test Org", "invite_code": "TEST123"})
+    client.post("/register", json={"username": "member", "password": "testpassword"})
+    token = client.post("/token", data={"username": "member", "password": "testpassword"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post("/join-organization?invite_code=TEST123", headers=headers)
+    return headers
+
+def deployment(**target):
+    return {"docker_image": "a", "required_ram": 1024, "required_cpu": 1, "required_gpu": 0, "priority": 1, **target}
+
+@pytest.mark.parametrize("kind", ["memory", "fakeredis"])
+def test_buckets(kind, clock, monkeypatch):
+    if kind == "fakeredis":
+        fakeredis = pytest.importorskip("fakeredis")
+        monkeypatch.setattr(database, "redis_client", fakeredis.FakeAsyncRedis())
+        backend = admission.RedisBuckets()
+    else:
+        backend = admission.MemoryBuckets()
+    org, cluster = ("organization:1", 2.0, 4), ("cluster:1", 1.0, 2)
+
+    async def scenario():
+        # The burst at once, then refilled at the rate
+        assert await backend.take([org], 4) == (0.0, None)
+        assert await backend.take([org], 1) == (0.5, "organization:1")
+        clock[0] += 0.5
+        assert await backend.take([org], 1) == (0.0, None)
+        # All or nothing: the cluster bucket is full but the organization's is empty
+        assert await backend.take([org, cluster], 2) == (1.0, "organization:1")
+        clock[0] += 1
+        assert await backend.take([org, cluster], 2) == (0.0, None)
+        assert await backend.take([cluster], 1) == (1.0, "cluster:1")
+        # A batch larger than the burst passes a full bucket and leaves it in debt
+        clock[0] += 10
+        assert await backend.take([org], 6) == (0.0, None)
+        assert await backend.take([org], 1) == (1.5, "organization:1")
+
+    asyncio.run(scenario())
+
+def test_submission_rate(member, clock, monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_ORG_RATE", 1.0)
+    monkeypatch.setattr(admission, "ADMISSION_ORG_BURST", 2)
+    cluster = client.post("/clusters", json={"name": "c", "total_ram": 4096, "total_cpu": 4, "total_gpu": 0},
+                          headers=member).json()
+    target = {"cluster_id": cluster["id"]}
+    assert [client.post("/deployments", json=deployment(**target), headers=member).status_code for _ in range(2)] == [200, 200]
+    response = client.post("/deployments", json=deployment(**target), headers=member)
+    assert response.status_code == 429 and response.headers["retry-after"] == "1"
+
+    # Per item in a batch: the whole group of a cluster is refused, the others go through
+    clock[0] += 1
+    response = client.post("/deployments/batch", json=[deployment(**target)] * 2, headers=member)
+    assert [item["status_code"] for item in response.json()] == [429, 429]
+    assert response.headers["retry-after"] == "1"
+    clock[0] += 1
+    response = client.post("/deployments/batch", json=[deployment(**target), deployment(cluster_id=999)], headers=member)
+    assert [item["status_code"] for item in response.json()] == [200, 404]
+    assert "retry-after" not in response.headers
+    # Nothing refused was queued
+    assert asyncio.run(queues.backend.size(cluster["id"])) == 3
+
+def test_queue_depth(member, monkeypatch):
+    monkeypatch.setattr(admission, "ADMISSION_CLUSTER_MAX_PENDING", 2)
+    monkeypatch.setattr(admission, "ADMISSION_ORG_MAX_PENDING", 3)
+    monkeypatch.setattr(admission, "ADMISSION_RETRY_AFTER", 7)
+    clusters = [client.post("/clusters", json={"name": name, "total_ram": 1, "total_cpu": 1, "total_gpu": 0},
+                            headers=member).json() for name in ("c", "d")]
+    org_id = clusters[0]["organization_id"]
+    for _ in range(2):
+        assert client.post("/deployments", json=deployment(cluster_id=clusters[0]["id"]), headers=member).status_code == 200
+    response = client.post("/deployments", json=deployment(cluster_id=clusters[0]["id"]), headers=member)
+    assert response.status_code == 429 and response.headers["retry-after"] == "7"
+    assert "waiting" in response.json()["detail"]
+
+    # The organization counts its clusters' queues and its own
+    auto = client.post("/deployments", json=deployment(organization_id=org_id), headers=member)
+    assert auto.status_code == 200
+    assert client.post("/deployments", json=deployment(cluster_id=clusters[1]["id"]), headers=member).status_code == 429
+    # A new cluster's queue is counted too
+    other = client.post("/clusters", json={"name": "e", "total_ram": 1, "total_cpu": 1, "total_gpu": 0},
+                        headers=member).json()
+    asyncio.run(queues.backend.enqueue({other["id"]: {999: 1}}))
+    asyncio.run(queues.backend.auto.remove(org_id, [auto.json()["id"]]))
+    assert client.post("/deployments", json=deployment(organization_id=org_id), headers=member).status_code == 429
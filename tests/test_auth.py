@@ -1,20 +1,25 @@
 import pytest
 from fastapi.testclient import TestClient
+import time
 from app.main import app
+from app import auth
+from app.cache import TTLCache
+from app import models
+from passlib.context import CryptContext
 from app.database import get_db, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, select, update
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db" # i tested it using my local psql db
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# TestClient runs every request on its own event loop, so no pooled connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 app.dependency_overrides[get_db] = override_get_db
 
@@ -47,4 +52,60 @@ def test_join_organization():
     
     response = client.post("/join-organization?invite_code=TEST123", headers={"Authorization": f"Bearer {token}"})
     assert response.status_code == 200
-    assert response.json()["message"] == "Successfully joined the organization"
\ No newline at end of file
+    assert response.json()["message"] == "Successfully joined the organization"
+
+def test_token_cache_skips_user_lookup():
+    auth.token_cache.clear()
+    client.post("/register", json={"username": "testuser", "password": "testpassword"})
+    token = client.post("/token", data={"username": "testuser", "password": "testpassword"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    client.get("/auth/cache-stats", headers=headers)
+    stats = client.get("/auth/cache-stats", headers=headers).json()["token_cache"]
+    assert stats["size"] == 1
+    assert stats["hits"] >= 1
+
+    # A changed user is resolved again
+    auth.invalidate_user("testuser")
+    misses = auth.token_cache.misses
+    hits = auth.token_cache.hits
+    client.get("/auth/cache-stats", headers=headers)
+    assert auth.token_cache.misses == misses + 1
+    assert auth.token_cache.hits == hits
+
+def test_token_cache_rejects_bad_tokens():
+    response = client.get("/auth/cache-stats", headers={"Authorization": "Bearer not-a-token"})
+    assert response.status_code == 401
+    assert auth.token_cache.get("not-a-token") is None
+
+def test_ttl_cache_expiry_and_bound():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2, expires_at=time.time() - 1)
+    assert cache.get("b") is None
+    cache.set("c", 3)
+    cache.get("a")
+    cache.set("d", 4)
+    # "c" was the least recently used
+    assert cache.get("c") is None
+    assert cache.get("a") == 1 and cache.get("d") == 4
+    assert cache.stats()["size"] == 2
+
+def test_login_upgrades_weak_hash():
+    client.post("/register", json={"username": "testuser", "password": "testpassword"})
+    weak_hash = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4).hash("testpassword")
+    with engine.begin() as conn:
+        conn.execute(update(models.User).where(models.User.username == "testuser").values(hashed_password=weak_hash))
+
+    response = client.post("/token", data={"username": "testuser", "password": "testpassword"})
+    assert response.status_code == 200
+    with engine.connect() as conn:
+        stored = conn.execute(select(models.User.hashed_password).where(models.User.username == "testuser")).scalar()
+    assert stored != weak_hash
+    assert auth.pwd_context.verify("testpassword", stored)
+    assert not auth.pwd_context.needs_update(stored)
+
+def test_login_wrong_password():
+    client.post("/register", json={"username": "testuser", "password": "testpassword"})
+    response = client.post("/token", data={"username": "testuser", "password": "wrong"})
+    assert response.status_code == 401
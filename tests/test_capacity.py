@@ -0,0 +1,28 @@
+import random
+from app.capacity import CapacityIndex
+
+def test_find_returns_the_first_cluster_with_room():
+    index = CapacityIndex([(3, (4, 4, 0)), (1, (1, 8, 0)), (2, (8, 2, 1))])
+    assert index.find((1, 1, 0)) == 1
+    assert index.find((2, 2, 0)) == 2
+    assert index.find((2, 3, 0)) == 3
+    assert index.find((0, 0, 2)) is None
+    index.reserve(2, (8, 2, 1))
+    assert index.get(2) == (0, 0, 0)
+    assert index.find((2, 2, 0)) == 3
+    index.update(4, (16, 16, 4))
+    assert len(index) == 4 and index.find((0, 0, 2)) == 4
+
+def test_matches_a_scan():
+    rng = random.Random(3)
+    free = {}
+    index = CapacityIndex()
+    for _ in range(2000):
+        cluster_id = rng.randrange(300)
+        free[cluster_id] = tuple(rng.randrange(64) for _ in range(3))
+        index.update(cluster_id, free[cluster_id])
+        demand = tuple(rng.randrange(64) for _ in range(3))
+        fitting = [c for c in sorted(free) if all(f >= d for f, d in zip(free[c], demand))]
+        # The first one indexed
+        expected = min(fitting, key=index._ids.index) if fitting else None
+        assert index.find(demand) == expected
@@ -1,27 +1,37 @@
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
+from app import authz, database, events, models, queues, versions
+import asyncio
+import json
 from app.database import get_db, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db" # i tested it using my local psql db
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# TestClient runs every request on its own event loop, so no pooled connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 app.dependency_overrides[get_db] = override_get_db
 
 client = TestClient(app)
 
 @pytest.fixture(autouse=True)
-def setup_db():
+def setup_db(monkeypatch):
+    # Queue, events and versions in process, no Redis server needed
+    monkeypatch.setattr(queues, "backend", queues.MemoryQueue())
+    monkeypatch.setattr(events, "broker", events.Broker())
+    monkeypatch.setattr(versions, "backend", versions.MemoryVersions())
+    # The scheduler's own sessions go to the test database too, not DATABASE_URL
+    monkeypatch.setattr(database, "AsyncSessionLocal", TestingSessionLocal)
     Base.metadata.create_all(bind=engine)
     yield
     Base.metadata.drop_all(bind=engine)
@@ -47,4 +57,124 @@ def test_get_cluster(authenticated_user):
     
     response = client.get(f"/clusters/{cluster_id}", headers={"Authorization": f"Bearer {authenticated_user}"})
     assert response.status_code == 200
-    assert response.json()["name"] == "TestCluster"
\ No newline at end of file
+    assert response.json()["name"] == "TestCluster"
+
+@pytest.fixture
+def org_member():
+    authz.memberships.clear()
+    authz.cluster_orgs.clear()
+    client.post("/create-organization", json={"name": "Test Org", "invite_code": "TEST123"})
+    client.post("/create-organization", json={"name": "Other Org", "invite_code": "OTHER"})
+    tokens = []
+    for username, invite_code in (("member", "TEST123"), ("outsider", "OTHER")):
+        client.post("/register", json={"username": username, "password": "testpassword"})
+        token = client.post("/token", data={"username": username, "password": "testpassword"}).json()["access_token"]
+        client.post(f"/join-organization?invite_code={invite_code}", headers={"Authorization": f"Bearer {token}"})
+        tokens.append({"Authorization": f"Bearer {token}"})
+    yield tokens
+    # The tables are dropped after each test, don't leak what was cached about them
+    authz.memberships.clear()
+    authz.cluster_orgs.clear()
+
+@pytest.fixture
+def statements():
+    executed = []
+    record = lambda *args: executed.append(args[2])
+    # Every test module overrides get_db, count on all engines
+    event.listen(Engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(Engine, "before_cursor_execute", record)
+
+def test_cluster_access_single_query(org_member, statements):
+    member, outsider = org_member
+    cluster_id = client.post("/clusters", json={"name": "TestCluster", "total_ram": 16384, "total_cpu": 8, "total_gpu": 2},
+                             headers=member).json()["id"]
+
+    del statements[:]
+    assert client.get(f"/clusters/{cluster_id}", headers=member).status_code == 200
+    assert len(statements) == 1
+
+    # Memberships and the cluster's organization are cached, only the listing query is left
+    del statements[:]
+    assert client.get(f"/clusters/{cluster_id}/deployments", headers=member).status_code == 200
+    assert len(statements) == 1
+
+    assert client.get(f"/clusters/{cluster_id}", headers=outsider).status_code == 403
+    assert client.get(f"/clusters/{cluster_id}/deployments", headers=outsider).status_code == 403
+    assert client.get("/clusters/999", headers=member).status_code == 404
+
+def test_join_organization_refreshes_membership(org_member):
+    member, outsider = org_member
+    cluster_id = client.post("/clusters", json={"name": "TestCluster", "total_ram": 16384, "total_cpu": 8, "total_gpu": 2},
+                             headers=member).json()["id"]
+    assert client.get(f"/clusters/{cluster_id}/deployments", headers=outsider).status_code == 403
+    client.post("/join-organization?invite_code=TEST123", headers=outsider)
+    assert client.get(f"/clusters/{cluster_id}/deployments", headers=outsider).status_code == 200
+
+@pytest.fixture
+def deployments(org_member):
+    member, _ = org_member
+    cluster_id = client.post("/clusters", json={"name": "TestCluster", "total_ram": 16384, "total_cpu": 8, "total_gpu": 2},
+                             headers=member).json()["id"]
+    # Straight into the table, create_deployment would also need Redis
+    with engine.begin() as conn:
+        conn.execute(models.Deployment.__table__.insert(), [
+            {"docker_image": f"d{i}", "required_ram": 1, "required_cpu": 1, "required_gpu": 0,
+             "priority": i % 3, "status": "running" if i % 2 else "pending", "cluster_id": cluster_id}
+            for i in range(25)
+        ])
+    return member, cluster_id
+
+def test_cluster_deployments_keyset_pages(deployments):
+    member, cluster_id = deployments
+    seen, cursor = [], None
+    while True:
+        params = {"limit": 10} if cursor is None else {"limit": 10, "cursor": cursor}
+        response = client.get(f"/clusters/{cluster_id}/deployments", params=params, headers=member)
+        assert response.status_code == 200
+        seen += [d["docker_image"] for d in response.json()]
+        cursor = response.headers.get("X-Next-Cursor")
+        if cursor is None:
+            break
+        assert 'rel="next"' in response.headers["Link"]
+    assert seen == [f"d{i}" for i in range(25)]
+
+    response = client.get(f"/clusters/{cluster_id}/deployments", params={"status": "running", "priority": 1}, headers=member)
+    assert [d["docker_image"] for d in response.json()] == [f"d{i}" for i in range(25) if i % 2 and i % 3 == 1]
+    assert client.get(f"/clusters/{cluster_id}/deployments", params={"limit": 0}, headers=member).status_code == 422
+
+def test_cluster_deployments_ndjson_stream(deployments):
+    member, cluster_id = deployments
+    response = client.get(f"/clusters/{cluster_id}/deployments", params={"stream": True, "status": "pending"}, headers=member)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [d["docker_image"] for d in rows] == [f"d{i}" for i in range(0, 25, 2)]
+
+def test_clusters_paged_by_id(org_member):
+    member, _ = org_member
+    for i in range(3):
+        client.post("/clusters", json={"name": f"c{i}", "total_ram": 1, "total_cpu": 1, "total_gpu": 0}, headers=member)
+    first = client.get("/clusters", params={"limit": 2}, headers=member)
+    rest = client.get("/clusters", params={"limit": 2, "cursor": first.headers["X-Next-Cursor"]}, headers=member)
+    assert [c["name"] for c in first.json() + rest.json()] == ["c0", "c1", "c2"]
+    assert "X-Next-Cursor" not in rest.headers
+
+def test_batch_submission(org_member):
+    member, outsider = org_member
+    own = client.post("/clusters", json={"name": "Own", "total_ram": 16384, "total_cpu": 8, "total_gpu": 2}, headers=member).json()["id"]
+    other = client.post("/clusters", json={"name": "Other", "total_ram": 16384, "total_cpu": 8, "total_gpu": 2}, headers=outsider).json()["id"]
+
+    items = [{"cluster_id": own if i % 4 else other, "docker_image": f"d{i}", "required_ram": 1, "required_cpu": 1,
+              "required_gpu": 0, "priority": i % 3} for i in range(1000)]
+    response = client.post("/deployments/batch", json=items, headers=member)
+    assert response.status_code == 200
+    results = response.json()
+    assert [r["index"] for r in results] == list(range(1000))
+    assert all(r["status_code"] == 403 and r["deployment"] is None for r in results[::4])
+    created = [r["deployment"] for r in results if r["status_code"] == 200]
+    assert len(created) == 750
+    assert [d["docker_image"] for d in created] == [f"d{i}" for i in range(1000) if i % 4]
+
+    assert sorted(asyncio.run(queues.backend.peek(own))) == sorted((d["id"], d["priority"]) for d in created)
+    assert asyncio.run(queues.backend.clusters()) == [own]
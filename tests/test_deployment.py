@@ -1,27 +1,35 @@
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
+from app import authz, capacity, database, deployment, events, queues, scheduler, versions
+import asyncio
 from app.database import get_db, Base
 from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db" # i tested it using my local psql db
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# TestClient runs every request on its own event loop, so no pooled connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 app.dependency_overrides[get_db] = override_get_db
 
 client = TestClient(app)
 
 @pytest.fixture(autouse=True)
-def setup_db():
+def setup_db(monkeypatch):
+    # Queue, events and versions in process, no Redis server needed
+    monkeypatch.setattr(queues, "backend", queues.MemoryQueue())
+    monkeypatch.setattr(events, "broker", events.Broker())
+    monkeypatch.setattr(versions, "backend", versions.MemoryVersions())
+    # The scheduler's own sessions go to the test database too, not DATABASE_URL
+    monkeypatch.setattr(database, "AsyncSessionLocal", TestingSessionLocal)
     Base.metadata.create_all(bind=engine)
     yield
     Base.metadata.drop_all(bind=engine)
@@ -84,4 +92,123 @@ def test_get_cluster_deployments(authenticated_user, cluster_id):
     
     response = client.get(f"/clusters/{cluster_id}/deployments", headers={"Authorization": f"Bearer {authenticated_user}"})
     assert response.status_code == 200
-    assert len(response.json()) == 1
\ No newline at end of file
+    assert len(response.json()) == 1
+@pytest.fixture
+def member():
+    authz.memberships.clear()
+    authz.cluster_orgs.clear()
+    client.post("/create-organization", json={"name": "Test Org", "invite_code": "TEST123"})
+    client.post("/register", json={"username": "member", "password": "testpassword"})
+    token = client.post("/token", data={"username": "member", "password": "testpassword"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post("/join-organization?invite_code=TEST123", headers=headers)
+    yield headers
+    authz.memberships.clear()
+    authz.cluster_orgs.clear()
+
+def test_complete_releases_capacity_to_the_queue(member, monkeypatch):
+    cluster_id = client.post("/clusters", json={"name": "Small", "total_ram": 2048, "total_cpu": 2, "total_gpu": 0},
+                             headers=member).json()["id"]
+    first, second = (client.post("/deployments", json={"cluster_id": cluster_id, "docker_image": image, "required_ram": 2048,
+                                                       "required_cpu": 2, "required_gpu": 0, "priority": 1},
+                                 headers=member).json()["id"] for image in ("a", "b"))
+    asyncio.run(scheduler.schedule_deployments())
+    assert client.get(f"/deployments/{second}", headers=member).json()["status"] == "pending"
+
+    passes = []
+    def scoped_pass(cluster_id=None):
+        passes.append(cluster_id)
+    # TestClient runs no scheduler, record the wake-up instead
+    monkeypatch.setattr(deployment, "notify_scheduler", scoped_pass)
+    response = client.post(f"/deployments/{first}/complete", headers=member)
+    assert response.status_code == 200
+    assert response.json()["status"] == "completed"
+    assert passes == [cluster_id]
+    assert client.get(f"/clusters/{cluster_id}", headers=member).json()["available_ram"] == 2048
+
+    # The woken pass only looks at that cluster and reuses what was freed
+    asyncio.run(scheduler.schedule_deployments([cluster_id]))
+    assert client.get(f"/deployments/{second}", headers=member).json()["status"] == "running"
+    assert client.get(f"/clusters/{cluster_id}", headers=member).json()["available_ram"] == 0
+
+    # Finished deployments stay finished
+    assert client.post(f"/deployments/{first}/complete", headers=member).status_code == 409
+    assert client.post(f"/deployments/{first}/terminate", headers=member).status_code == 409
+
+def test_terminate_pending_leaves_the_queue(member):
+    cluster_id = client.post("/clusters", json={"name": "Empty", "total_ram": 0, "total_cpu": 0, "total_gpu": 0},
+                             headers=member).json()["id"]
+    deployment_id = client.post("/deployments", json={"cluster_id": cluster_id, "docker_image": "a", "required_ram": 1,
+                                                      "required_cpu": 1, "required_gpu": 0, "priority": 1},
+                                headers=member).json()["id"]
+    assert client.post(f"/deployments/{deployment_id}/complete", headers=member).status_code == 409
+    response = client.post(f"/deployments/{deployment_id}/terminate", headers=member)
+    assert response.json()["status"] == "terminated"
+    assert asyncio.run(queues.backend.peek(cluster_id)) == []
+    assert client.get(f"/clusters/{cluster_id}", headers=member).json()["available_ram"] == 0
+
+def test_organization_deployments_are_placed_where_there_is_room(member):
+    capacity.reset()
+    create = lambda name, cpu: client.post("/clusters", json={"name": name, "total_ram": 4096, "total_cpu": cpu,
+                                                              "total_gpu": 0}, headers=member).json()
+    full = create("Full", 2)
+    org_id = full["organization_id"]
+    spec = {"docker_image": "a", "required_ram": 1024, "required_cpu": 2, "required_gpu": 0, "priority": 1}
+    client.post("/deployments", json={"cluster_id": full["id"], **spec}, headers=member)
+    asyncio.run(scheduler.schedule_deployments())
+
+    # Needs a cluster, not both or neither
+    assert client.post("/deployments", json=spec, headers=member).status_code == 422
+    assert client.post("/deployments", json={"cluster_id": full["id"], "organization_id": org_id, **spec},
+                       headers=member).status_code == 422
+    assert client.post("/deployments", json={"organization_id": org_id + 1, **spec}, headers=member).status_code == 403
+
+    waiting = client.post("/deployments", json={"organization_id": org_id, **spec}, headers=member).json()
+    assert (waiting["cluster_id"], waiting["organization_id"], waiting["status"]) == (None, org_id, "pending")
+    asyncio.run(scheduler.schedule_changed())
+    # Nowhere to go yet: the only cluster is full
+    assert client.get(f"/deployments/{waiting['id']}", headers=member).json()["cluster_id"] is None
+
+    # A new cluster is seen by the index, the deployment runs there
+    spare = create("Spare", 4)
+    asyncio.run(scheduler.schedule_changed())
+    placed = client.get(f"/deployments/{waiting['id']}", headers=member).json()
+    assert (placed["cluster_id"], placed["status"]) == (spare["id"], "running")
+    assert capacity.indexes[org_id].get(spare["id"]) == (3072, 2, 0)
+
+    # Terminating one still without a cluster takes it off the organization's queue
+    batch = client.post("/deployments/batch", json=[{"organization_id": org_id, **dict(spec, required_cpu=8)}],
+                        headers=member).json()
+    unplaceable = batch[0]["deployment"]["id"]
+    assert asyncio.run(queues.backend.auto.peek(org_id)) == [(unplaceable, 1.0)]
+    assert client.post(f"/deployments/{unplaceable}/terminate", headers=member).json()["status"] == "terminated"
+    assert asyncio.run(queues.backend.auto.peek(org_id)) == []
+
+def test_organization_deployments_move_on_when_the_indexed_cluster_refuses(member):
+    capacity.reset()
+    create = lambda name, **extra: client.post("/clusters", json={"name": name, "total_ram": 4096, "total_cpu": 4,
+                                                                  "total_gpu": 0, **extra}, headers=member).json()
+    # First in the index and looks free, but strict_priority keeps it behind a head that never fits
+    blocked = create("Blocked", placement_strategy="strict_priority")
+    spare = create("Spare")
+    org_id = blocked["organization_id"]
+    spec = {"docker_image": "a", "required_ram": 1024, "required_gpu": 0}
+    head = client.post("/deployments", json={"cluster_id": blocked["id"], "required_cpu": 8, "priority": 1, **spec},
+                       headers=member).json()
+    waiting = client.post("/deployments", json={"organization_id": org_id, "required_cpu": 1, "priority": 2, **spec},
+                          headers=member).json()
+
+    asyncio.run(scheduler.schedule_changed())
+    placed = client.get(f"/deployments/{waiting['id']}", headers=member).json()
+    assert (placed["cluster_id"], placed["status"]) == (spare["id"], "running")
+    assert client.get(f"/deployments/{head['id']}", headers=member).json()["status"] == "pending"
+    assert asyncio.run(queues.backend.auto.peek(org_id)) == []
+    assert asyncio.run(queues.backend.peek(blocked["id"])) == [(head["id"], 1.0)]
+
+    # With nowhere else to go it keeps waiting without a cluster, not stuck on the blocked one
+    late = client.post("/deployments", json={"organization_id": org_id, "required_cpu": 4, "priority": 2, **spec},
+                       headers=member).json()
+    asyncio.run(scheduler.schedule_changed())
+    assert client.get(f"/deployments/{late['id']}", headers=member).json()["cluster_id"] is None
+    assert asyncio.run(queues.backend.auto.peek(org_id)) == [(late["id"], 2.0)]
+    assert asyncio.run(queues.backend.peek(blocked["id"])) == [(head["id"], 1.0)]
@@ -0,0 +1,101 @@
+import asyncio
+import json
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app import authz, database, events, queues, scheduler, versions
+from app.database import get_db, Base
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+engine = create_engine("sqlite:///./test.db", connect_args={"check_same_thread": False})
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+async def override_get_db():
+    async with TestingSessionLocal() as db:
+        yield db
+
+app.dependency_overrides[get_db] = override_get_db
+
+client = TestClient(app)
+
+@pytest.fixture(autouse=True)
+def setup_db(monkeypatch):
+    # Queue, events and versions in process, no Redis server needed
+    monkeypatch.setattr(queues, "backend", queues.MemoryQueue())
+    monkeypatch.setattr(versions, "backend", versions.MemoryVersions())
+    monkeypatch.setattr(events, "broker", events.Broker())
+    authz.memberships.clear()
+    authz.cluster_orgs.clear()
+    # The scheduler's own sessions go to the test database too, not DATABASE_URL
+    monkeypatch.setattr(database, "AsyncSessionLocal", TestingSessionLocal)
+    Base.metadata.create_all(bind=engine)
+    yield
+    Base.metadata.drop_all(bind=engine)
+    # Ids are reused by the next test's rows
+    authz.memberships.clear()
+    authz.cluster_orgs.clear()
+
+@pytest.fixture
+def member():
+    client.post("/create-organization", json={"name": "Test Org", "invite_code": "TEST123"})
+    client.post("/register", json={"username": "member", "password": "testpassword"})
+    token = client.post("/token", data={"username": "member", "password": "testpassword"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post("/join-organization?invite_code=TEST123", headers=headers)
+    return headers
+
+def parse(body):
+    return [json.loads(chunk.split("data: ", 1)[1]) for chunk in body.strip().split("\n\n") if chunk.startswith("event: status")]
+
+def test_broker_fans_out_by_topic(monkeypatch):
+    monkeypatch.setattr(events, "EVENTS_BUFFER", 2)
+    broker = events.Broker()
+    followed = [broker.subscribe(topic) for topic in ("deployment:1", "cluster:2", "organization:3", "deployment:9")]
+    broker.dispatch([events.event(1, "running", "pending", 2, 3)])
+    assert [len(s.events) for s in followed] == [1, 1, 1, 0]
+
+    # A subscriber that doesn't keep up keeps the latest events and is told it missed some
+    broker.dispatch([events.event(1, "pending", "running", 2, 3), events.event(1, "running", "pending", 2, 3)])
+    assert followed[0].lagged and [e["status"] for e in asyncio.run(followed[0].get(1))] == ["pending", "running"]
+    assert asyncio.run(followed[3].get(0.01)) == []
+
+    for subscription in followed:
+        subscription.close()
+    assert broker.subscribers() == 0
+
+def test_deployment_stream_follows_transitions(member):
+    cluster = client.post("/clusters", json={"name": "c", "total_ram": 4096, "total_cpu": 4, "total_gpu": 0},
+                          headers=member).json()
+    deployment = client.post("/deployments", json={"cluster_id": cluster["id"], "docker_image": "a", "required_ram": 1024,
+                                                   "required_cpu": 1, "required_gpu": 0, "priority": 1},
+                             headers=member).json()
+    assert deployment["organization_id"] == cluster["organization_id"]
+
+    async def follow():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            # The transport only returns once the stream ends, at the final status
+            stream = asyncio.create_task(ac.get(f"/deployments/{deployment['id']}/events", headers=member))
+            while not events.broker.subscribers():
+                await asyncio.sleep(0.01)
+            await scheduler.schedule_deployments()
+            await ac.post(f"/deployments/{deployment['id']}/complete", headers=member)
+            return await asyncio.wait_for(stream, 5)
+
+    response = asyncio.run(follow())
+    assert response.headers["content-type"].startswith("text/event-stream")
+    received = parse(response.text)
+    assert [(e["previous"], e["status"]) for e in received] == [(None, "pending"), ("pending", "running"), ("running", "completed")]
+    assert {(e["cluster_id"], e["organization_id"]) for e in received} == {(cluster["id"], cluster["organization_id"])}
+    assert events.broker.subscribers() == 0
+
+    # Already final: the current state, and the stream ends
+    response = client.get(f"/deployments/{deployment['id']}/events", headers=member)
+    assert [e["status"] for e in parse(response.text)] == ["completed"]
+    assert client.get("/deployments/999/events", headers=member).status_code == 404
+    assert events.broker.subscribers() == 0
+    assert client.get(f"/organizations/{cluster['organization_id'] + 1}/events", headers=member).status_code == 403
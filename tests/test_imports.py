@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+import textwrap
+
+def run_python(code, **env):
+    # A fresh interpreter, so nothing imported by the other tests counts
+    result = subprocess.run(
+        [sys.executable, "-c", textwrap.dedent(code)],
+        env={**os.environ, **env}, capture_output=True, text=True, timeout=60,
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+def test_imports_have_no_side_effects():
+    # Nothing listens there: any connection attempt at import would fail
+    run_python("""
+        import sys
+        import app, app.models, app.schemas
+        for module in ("app.main", "fastapi", "numpy"):
+            assert module not in sys.modules, module
+        import app.main
+        from app import database
+        assert not {"engine", "async_engine", "redis_pool", "redis_client"} & set(vars(database))
+        assert "app" not in vars(app.main)
+        for module in ("app.auth", "app.scheduler", "apscheduler"):
+            assert module not in sys.modules, module
+    """, DATABASE_URL="postgresql://nobody@127.0.0.1:1/nothing")
+
+def test_create_app_creates_schema_at_startup(tmp_path):
+    url = f"sqlite:///{tmp_path}/app.db"
+    run_python("""
+        from fastapi.testclient import TestClient
+        from sqlalchemy import inspect
+        from app.main import create_app
+        from app import database
+
+        assert not inspect(database.engine).get_table_names()
+        with TestClient(create_app(embedded_scheduler=False, create_schema=False)):
+            pass
+        assert not inspect(database.engine).get_table_names()
+        with TestClient(create_app(embedded_scheduler=False)) as client:
+            assert client.post("/register", json={"username": "u", "password": "p"}).status_code == 200
+        assert "deployments" in inspect(database.engine).get_table_names()
+    """, DATABASE_URL=url, QUEUE_BACKEND="memory")
+
+def test_embedded_scheduler_stops_at_shutdown(tmp_path):
+    run_python("""
+        from fastapi.testclient import TestClient
+        from app.main import create_app
+        from app import scheduler
+
+        calls = []
+        def start_scheduler():
+            calls.append("start")
+            return lambda: calls.append("stop")
+        scheduler.start_scheduler = start_scheduler
+
+        with TestClient(create_app(embedded_scheduler=True)):
+            assert calls == ["start"]
+        assert calls == ["start", "stop"]
+    """, DATABASE_URL=f"sqlite:///{tmp_path}/app.db", QUEUE_BACKEND="memory")
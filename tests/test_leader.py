@@ -0,0 +1,111 @@
+import asyncio
+import pytest
+from app import leader, scheduler, scheduler_worker
+
+fakeredis = pytest.importorskip("fakeredis")
+
+def test_redis_lock_is_exclusive_and_expires():
+    async def run():
+        client = fakeredis.FakeAsyncRedis()
+        first = leader.RedisLeaderLock(client, ttl=0.2)
+        second = leader.RedisLeaderLock(client, ttl=0.2)
+        assert await first.acquire()
+        assert not await second.acquire()
+        assert await first.renew()
+        assert not await second.renew()
+        # A leader that stops renewing loses the lock, and can't renew it back
+        await asyncio.sleep(0.3)
+        assert await second.acquire()
+        assert not await first.renew()
+        await first.release()
+        assert await client.get(leader.LEADER_KEY) == second.token
+        await second.release()
+        assert await client.get(leader.LEADER_KEY) is None
+
+    asyncio.run(run())
+
+def test_file_lock_is_exclusive(tmp_path):
+    async def run():
+        path = str(tmp_path / "leader.lock")
+        first = leader.FileLeaderLock(path)
+        second = leader.FileLeaderLock(path)
+        assert await first.acquire()
+        assert not await second.acquire()
+        assert await first.renew() and not await second.renew()
+        await first.release()
+        assert await second.acquire()
+        await second.release()
+
+    asyncio.run(run())
+
+def test_standby_takes_over(monkeypatch):
+    running = []
+
+    def fake_start():
+        task = asyncio.current_task()
+        running.append(task)
+        return lambda: running.remove(task)
+
+    monkeypatch.setattr(scheduler, "start_scheduler", fake_start)
+
+    async def run():
+        client = fakeredis.FakeAsyncRedis()
+        workers = [
+            asyncio.create_task(scheduler_worker.run(leader.RedisLeaderLock(client, ttl=1), heartbeat=0.05))
+            for _ in range(2)
+        ]
+        await asyncio.sleep(0.2)
+        assert len(running) == 1
+        leading = running[0]
+        leading.cancel()
+        await asyncio.sleep(0.2)
+        # The leader released the lock on its way out, the standby picked it up
+        assert running == [task for task in workers if task is not leading]
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    asyncio.run(run())
+
+class FlakyLock:
+    """Fails like a Redis that goes away: the first acquire, then the second renew."""
+
+    def __init__(self):
+        self.acquires = self.renews = 0
+
+    async def acquire(self):
+        self.acquires += 1
+        if self.acquires == 1:
+            raise ConnectionError("Connection refused")
+        return True
+
+    async def renew(self):
+        self.renews += 1
+        if self.renews == 2:
+            raise leader.redis.ConnectionError("Connection reset by peer")
+        return True
+
+    async def release(self):
+        raise leader.redis.ConnectionError("Connection refused")
+
+def test_lock_errors_put_the_worker_on_standby(monkeypatch):
+    started, stopped = [], []
+
+    def fake_start():
+        started.append(True)
+        return lambda: stopped.append(True)
+
+    monkeypatch.setattr(scheduler, "start_scheduler", fake_start)
+
+    async def run():
+        lock = FlakyLock()
+        worker = asyncio.create_task(scheduler_worker.run(lock, heartbeat=0.02))
+        await asyncio.sleep(0.2)
+        # Survived both errors: stopped scheduling on the renew failure and was elected again
+        assert not worker.done()
+        assert lock.acquires >= 3 and len(started) == 2 and len(stopped) == 1
+        worker.cancel()
+        await asyncio.gather(worker, return_exceptions=True)
+        assert len(stopped) == 2
+
+    asyncio.run(run())
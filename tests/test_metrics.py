@@ -0,0 +1,94 @@
+import asyncio
+import re
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app import database, events, metrics, models, queues, scheduler, versions
+from app.database import get_db, Base
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
+engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+# TestClient runs every request on its own event loop, so no pooled connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+# Timed like the app's own engine, the scheduler runs its queries on this one
+database.instrument_engine(async_engine.sync_engine)
+TestingSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+async def override_get_db():
+    async with TestingSessionLocal() as db:
+        yield db
+
+app.dependency_overrides[get_db] = override_get_db
+
+client = TestClient(app)
+
+@pytest.fixture(autouse=True)
+def setup_db(monkeypatch):
+    # Queue, events and versions in process, no Redis server needed
+    monkeypatch.setattr(queues, "backend", queues.MemoryQueue())
+    monkeypatch.setattr(events, "broker", events.Broker())
+    monkeypatch.setattr(versions, "backend", versions.MemoryVersions())
+    # The scheduler's own sessions go to the test database too, not DATABASE_URL
+    monkeypatch.setattr(database, "AsyncSessionLocal", TestingSessionLocal)
+    Base.metadata.create_all(bind=engine)
+    metrics.reset()
+    yield
+    metrics.reset()
+    Base.metadata.drop_all(bind=engine)
+
+def sample(text, name, **labels):
+    """The value of one sample of an exposition, None if it isn't there."""
+    label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    match = re.search(rf"^{re.escape(name)}(?:\{{{re.escape(label_text)}\}})? (\S+)$", text, re.MULTILINE)
+    return float(match.group(1)) if match else None
+
+def test_histogram_exposition():
+    for seconds in (0.0002, 0.003, 0.003, 2):
+        metrics.observe_query("SELECT 1", seconds)
+    metrics.observe_query("PRAGMA foo", 0.001)
+    text = metrics.render()
+    assert "# TYPE db_query_duration_seconds histogram" in text
+    assert sample(text, "db_query_duration_seconds_bucket", operation="SELECT", le="0.0005") == 1
+    assert sample(text, "db_query_duration_seconds_bucket", operation="SELECT", le="0.005") == 3
+    assert sample(text, "db_query_duration_seconds_bucket", operation="SELECT", le="+Inf") == 4
+    assert sample(text, "db_query_duration_seconds_count", operation="SELECT") == 4
+    assert sample(text, "db_query_duration_seconds_sum", operation="SELECT") == pytest.approx(2.0062)
+    assert sample(text, "db_query_duration_seconds_count", operation="OTHER") == 1
+
+def test_metrics_endpoint():
+    with engine.begin() as conn:
+        conn.execute(models.Cluster.__table__.insert(), [{
+            "id": 1, "name": "c", "total_ram": 8, "total_cpu": 4, "total_gpu": 0,
+            "available_ram": 8, "available_cpu": 4, "available_gpu": 0,
+        }])
+        conn.execute(models.Deployment.__table__.insert(), [{
+            "id": i, "cluster_id": 1, "docker_image": "img", "required_ram": 2, "required_cpu": 2,
+            "required_gpu": 0, "priority": 1, "status": "pending",
+        } for i in (1, 2, 3)])
+    asyncio.run(queues.backend.enqueue({1: {1: 1, 2: 1, 3: 1}}))
+    asyncio.run(scheduler.schedule_deployments())
+    client.post("/token", data={"username": "nobody", "password": "wrong"})
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert sample(text, "http_requests_total", router="auth", method="POST", status="4xx") == 1
+    assert sample(text, "http_request_duration_seconds_count", router="auth", method="POST") == 1
+    # Two fit on the cluster's 4 cpus, one waits
+    assert sample(text, "scheduler_pass_duration_seconds_count") == 1
+    assert sample(text, "scheduler_pass_placed_sum") == 2
+    assert sample(text, "scheduler_pass_skipped_sum") == 1
+    assert sample(text, "queue_depth", cluster_id="1") == 1
+    assert sample(text, "cluster_utilization_ratio", cluster_id="1", resource="cpu") == 1.0
+    assert sample(text, "cluster_utilization_ratio", cluster_id="1", resource="ram") == 0.5
+    assert sample(text, "cluster_utilization_ratio", cluster_id="1", resource="gpu") == 0.0
+    # The scheduler's queries are timed
+    assert sample(text, "db_query_duration_seconds_count", operation="UPDATE") >= 2
+    assert sample(text, "db_query_duration_seconds_count", operation="SELECT") >= 1
+
+    # The scrape itself is counted on the next one
+    assert sample(client.get("/metrics").text, "http_requests_total", router="monitoring", method="GET", status="2xx") == 1
@@ -0,0 +1,45 @@
+import asyncio
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from app import migrate
+
+# The tables as the first version created them
+OLD_SCHEMA = [
+    "CREATE TABLE organizations (id INTEGER PRIMARY KEY, name VARCHAR, invite_code VARCHAR UNIQUE)",
+    "CREATE TABLE clusters (id INTEGER PRIMARY KEY, organization_id INTEGER REFERENCES organizations (id), name VARCHAR,"
+    " total_ram INTEGER, total_cpu INTEGER, total_gpu INTEGER,"
+    " available_ram INTEGER, available_cpu INTEGER, available_gpu INTEGER)",
+    "CREATE TABLE deployments (id INTEGER PRIMARY KEY, cluster_id INTEGER REFERENCES clusters (id), docker_image VARCHAR,"
+    " required_ram INTEGER, required_cpu INTEGER, required_gpu INTEGER, priority INTEGER, status VARCHAR,"
+    " created_at DATETIME DEFAULT CURRENT_TIMESTAMP)",
+    "INSERT INTO organizations (id, name, invite_code) VALUES (7, 'org', 'CODE')",
+    "INSERT INTO clusters (id, organization_id, name) VALUES (3, 7, 'c')",
+    "INSERT INTO deployments (id, cluster_id, status) VALUES (1, 3, 'running')",
+    "INSERT INTO deployments (id, cluster_id, status) VALUES (2, NULL, 'pending')",
+]
+
+def test_upgrade_adds_the_new_columns(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/old.db")
+    with engine.begin() as conn:
+        for statement in OLD_SCHEMA:
+            conn.execute(text(statement))
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/old.db", poolclass=NullPool)
+
+    # Again is a no-op
+    for _ in range(2):
+        asyncio.run(migrate.upgrade(async_engine))
+        assert "placement_strategy" in {c["name"] for c in inspect(engine).get_columns("clusters")}
+        assert "organization_id" in {c["name"] for c in inspect(engine).get_columns("deployments")}
+        assert {"ix_deployments_cluster_created", "ix_deployments_status_id"} <= {
+            index["name"] for index in inspect(engine).get_indexes("deployments")
+        }
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT placement_strategy FROM clusters")).all() == [(None,)]
+        # Backfilled from the cluster
+        assert conn.execute(text("SELECT id, organization_id FROM deployments ORDER BY id")).all() == [(1, 7), (2, None)]
+
+def test_upgrade_skips_an_empty_database(tmp_path):
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/new.db", poolclass=NullPool)
+    asyncio.run(migrate.upgrade(async_engine))
+    assert not inspect(create_engine(f"sqlite:///{tmp_path}/new.db")).get_table_names()
@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+from app.placement import STRATEGIES, find_victims, get_strategy, greedy_fit, plan_preemption
+import time
+
+TOTAL = (16384, 8, 2)
+
+
+def sequential_first_fit(demands, available):
+    remaining = list(available)
+    selected = []
+    for i, demand in enumerate(demands):
+        if all(r >= d for r, d in zip(remaining, demand)):
+            remaining = [r - d for r, d in zip(remaining, demand)]
+            selected.append(i)
+    return selected, remaining
+
+def test_greedy_fit_matches_sequential_loop():
+    rng = np.random.default_rng(7)
+    demands = rng.integers(0, 6, size=(2000, 3))
+    available = (400, 350, 500)
+    selected, remaining = greedy_fit(demands, np.arange(len(demands)), available)
+    expected, expected_remaining = sequential_first_fit(demands.tolist(), available)
+    assert selected.tolist() == expected
+    assert remaining.tolist() == expected_remaining
+
+def test_first_fit_keeps_scheduler_behaviour():
+    # The medium one no longer fits once the large one is placed, the small one still does
+    demands = [(8192, 4, 1), (4096, 2, 2), (1024, 1, 0)]
+    selected, remaining, report = get_strategy("first_fit").place(demands, [1, 2, 3], TOTAL, TOTAL)
+    assert sorted(selected.tolist()) == [0, 2]
+    assert remaining.tolist() == [16384 - 9216, 3, 1]
+    assert report.placed == 2 and report.candidates == 3
+
+def test_strict_priority_blocks_lower_tiers():
+    demands = [(8192, 4, 1), (4096, 8, 1), (1024, 1, 0)]
+    selected, _, _ = get_strategy("strict_priority").place(demands, [1, 2, 3], TOTAL, TOTAL)
+    assert selected.tolist() == [0]
+
+def test_priority_knapsack_fills_tier_before_lower_ones():
+    demands = [(1024, 1, 0), (8192, 4, 0), (8192, 4, 0), (1024, 1, 0)]
+    selected, _, report = get_strategy("priority_knapsack").place(demands, [1, 1, 1, 2], (16384, 8, 0), (16384, 8, 0))
+    # The two large ones fill the cluster exactly, which beats taking the small one first
+    assert sorted(selected.tolist()) == [1, 2]
+    assert report.efficiency == pytest.approx(1.0)
+
+@pytest.mark.parametrize("name", sorted(STRATEGIES))
+def test_strategies_never_overcommit(name):
+    rng = np.random.default_rng(3)
+    demands = np.column_stack([rng.integers(256, 4096, 5000), rng.integers(1, 8, 5000), rng.integers(0, 2, 5000)])
+    priorities = rng.integers(1, 5, 5000)
+    total = (512 * 1024, 256, 16)
+    selected, remaining, report = get_strategy(name).place(demands, priorities, total, total)
+    assert len(set(selected.tolist())) == len(selected)
+    assert (demands[selected].sum(axis=0) + remaining == np.array(total)).all()
+    assert (remaining >= 0).all()
+    assert 0 < report.efficiency <= 1
+
+def test_unknown_strategy():
+    with pytest.raises(ValueError):
+        get_strategy("round_robin")
+
+def test_victims_are_lowest_priority_and_minimal():
+    running = [(1, 1, 0), (1, 1, 0), (4, 4, 0), (2, 2, 0), (8, 8, 0)]
+    priorities = [5, 5, 5, 2, 1]
+    # Needs 4: the single 4-unit deployment of the lowest tier beats two small ones
+    assert sorted(find_victims((4, 4, 0), (0, 0, 0), running, priorities, 1).tolist()) == [2]
+    # Needs 2 with 1 free: one small deployment is enough
+    assert len(find_victims((2, 2, 0), (1, 1, 0), running, priorities, 1)) == 1
+    # Never the same or a higher priority, and nothing when it already fits
+    assert find_victims((10, 10, 0), (0, 0, 0), running, priorities, 2) is None
+    assert find_victims((1, 1, 0), (1, 1, 0), running, priorities, 1).size == 0
+
+def test_victims_free_enough_in_every_dimension():
+    rng = np.random.default_rng(11)
+    running = np.column_stack([rng.integers(1, 64, 3000), rng.integers(1, 8, 3000), rng.integers(0, 2, 3000)])
+    priorities = rng.integers(1, 6, 3000)
+    for _ in range(50):
+        demand = (int(rng.integers(64, 2048)), int(rng.integers(8, 64)), int(rng.integers(0, 4)))
+        victims = find_victims(demand, (0, 0, 0), running, priorities, 2)
+        if victims is None:
+            continue
+        assert (priorities[victims] > 2).all()
+        freed = running[victims].sum(axis=0)
+        assert (freed >= demand).all()
+        # None of them could be spared
+        assert all(((freed - running[v]) < demand).any() for v in victims)
+
+def test_victim_search_is_fast_on_large_clusters():
+    rng = np.random.default_rng(5)
+    running = np.column_stack([rng.integers(256, 4096, 5000), rng.integers(1, 8, 5000), rng.integers(0, 2, 5000)])
+    priorities = rng.integers(1, 6, 5000)
+    timings = []
+    for _ in range(20):
+        start = time.perf_counter()
+        assert find_victims((64 * 1024, 32, 4), (0, 0, 0), running, priorities, 1) is not None
+        timings.append(time.perf_counter() - start)
+    assert sorted(timings)[len(timings) // 2] < 0.01
+
+def test_plan_preemption_places_in_priority_order():
+    running = [(2, 2, 0)] * 3
+    placed, evicted, remaining = plan_preemption([(2, 2, 0), (2, 2, 0), (4, 4, 0)], [1, 3, 1], (0, 0, 0), running, [3, 3, 4])
+    # The first waiting one takes the priority 4 slot, the second can't evict its own tier,
+    # the third evicts both priority 3 ones
+    assert placed == [0, 2]
+    assert sorted(evicted) == [0, 1, 2]
+    assert remaining.tolist() == [0, 0, 0]
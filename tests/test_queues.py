@@ -0,0 +1,134 @@
+import asyncio
+import random
+import pytest
+from app import queues
+
+# Every backend must pass the same suite
+def memory_backend():
+    return queues.MemoryQueue()
+
+def redis_backend():
+    fakeredis = pytest.importorskip("fakeredis")
+    return queues.RedisQueue(fakeredis.FakeAsyncRedis())
+
+@pytest.fixture(params=[memory_backend, redis_backend], ids=["memory", "redis"])
+def backend(request):
+    return request.param()
+
+def run(coro):
+    return asyncio.run(coro)
+
+def test_peek_orders_by_score_then_id(backend):
+    run(backend.enqueue({1: {5: 2, 3: 1, 10: 1, 9: 1}, 2: {7: 0}}))
+    # Equal scores are ordered like Redis orders members: as strings
+    assert run(backend.peek(1)) == [(10, 1.0), (3, 1.0), (9, 1.0), (5, 2.0)]
+    assert run(backend.peek(1, limit=2)) == [(10, 1.0), (3, 1.0)]
+    assert run(backend.peek(2)) == [(7, 0.0)]
+    assert run(backend.peek(3)) == []
+    assert run(backend.peek(1, limit=0)) == []
+    assert run(backend.size(1)) == 4
+
+def test_enqueue_rescores(backend):
+    run(backend.enqueue({1: {1: 5, 2: 3}}))
+    run(backend.enqueue({1: {1: 1}}))
+    assert run(backend.peek(1)) == [(1, 1.0), (2, 3.0)]
+    assert run(backend.size(1)) == 2
+
+def test_dequeue_batch_removes(backend):
+    run(backend.enqueue({1: {i: i % 4 for i in range(1, 11)}}))
+    assert run(backend.dequeue_batch(1, limit=0)) == []
+    assert run(backend.size(1)) == 10
+    first = run(backend.dequeue_batch(1, limit=3))
+    assert first == [(4, 0.0), (8, 0.0), (1, 1.0)]
+    rest = run(backend.dequeue_batch(1))
+    assert [entry[0] for entry in rest] == [5, 9, 10, 2, 6, 3, 7]
+    assert run(backend.size(1)) == 0
+    assert run(backend.dequeue_batch(1)) == []
+
+def test_remove_and_clusters(backend):
+    run(backend.enqueue({3: {1: 1, 2: 1}, 1: {3: 1}, 2: {}}))
+    assert run(backend.clusters()) == [1, 3]
+    assert run(backend.sizes()) == {1: 1, 3: 2}
+    run(backend.remove(3, [1, 2, 99]))
+    run(backend.remove(4, [1]))
+    assert run(backend.clusters()) == [1]
+    assert run(backend.peek(1)) == [(3, 1.0)]
+
+def test_matches_sorted_reference(backend):
+    rng = random.Random(7)
+    reference = {}
+    for _ in range(50):
+        scores = {rng.randrange(500): rng.randrange(5) for _ in range(40)}
+        run(backend.enqueue({1: scores}))
+        reference.update(scores)
+        gone = rng.sample(sorted(reference), 10)
+        run(backend.remove(1, gone))
+        for deployment_id in gone:
+            del reference[deployment_id]
+    expected = sorted(((float(s), i) for i, s in reference.items()), key=lambda e: (e[0], str(e[1])))
+    assert run(backend.peek(1)) == [(i, s) for s, i in expected]
+
+def test_bulk_cycle(backend):
+    entries = {cluster_id: {cluster_id * 100000 + i: i % 5 for i in range(5000)} for cluster_id in range(1, 5)}
+
+    async def cycle():
+        await backend.enqueue(entries)
+        for cluster_id in await backend.clusters():
+            queued = await backend.peek(cluster_id)
+            assert len(queued) == 5000 and [score for _, score in queued] == sorted(score for _, score in queued)
+            await backend.remove(cluster_id, [deployment_id for deployment_id, _ in queued[:2500]])
+            assert await backend.size(cluster_id) == 2500
+            dequeued = await backend.dequeue_batch(cluster_id, limit=2500)
+            assert [entry for entry in dequeued] == queued[2500:]
+
+    run(cycle())
+    assert run(backend.clusters()) == []
+
+def test_dirty_set(backend):
+    run(backend.enqueue({1: {1: 1}, 2: {}}))
+    run(backend.wake([3]))
+    run(backend.mark_dirty([4, 1]))
+    assert run(backend.take_dirty()) == {1, 3, 4}
+    assert run(backend.take_dirty()) == set()
+    # Taking marks doesn't touch the queues
+    assert run(backend.clusters()) == [1]
+
+def test_auto_queue_is_separate(backend):
+    run(backend.auto.enqueue({7: {1: 2, 2: 1}}))
+    assert run(backend.auto.peek(7)) == [(2, 1.0), (1, 2.0)]
+    assert run(backend.auto.take_dirty()) == {7}
+    # Organization shards aren't cluster shards
+    assert run(backend.clusters()) == []
+    assert run(backend.take_dirty()) == set()
+
+def test_scores_and_scan(backend):
+    run(backend.enqueue({1: {i: i % 3 for i in range(1, 26)}, 2: {30: 4}}))
+    assert run(backend.scores({1: [3, 4, 99], 2: [30, 3], 5: [1]})) == {1: [0.0, 1.0, None], 2: [4.0, None], 5: [None]}
+
+    async def scanned(cluster_id):
+        return [chunk async for chunk in backend.scan(cluster_id, count=10)]
+
+    chunks = run(scanned(1))
+    assert sorted(i for chunk in chunks for i in chunk) == list(range(1, 26))
+    assert run(scanned(3)) == []
+
+def test_wakeups(backend):
+    async def heard():
+        received = []
+
+        async def listen():
+            async for cluster_id in backend.wakeups():
+                received.append(cluster_id)
+
+        task = asyncio.create_task(listen())
+        await asyncio.sleep(0.05)
+        await backend.wake([3])
+        await asyncio.sleep(0.05)
+        # Still listening, an iterator that ended would be restarted in a busy loop
+        assert not task.done()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return received
+
+    # Other processes hear a shared queue's wake-ups, a process-local one has nobody to tell
+    assert run(heard()) == ([3] if backend.shared else [])
@@ -0,0 +1,89 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app import auth, authz, capacity, database, events, queues, reconcile, scheduler, versions
+from app.database import get_db, Base
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+engine = create_engine("sqlite:///./test.db", connect_args={"check_same_thread": False})
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+async def override_get_db():
+    async with TestingSessionLocal() as db:
+        yield db
+
+app.dependency_overrides[get_db] = override_get_db
+
+client = TestClient(app)
+
+@pytest.fixture(autouse=True)
+def setup_db(monkeypatch):
+    # Queue, events and versions in process, no Redis server needed
+    monkeypatch.setattr(queues, "backend", queues.MemoryQueue())
+    monkeypatch.setattr(versions, "backend", versions.MemoryVersions())
+    monkeypatch.setattr(events, "broker", events.Broker())
+    # Several round trips per side even on a small table
+    monkeypatch.setattr(reconcile, "RECONCILE_BATCH_SIZE", 2)
+    # The scheduler's own sessions go to the test database too, not DATABASE_URL
+    monkeypatch.setattr(database, "AsyncSessionLocal", TestingSessionLocal)
+    Base.metadata.create_all(bind=engine)
+    yield
+    Base.metadata.drop_all(bind=engine)
+    # Ids are reused by the next test's rows
+    authz.memberships.clear()
+    authz.cluster_orgs.clear()
+    capacity.reset()
+
+@pytest.fixture
+def member():
+    client.post("/create-organization", json={"name": "Test Org", "invite_code": "TEST123"})
+    client.post("/register", json={"username": "member", "password": "testpassword"})
+    token = client.post("/token", data={"username": "member", "password": "testpassword"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post("/join-organization?invite_code=TEST123", headers=headers)
+    return headers
+
+def submit(headers, priority, **target):
+    return client.post("/deployments", json={"docker_image": "a", "required_ram": 1024, "required_cpu": 1,
+                                             "required_gpu": 0, "priority": priority, **target}, headers=headers).json()
+
+def test_reconcile_repairs_both_directions(member):
+    cluster = client.post("/clusters", json={"name": "c", "total_ram": 4096, "total_cpu": 4, "total_gpu": 0},
+                          headers=member).json()
+    other = client.post("/clusters", json={"name": "d", "total_ram": 4096, "total_cpu": 4, "total_gpu": 0},
+                        headers=member).json()
+    pinned = [submit(member, priority, cluster_id=cluster["id"]) for priority in (1, 2, 3)]
+    auto = submit(member, 1, organization_id=cluster["organization_id"])
+    done = submit(member, 1, cluster_id=cluster["id"])
+    client.post(f"/deployments/{done['id']}/terminate", headers=member)
+
+    backend = queues.backend
+    # Lost: one pinned and the auto one, a wrong score, an entry left for a finished deployment,
+    # and one on a cluster the deployment isn't on
+    asyncio.run(backend.remove(cluster["id"], [pinned[0]["id"]]))
+    asyncio.run(backend.auto.remove(cluster["organization_id"], [auto["id"]]))
+    asyncio.run(backend.enqueue({cluster["id"]: {pinned[1]["id"]: 9, done["id"]: 1}, other["id"]: {pinned[2]["id"]: 3}}))
+
+    report = asyncio.run(reconcile.reconcile())
+    assert (report["pending"], report["requeued"], report["rescored"], report["removed"]) == (4, 2, 1, 2)
+    assert report["clusters"] == [cluster["id"]] and report["organizations"] == [cluster["organization_id"]]
+    assert asyncio.run(backend.peek(cluster["id"])) == [(pinned[0]["id"], 1.0), (pinned[1]["id"], 2.0), (pinned[2]["id"], 3.0)]
+    assert asyncio.run(backend.peek(other["id"])) == []
+    assert asyncio.run(backend.auto.peek(cluster["organization_id"])) == [(auto["id"], 1.0)]
+
+    # Nothing left to repair, and everything is scheduled again
+    report = asyncio.run(reconcile.reconcile())
+    assert (report["requeued"], report["rescored"], report["removed"]) == (0, 0, 0)
+    asyncio.run(scheduler.schedule_deployments())
+    statuses = {client.get(f"/deployments/{d['id']}", headers=member).json()["status"] for d in pinned + [auto]}
+    assert statuses == {"running"}
+
+def test_reconcile_endpoint_is_admin_only(member, monkeypatch):
+    assert client.post("/scheduler/reconcile", headers=member).status_code == 403
+    monkeypatch.setattr(auth, "ADMIN_USERNAMES", {"member"})
+    response = client.post("/scheduler/reconcile", headers=member)
+    assert response.status_code == 200 and response.json()["requeued"] == 0
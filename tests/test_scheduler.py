@@ -1,28 +1,36 @@
+import asyncio
 import pytest
 from fastapi.testclient import TestClient
 from app.main import app
 from app.database import get_db, Base
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+from app import database, events, metrics, models, queues, scheduler, versions
 from app.scheduler import schedule_deployments
 
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db" # i tested it using my local psql db
 engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
-TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# TestClient runs every request on its own event loop, so no pooled connections
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
 
-def override_get_db():
-    try:
-        db = TestingSessionLocal()
+async def override_get_db():
+    async with TestingSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 app.dependency_overrides[get_db] = override_get_db
 
 client = TestClient(app)
 
 @pytest.fixture(autouse=True)
-def setup_db():
+def setup_db(monkeypatch):
+    # Queue, events and versions in process, no Redis server needed
+    monkeypatch.setattr(queues, "backend", queues.MemoryQueue())
+    monkeypatch.setattr(events, "broker", events.Broker())
+    monkeypatch.setattr(versions, "backend", versions.MemoryVersions())
+    # The scheduler's own sessions go to the test database too, not DATABASE_URL
+    monkeypatch.setattr(database, "AsyncSessionLocal", TestingSessionLocal)
     Base.metadata.create_all(bind=engine)
     yield
     Base.metadata.drop_all(bind=engine)
@@ -120,4 +128,230 @@ def test_scheduler_resource_constraints(authenticated_user, cluster_id):
     assert len(deployments) == 3
     assert deployments[0]["status"] == "running"  # Highest priority (large-app) should be running
     assert deployments[1]["status"] == "pending"  # Medium priority should be pending due to lack of resources
-    assert deployments[2]["status"] == "running"  # Lowest priority (small-app) should be running as it fits in remaining resources
\ No newline at end of file
+    assert deployments[2]["status"] == "running"  # Lowest priority (small-app) should be running as it fits in remaining resources
+
+def test_wakeups_are_coalesced(monkeypatch):
+    passes = []
+
+    async def fake_pass(cluster_ids=None, org_ids=()):
+        passes.append(cluster_ids)
+
+    monkeypatch.setattr(scheduler, "schedule_deployments", fake_pass)
+
+    async def run():
+        task = asyncio.create_task(scheduler.run_event_loop())
+        await asyncio.sleep(0)
+        # A burst of submissions turns into a single pass, over the clusters they were for
+        for i in range(100):
+            scheduler.notify_scheduler(3 if i % 2 else 1)
+        await asyncio.sleep(0.2)
+        assert passes == [[1, 3]]
+        # A later wake-up for every cluster runs a full pass
+        scheduler.notify_scheduler(2)
+        scheduler.notify_scheduler()
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(run())
+    assert passes == [[1, 3], None]
+
+@pytest.fixture
+def contended_cluster():
+    # Capacity for 10 of the 30 queued deployments
+    with engine.begin() as conn:
+        conn.execute(models.Cluster.__table__.insert(), [{
+            "id": 1, "name": "c", "total_ram": 10, "total_cpu": 10, "total_gpu": 0,
+            "available_ram": 10, "available_cpu": 10, "available_gpu": 0,
+        }])
+        conn.execute(models.Deployment.__table__.insert(), [{
+            "id": i, "cluster_id": 1, "docker_image": "img", "required_ram": 1, "required_cpu": 1,
+            "required_gpu": 0, "priority": 1, "status": "pending",
+        } for i in range(1, 31)])
+    asyncio.run(queues.backend.enqueue({1: {i: 1 for i in range(1, 31)}}))
+    return 1
+
+class SplitQueue(queues.MemoryQueue):
+    # Each reader sees a different half of the queue, like replicas reading it at different times
+    reads = 0
+
+    async def peek(self, cluster_id, limit=None):
+        self.reads += 1
+        return [entry for entry in await super().peek(cluster_id, limit) if entry[0] % 2 == self.reads % 2]
+
+def test_concurrent_passes_never_overallocate(contended_cluster, monkeypatch):
+    split = SplitQueue()
+    asyncio.run(split.enqueue({1: dict(asyncio.run(queues.backend.peek(1)))}))
+    monkeypatch.setattr(queues, "backend", split)
+
+    async def replicas():
+        # Several schedulers racing on the same cluster, as separate replicas would
+        return await asyncio.gather(*(scheduler._schedule_cluster(contended_cluster) for _ in range(4)))
+
+    results = asyncio.run(replicas())
+    assert sum(r[0] for r in results) == 10
+    with engine.connect() as conn:
+        cluster = conn.execute(select(models.Cluster).where(models.Cluster.id == 1)).one()
+        running = conn.execute(select(models.Deployment.id).where(models.Deployment.status == "running")).all()
+    assert len(running) == 10
+    assert (cluster.available_ram, cluster.available_cpu) == (0, 0)
+
+def test_claim_rejects_stale_placement(contended_cluster):
+    async def claim(placed, used):
+        async with TestingSessionLocal() as db:
+            ok = await scheduler._claim(db, contended_cluster, placed, used)
+            await (db.commit() if ok else db.rollback())
+            return ok
+
+    assert asyncio.run(claim([1, 2], [2, 2, 0]))
+    # Already running
+    assert not asyncio.run(claim([2, 3], [2, 2, 0]))
+    # More than what is left
+    assert not asyncio.run(claim(list(range(3, 13)), [10, 10, 0]))
+    with engine.connect() as conn:
+        cluster = conn.execute(select(models.Cluster).where(models.Cluster.id == 1)).one()
+    assert (cluster.available_ram, cluster.available_cpu) == (8, 8)
+
+@pytest.fixture
+def full_cluster():
+    # Full of priority 5 deployments, one of priority 2
+    with engine.begin() as conn:
+        conn.execute(models.Cluster.__table__.insert(), [{
+            "id": 1, "name": "c", "total_ram": 8, "total_cpu": 8, "total_gpu": 0,
+            "available_ram": 0, "available_cpu": 0, "available_gpu": 0,
+        }])
+        conn.execute(models.Deployment.__table__.insert(), [{
+            "id": i, "cluster_id": 1, "docker_image": "img", "required_ram": size, "required_cpu": size,
+            "required_gpu": 0, "priority": priority, "status": "running",
+        } for i, size, priority in ((1, 1, 5), (2, 1, 5), (3, 2, 5), (4, 4, 2))])
+    metrics.reset()
+    yield 1
+    metrics.reset()
+
+def queue_deployment(deployment_id, size, priority):
+    with engine.begin() as conn:
+        conn.execute(models.Deployment.__table__.insert(), [{
+            "id": deployment_id, "cluster_id": 1, "docker_image": "img", "required_ram": size, "required_cpu": size,
+            "required_gpu": 0, "priority": priority, "status": "pending",
+        }])
+    asyncio.run(queues.backend.enqueue({1: {deployment_id: priority}}))
+
+def statuses():
+    with engine.connect() as conn:
+        return dict(conn.execute(select(models.Deployment.id, models.Deployment.status)).all())
+
+def test_preemption_evicts_lower_priority(full_cluster, monkeypatch):
+    queue_deployment(10, 2, 1)
+    # Off by default: it waits
+    asyncio.run(scheduler.schedule_deployments())
+    assert statuses()[10] == "pending"
+
+    monkeypatch.setattr(scheduler, "SCHEDULER_PREEMPTION", True)
+    asyncio.run(scheduler.schedule_deployments())
+    current = statuses()
+    assert current[10] == "running"
+    # The one 2-unit deployment of the lowest tier makes room, nothing else moves
+    assert [i for i in (1, 2, 3, 4) if current[i] == "pending"] == [3]
+    assert asyncio.run(queues.backend.peek(1)) == [(3, 5.0)]
+    with engine.connect() as conn:
+        assert conn.execute(select(models.Cluster.available_ram)).scalar() == 0
+
+    # Same tier can't preempt
+    queue_deployment(11, 1, 5)
+    asyncio.run(scheduler.schedule_deployments())
+    assert statuses()[11] == "pending"
+
+    stats = metrics.scheduler_stats()
+    assert (stats["preemptions"], stats["evictions"]) == (1, 1)
+    assert stats["latency_by_priority"][1]["count"] == 1
+
+def test_incremental_passes_only_evaluate_dirty_clusters(full_cluster, monkeypatch):
+    evaluated = []
+    schedule_cluster = scheduler._schedule_cluster
+
+    async def spy(cluster_id):
+        evaluated.append(cluster_id)
+        return await schedule_cluster(cluster_id)
+
+    monkeypatch.setattr(scheduler, "_schedule_cluster", spy)
+    queue_deployment(10, 2, 1)
+    asyncio.run(scheduler.schedule_changed())
+    assert evaluated == [1] and statuses()[10] == "pending"
+
+    # Still waiting, but nothing changed: the next passes don't look at it again
+    asyncio.run(scheduler.schedule_changed())
+    asyncio.run(scheduler.schedule_changed())
+    assert evaluated == [1]
+
+    # A release marks it dirty
+    with engine.begin() as conn:
+        conn.execute(models.Deployment.__table__.update().where(models.Deployment.id == 4).values(status="completed"))
+        conn.execute(models.Cluster.__table__.update().values(available_ram=4, available_cpu=4))
+    asyncio.run(queues.backend.wake([1]))
+    asyncio.run(scheduler.schedule_changed())
+    assert evaluated == [1, 1] and statuses()[10] == "running"
+
+    # A cluster that couldn't be scheduled stays dirty, the full sweep looks at every queue
+    async def failing(cluster_id):
+        evaluated.append(cluster_id)
+        return 0, 0, 0, None, True
+
+    monkeypatch.setattr(scheduler, "_schedule_cluster", failing)
+    asyncio.run(scheduler.schedule_changed([1]))
+    assert asyncio.run(queues.backend.take_dirty()) == {1}
+    queue_deployment(11, 8, 5)
+    asyncio.run(scheduler.schedule_deployments())
+    assert evaluated == [1, 1, 1, 1]
+    stats = metrics.render()
+    assert 'scheduler_pass_clusters_count{kind="incremental"} 3' in stats
+    assert 'scheduler_pass_clusters_count{kind="full"} 1' in stats
+
+def test_legacy_queue_is_sharded_once(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeAsyncRedis()
+    monkeypatch.setattr(queues, "backend", queues.RedisQueue(client))
+    monkeypatch.setattr(scheduler, "_legacy_drained", False)
+    # No room anywhere, the deployments stay queued where the pass put them
+    with engine.begin() as conn:
+        conn.execute(models.Cluster.__table__.insert(), [{
+            "id": i, "name": f"c{i}", "total_ram": 0, "total_cpu": 0, "total_gpu": 0,
+            "available_ram": 0, "available_cpu": 0, "available_gpu": 0,
+        } for i in (1, 2)])
+        conn.execute(models.Deployment.__table__.insert(), [{
+            "id": i, "cluster_id": 1 + i % 2, "docker_image": "img", "required_ram": 1, "required_cpu": 1,
+            "required_gpu": 0, "priority": i, "status": "pending",
+        } for i in range(1, 5)])
+    asyncio.run(client.zadd(queues.QUEUE_KEY, {i: i for i in range(1, 5)}))
+
+    asyncio.run(schedule_deployments())
+    assert asyncio.run(queues.backend.peek(1)) == [(2, 2.0), (4, 4.0)]
+    assert asyncio.run(queues.backend.peek(2)) == [(1, 1.0), (3, 3.0)]
+    assert not asyncio.run(client.exists(queues.QUEUE_KEY))
+
+    # Later full passes don't look for it again
+    asyncio.run(client.zadd(queues.QUEUE_KEY, {9: 1}))
+    asyncio.run(schedule_deployments())
+    assert asyncio.run(client.zcard(queues.QUEUE_KEY)) == 1
+
+def test_passes_schedule_at_most_the_concurrency_limit(monkeypatch):
+    monkeypatch.setattr(scheduler, "SCHEDULER_CONCURRENCY", 2)
+    evaluated, running, most = [], [0], [0]
+
+    async def spy(cluster_id):
+        evaluated.append(cluster_id)
+        running[0] += 1
+        most[0] = max(most[0], running[0])
+        await asyncio.sleep(0.01)
+        running[0] -= 1
+        return 0, 1, 0, None, False
+
+    monkeypatch.setattr(scheduler, "_schedule_cluster", spy)
+    asyncio.run(queues.backend.enqueue({cluster_id: {cluster_id: 1} for cluster_id in range(1, 7)}))
+    asyncio.run(scheduler.schedule_changed())
+    assert sorted(evaluated) == [1, 2, 3, 4, 5, 6] and most[0] == 2
+
+    # Only the clusters marked since are looked at
+    asyncio.run(queues.backend.wake([4]))
+    asyncio.run(scheduler.schedule_changed())
+    assert evaluated[6:] == [4]
+    asyncio.run(schedule_deployments())
+    assert sorted(evaluated[7:]) == [1, 2, 3, 4, 5, 6] and most[0] == 2
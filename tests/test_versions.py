@@ -0,0 +1,112 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app import authz, database, events, queues, scheduler, versions
+from app.database import get_db, Base
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
+
+engine = create_engine("sqlite:///./test.db", connect_args={"check_same_thread": False})
+async_engine = create_async_engine("sqlite+aiosqlite:///./test.db", poolclass=NullPool)
+TestingSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+async def override_get_db():
+    async with TestingSessionLocal() as db:
+        yield db
+
+app.dependency_overrides[get_db] = override_get_db
+
+client = TestClient(app)
+
+queries = []
+event.listen(async_engine.sync_engine, "before_cursor_execute", lambda *args: queries.append(args[2]))
+
+@pytest.fixture(autouse=True)
+def setup_db(monkeypatch):
+    # Queue, events and versions in process, no Redis server needed
+    monkeypatch.setattr(queues, "backend", queues.MemoryQueue())
+    monkeypatch.setattr(events, "broker", events.Broker())
+    monkeypatch.setattr(versions, "backend", versions.MemoryVersions())
+    versions.responses.clear()
+    # The scheduler's own sessions go to the test database too, not DATABASE_URL
+    monkeypatch.setattr(database, "AsyncSessionLocal", TestingSessionLocal)
+    Base.metadata.create_all(bind=engine)
+    yield
+    Base.metadata.drop_all(bind=engine)
+    # Ids are reused by the next test's rows
+    versions.responses.clear()
+    authz.memberships.clear()
+    authz.cluster_orgs.clear()
+
+def join(username, invite_code):
+    client.post("/create-organization", json={"name": f"Org {invite_code}", "invite_code": invite_code})
+    client.post("/register", json={"username": username, "password": "testpassword"})
+    token = client.post("/token", data={"username": username, "password": "testpassword"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    client.post(f"/join-organization?invite_code={invite_code}", headers=headers)
+    return headers
+
+def revalidate(url, headers):
+    """The response to a GET, then the queries run by the same GET with its ETag."""
+    response = client.get(url, headers=headers)
+    del queries[:]
+    again = client.get(url, headers=dict(headers, **{"If-None-Match": response.headers["etag"]}))
+    return response, again, list(queries)
+
+def test_conditional_gets_follow_versions():
+    member = join("member", "TEST123")
+    cluster = client.post("/clusters", json={"name": "c", "total_ram": 4096, "total_cpu": 4, "total_gpu": 0},
+                          headers=member).json()
+    deployment = client.post("/deployments", json={"cluster_id": cluster["id"], "docker_image": "a", "required_ram": 1024,
+                                                   "required_cpu": 1, "required_gpu": 0, "priority": 1},
+                             headers=member).json()
+
+    tags = {}
+    for url in (f"/clusters/{cluster['id']}", "/clusters", f"/deployments/{deployment['id']}"):
+        response, again, ran = revalidate(url, member)
+        assert response.status_code == 200 and response.headers["cache-control"] == "private, no-cache"
+        # Unchanged: a 304 from the cache, without a query
+        assert again.status_code == 304 and again.headers["etag"] == response.headers["etag"] and not again.content
+        assert ran == []
+        assert client.get(url, headers=member).json() == response.json()
+        tags[url] = response.headers["etag"]
+
+    # Placing the deployment moves its cluster's and organization's versions
+    asyncio.run(scheduler.schedule_deployments())
+    for url, tag in tags.items():
+        response = client.get(url, headers=dict(member, **{"If-None-Match": tag}))
+        assert response.status_code == 200 and response.headers["etag"] != tag
+    assert client.get(f"/deployments/{deployment['id']}", headers=member).json()["status"] == "running"
+    assert client.get(f"/clusters/{cluster['id']}", headers=member).json()["available_ram"] == 3072
+    assert client.get("/clusters", headers=member).json()[0]["available_cpu"] == 3
+
+    # A new cluster shows up in the list
+    client.post("/clusters", json={"name": "d", "total_ram": 1, "total_cpu": 1, "total_gpu": 0}, headers=member)
+    assert len(client.get("/clusters", headers=member).json()) == 2
+    # Cached pages keep their next page headers
+    first, cached = (client.get("/clusters?limit=1", headers=member) for _ in range(2))
+    assert first.headers["x-next-cursor"] == cached.headers["x-next-cursor"] == str(cluster["id"])
+    assert cached.json() == first.json() and len(cached.json()) == 1
+
+def test_cached_responses_are_checked_for_access():
+    member = join("member", "TEST123")
+    outsider = join("outsider", "OTHER")
+    cluster = client.post("/clusters", json={"name": "c", "total_ram": 4096, "total_cpu": 4, "total_gpu": 0},
+                          headers=member).json()
+    deployment = client.post("/deployments", json={"organization_id": cluster["organization_id"], "docker_image": "a",
+                                                   "required_ram": 1024, "required_cpu": 1, "required_gpu": 0, "priority": 1},
+                             headers=member).json()
+
+    for url in (f"/clusters/{cluster['id']}", f"/deployments/{deployment['id']}"):
+        tag = client.get(url, headers=member).headers["etag"]
+        assert client.get(url, headers=dict(outsider, **{"If-None-Match": tag})).status_code == 403
+        assert client.get(url, headers=outsider).status_code == 403
+
+    # Waiting for a cluster, it is cached under its organization until placed
+    tag = client.get(f"/deployments/{deployment['id']}", headers=member).headers["etag"]
+    asyncio.run(scheduler.schedule_deployments())
+    response = client.get(f"/deployments/{deployment['id']}", headers=dict(member, **{"If-None-Match": tag}))
+    assert response.status_code == 200 and response.json()["cluster_id"] == cluster["id"]
+    assert client.get("/deployments/999", headers=member).status_code == 404